@@ -0,0 +1,125 @@
+import os
+import importlib
+from collections import namedtuple
+
+import numpy as np
+
+import prefetch
+
+# Genotype backends, imported only when first used so that the command line can start, validate its inputs and fail
+# without loading any genotype library (rbgen goes through rpy2 and starts R).
+# name -> (module, class, genotype file extension)
+BACKENDS = {
+    'bgen': ('bgen.bgen_dosage', 'BGENDosage', '.bgen'),
+    'bed': ('plink.plink_dosage', 'BEDDosage', '.bed'),
+    'pgen': ('plink.plink_dosage', 'PGENDosage', '.pgen'),
+    'vcf': ('vcf.vcf_dosage', 'VCFDosage', '.vcf.gz'),
+}
+
+# variants yielded by the items() method of the genotype backends (BGENDosage yields pandas Series with these fields
+# when decoding through rbgen); dosages count allele1
+Variant = namedtuple('Variant', ['chr', 'position', 'rsid', 'allele0', 'allele1', 'dosages'])
+
+
+def chromosome_number(chromosome):
+    chromosome = chromosome[3:] if chromosome.lower().startswith('chr') else chromosome
+    return int(chromosome) if chromosome.isdigit() else chromosome
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError("Unknown genotype backend {} (known: {})".format(name, ', '.join(sorted(BACKENDS))))
+    module_name, class_name, _ = BACKENDS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def get_extension(name):
+    return BACKENDS[name][2]
+
+
+def find_genotype_files(genotype_dir, prefixes):
+    """
+    Picks the genotype backend from the files found: the first backend (in BACKENDS order) with files starting with
+    any of the prefixes.
+    :return: the backend name and the sorted list of matching file names, or (None, []) if none matches.
+    """
+    filenames = sorted(os.listdir(genotype_dir))
+    for name, (_, _, extension) in BACKENDS.items():
+        genotype_files = [x for x in filenames if x.startswith(prefixes) and x.endswith(extension)]
+        if genotype_files:
+            return name, genotype_files
+    return None, []
+
+
+class VariantTableDosage:
+    """
+    Common selection and batching logic of the backends whose variant table is read in memory (PLINK filesets, VCF
+    files). Subclasses implement _read_variants and _decode, and call _read_variants from their constructor; they can
+    also set prefetch_fd (with _batch_ranges) to read the bytes of the next batches ahead.
+    """
+    prefetch_fd = None
+    prefetch_depth = 0
+    prefetch_max_bytes = 0
+
+    def _read_variants(self, variants_path):
+        """
+        Reads the variant table: must set the chromosomes, positions, rsids, alleles0 and alleles1 lists (one entry
+        per variant, in the order they are stored) and variants_count.
+        """
+        raise NotImplementedError("{} does not read a variant table".format(type(self).__name__))
+
+    def _decode(self, variant_idxs):
+        """
+        Decodes a batch of variant indexes (in storage order) into a (variants x samples) float dosage array counting
+        allele1, with NaN for missing dosages.
+        """
+        raise NotImplementedError("{} does not decode dosages".format(type(self).__name__))
+
+    def _batch_ranges(self, variant_idxs):
+        """
+        Byte ranges of prefetch_fd read to decode a batch of variant indexes.
+        """
+        return []
+
+    def _select(self, include_rsid):
+        if include_rsid is None:
+            return np.arange(self.variants_count)
+        include_rsid = set(include_rsid)
+        return np.array([idx for idx, rsid in enumerate(self.rsids) if rsid in include_rsid], dtype=np.int64)
+
+    def variant_positions(self, include_rsid):
+        """
+        Returns the (rsid, position) of the variants with rsids in include_rsid, in the order they are stored.
+        """
+        return [(self.rsids[idx], self.positions[idx]) for idx in self._select(include_rsid)]
+
+    def variant_table(self):
+        """
+        Returns the rsids, chromosomes, positions and alleles (allele0, allele1) of all variants, in the order they are
+        stored.
+        """
+        return self.rsids, self.chromosomes, self.positions, self.alleles0, self.alleles1
+
+    def items(self, n_rows_cached=100, include_rsid=None, sample_idxs=None):
+        """
+        Retrieve generator of variants, one by one, in the order they are stored in the file. Dosages count allele1.
+        :param n_rows_cached: number of variants decoded at a time.
+        :param include_rsid: if given, only variants with these rsids are returned.
+        :param sample_idxs: if given, dosages only have these samples (indexes in the .fam/.psam file, or in the VCF header).
+        """
+        variant_idxs = self._select(include_rsid)
+        all_batch_idxs = (variant_idxs[start:start + n_rows_cached] for start in range(0, len(variant_idxs), n_rows_cached))
+        for batch_idxs in prefetch.read_ahead(all_batch_idxs, self._batch_ranges, self.prefetch_fd, self.prefetch_depth, self.prefetch_max_bytes):
+            dosages = self._decode(batch_idxs)
+            if sample_idxs is not None:
+                dosages = dosages[:, sample_idxs]
+
+            # missing genotypes are imputed with the mean dosage of the variant
+            missing = np.isnan(dosages)
+            if missing.any():
+                means = np.nanmean(dosages, axis=1)
+                dosages[missing] = np.take(means, np.nonzero(missing)[0])
+
+            for row_idx, variant_idx in enumerate(batch_idxs):
+                yield Variant(self.chromosomes[variant_idx], self.positions[variant_idx], self.rsids[variant_idx],
+                              self.alleles0[variant_idx], self.alleles1[variant_idx], dosages[row_idx])
@@ -1,34 +1,103 @@
 import sqlite3
 import gc
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-from rpy2.robjects.vectors import StrVector
-from rpy2.robjects.packages import importr
-from rpy2.robjects import pandas2ri
-pandas2ri.activate()
+import prefetch
+from backends import Variant, chromosome_number
+from bgen.bgen_reader import BGENReader, FIXED_POINT_ONE
+from bgen.bgi_sidecar import BGISidecar, rsid_hash
+
+# R is single-threaded: all calls through rpy2 must be serialized when BGEN files are read from several threads
+R_LOCK = threading.Lock()
 
 
 class BGENDosage:
-    def __init__(self, bgen_path, bgen_bgi=None, sample_path=None):
+    def __init__(self, bgen_path, bgen_bgi=None, sample_path=None, decoder='rbgen', n_threads=1, fixed_point=False, bgi_sidecar=False,
+                 prefetch_depth=0, prefetch_max_bytes=256 * 1024 ** 2):
+        """
+        :param decoder: 'rbgen' to read variants through the rbgen R package, or 'native' to decode them in Python
+        (BGENReader), with n_threads threads per batch.
+        :param fixed_point: native decoder only; return dosages as uint16 in units of dosage_scale (missing samples
+        are FIXED_POINT_MISSING) instead of float64, which is a quarter of the memory traffic.
+        :param bgi_sidecar: read the index through a NumPy copy of it stored next to the .bgi file (BGISidecar),
+        built on first use, instead of SQLite queries.
+        :param prefetch_depth: native decoder only; number of batches whose variant blocks are read ahead by the
+        kernel (posix_fadvise) while the current batch is decoded, up to prefetch_max_bytes. The .bgi index is also
+        read ahead when opening the file. 0 disables read-ahead.
+        """
         self.bgen_path = bgen_path
         if bgen_bgi is None:
             self.bgi_path = self.bgen_path + '.bgi'
         else:
             self.bgi_path = bgen_bgi + '.bgi'
         self.sample_path = sample_path
+        self.decoder = decoder
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.dosage_scale = 1.0 / FIXED_POINT_ONE if fixed_point else None
         
-        self.rbgen = importr('rbgen')
-        with sqlite3.connect(self.bgi_path) as conn:
-            self.variants_count = conn.execute('select count(*) from Variant').fetchone()[0]
+        if decoder == 'rbgen':
+            with R_LOCK:
+                from rpy2.robjects.packages import importr
+                from rpy2.robjects import pandas2ri
+                pandas2ri.activate()
+                self.rbgen = importr('rbgen')
+        elif decoder == 'native':
+            self.reader = BGENReader(self.bgen_path)
+            self.pool = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+        else:
+            raise ValueError("Unknown BGEN decoder {}".format(decoder))
+
+        if fixed_point and decoder != 'native':
+            raise ValueError("Fixed-point dosages need the native decoder")
 
-            # FIXME: only one chromosome per BGEN file is supported
-            self.chr_number = conn.execute('select distinct chromosome from Variant').fetchone()[0]
+        if prefetch_depth > 0 and decoder == 'native':
+            prefetch.advise_file(self.bgi_path)
+
+        self.sidecar = None
+        if bgi_sidecar:
+            try:
+                self.sidecar = BGISidecar(self.bgi_path)
+            except OSError as e:
+                print("WARNING: cannot use the BGI sidecar of {}, reading the index with SQLite ({})".format(self.bgi_path, e))
+
+        if self.sidecar is not None:
+            self.variants_count = self.sidecar.variants_count
+            self.chr_number = self.sidecar.chr_number
+        else:
+            with sqlite3.connect(self.bgi_path) as conn:
+                self.variants_count = conn.execute('select count(*) from Variant').fetchone()[0]
+
+                # FIXME: only one chromosome per BGEN file is supported
+                self.chr_number = conn.execute('select distinct chromosome from Variant').fetchone()[0]
+
+    def close(self):
+        """
+        Closes the BGEN file, its index sidecar and the decoding threads of the native decoder. Variants cannot be
+        read afterwards.
+        """
+        if getattr(self, 'reader', None) is not None:
+            self.reader.close()
+        if getattr(self, 'pool', None) is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.sidecar = None
 
     def get_row(self, row_idx):
         row_number = (row_idx if row_idx >= 0 else self.variants_count + row_idx, )
 
+        if self.decoder == 'native':
+            with sqlite3.connect(self.bgi_path) as conn:
+                file_start_position, size_in_bytes = conn.execute('select file_start_position, size_in_bytes from Variant order by position limit 1 offset ?', row_number).fetchone()
+            dosages = np.empty(self.reader.samples_count)
+            return Variant(*self._decode_variant(file_start_position, size_in_bytes, dosages), dosages)
+
+        from rpy2.robjects import pandas2ri
+
         with sqlite3.connect(self.bgi_path) as conn:
             variant_position = conn.execute('select position from Variant order by position limit 1 offset ?', row_number).fetchone()[0]
 
@@ -38,9 +107,10 @@ class BGENDosage:
             'end': [variant_position],
         })
 
-        data = self.rbgen.bgen_load(self.bgen_path, ranges)
-        variant = pandas2ri.ri2py(data[0])
-        probs = pandas2ri.ri2py(data[4])
+        with R_LOCK:
+            data = self.rbgen.bgen_load(self.bgen_path, ranges)
+            variant = pandas2ri.ri2py(data[0])
+            probs = pandas2ri.ri2py(data[4])
 
         dosage_row = variant.iloc[0].rename({'chromosome': 'chr'})
         dosage_row['chr'] = int(dosage_row.chr)
@@ -48,6 +118,29 @@ class BGENDosage:
 
         return dosage_row
 
+    def variant_positions(self, include_rsid):
+        """
+        Returns the (rsid, position) of the variants with rsids in include_rsid, in the order they are stored in the
+        BGEN file, read from the index only.
+        """
+        if self.sidecar is not None:
+            rsids_by_hash = {rsid_hash(rsid): rsid for rsid in include_rsid}
+            variants = self.sidecar.select(include_rsid)
+            return [(rsids_by_hash[h], p) for h, p in zip(variants['rsid_hash'].tolist(), variants['position'].tolist())]
+
+        stm = 'select rsid, position from Variant where rsid in ({}) order by file_start_position asc'.format(', '.join(["'{}'".format(x) for x in include_rsid]))
+        with sqlite3.connect(self.bgi_path) as conn:
+            return conn.execute(stm).fetchall()
+
+    def variant_table(self):
+        """
+        Returns the rsids, chromosomes, positions and alleles (allele0, allele1) of all variants in the BGEN index, in
+        the order they are stored in the BGEN file.
+        """
+        with sqlite3.connect(self.bgi_path) as conn:
+            rows = conn.execute('select rsid, chromosome, position, allele1, allele2 from Variant order by file_start_position asc').fetchall()
+        return tuple(list(column) for column in zip(*rows)) if rows else ([], [], [], [], [])
+
     def _chunker(self, seq, size):
         """
         Divides a sequence in chunks according to the given size.
@@ -57,13 +150,84 @@ class BGENDosage:
         """
         return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
-    def items(self, n_rows_cached=100, include_rsid=None):
+    def _decode_variant(self, file_start_position, size_in_bytes, out, sample_idxs=None):
+        block = self.reader.read_block(file_start_position, size_in_bytes)
+        rsid, chromosome, position, alleles, offset = self.reader.parse_variant(block)
+        self.reader.decode_dosages(self.reader.genotype_data(block, offset), out, sample_idxs)
+        return chromosome_number(chromosome), position, rsid, alleles[0], alleles[1]
+
+    def batches(self, n_rows_cached=100, include_rsid=None, sample_idxs=None):
+        """
+        Retrieve generator of batches of variants decoded with the native decoder, in the order they are stored in the
+        BGEN file. The variant blocks of a batch are read, decompressed and decoded by the thread pool, straight into
+        their row of the batch dosage array.
+        :param n_rows_cached: number of variants per batch.
+        :param include_rsid: if given, only variants with these rsids are returned.
+        :param sample_idxs: if given, only these samples (indexes in the BGEN file) are decoded.
+        :return: generator of (variants, dosages), where variants is a list of (chr, position, rsid, allele0, allele1)
+        and dosages is a (variants x samples) array (uint16 in units of dosage_scale with fixed_point).
+        """
+        n_samples = self.reader.samples_count if sample_idxs is None else len(sample_idxs)
+
+        all_blocks = prefetch.read_ahead(self._blocks(n_rows_cached, include_rsid), lambda blocks: blocks, self.reader.fd,
+                                         self.prefetch_depth, self.prefetch_max_bytes)
+        for blocks in all_blocks:
+            dosages = np.empty((len(blocks), n_samples), dtype=np.uint16 if self.dosage_scale else np.float64)
+            if self.pool is None:
+                variants = [self._decode_variant(start, size, dosages[idx], sample_idxs) for idx, (start, size) in enumerate(blocks)]
+            else:
+                variants = list(self.pool.map(self._decode_variant, [x[0] for x in blocks], [x[1] for x in blocks], dosages, [sample_idxs] * len(blocks)))
+
+            yield variants, dosages
+
+    def _blocks(self, n_rows_cached, include_rsid):
+        """
+        Retrieve generator of lists of (file_start_position, size_in_bytes) of at most n_rows_cached variant blocks, in
+        file order.
+        """
+        if self.sidecar is not None:
+            variants = self.sidecar.select(include_rsid)
+            for start in range(0, len(variants), n_rows_cached):
+                batch = variants[start:start + n_rows_cached]
+                yield list(zip(batch['file_start_position'].tolist(), batch['size_in_bytes'].tolist()))
+            return
+
+        if include_rsid is not None:
+            stm = 'select file_start_position, size_in_bytes from Variant where rsid in ({}) order by file_start_position asc'.format(', '.join(["'{}'".format(x) for x in include_rsid]))
+        else:
+            stm = 'select file_start_position, size_in_bytes from Variant order by file_start_position asc'
+
+        with sqlite3.connect(self.bgi_path) as conn:
+            cur = conn.cursor()
+            cur.execute(stm)
+
+            while True:
+                blocks = cur.fetchmany(size=n_rows_cached)
+                if not blocks:
+                    break
+                yield blocks
+
+    def items(self, n_rows_cached=100, include_rsid=None, sample_idxs=None):
         """
         Retrieve generator of variants, one by one. Although variants are returned in the order as they are stored in
         the BGEN file, when there are variants with the same positions their order is not guaranteed.
         :param n_rows_cached:
+        :param sample_idxs: if given, dosages only have these samples (indexes in the BGEN file).
         :return:
         """
+        if self.decoder == 'native':
+            return self._native_items(n_rows_cached, include_rsid, sample_idxs)
+        return self._rbgen_items(n_rows_cached, include_rsid, sample_idxs)
+
+    def _native_items(self, n_rows_cached, include_rsid, sample_idxs):
+        for variants, dosages in self.batches(n_rows_cached, include_rsid, sample_idxs):
+            for row_idx, variant in enumerate(variants):
+                yield Variant(*variant, dosages[row_idx])
+
+    def _rbgen_items(self, n_rows_cached, include_rsid, sample_idxs):
+        from rpy2.robjects.vectors import StrVector
+        from rpy2.robjects import pandas2ri
+
         # retrieve positions
         if include_rsid is not None:
             stm = 'select distinct rsid, position from Variant where rsid in ({}) order by file_start_position asc'.format(', '.join(["'{}'".format(x) for x in include_rsid]))
@@ -78,10 +242,11 @@ class BGENDosage:
 
             while True:
                 if iteration > 0:
-                    cached_data_struct = cached_data.__sexp__
-                    del cached_data
-                    del cached_data_struct
-                    gc.collect()
+                    with R_LOCK:
+                        cached_data_struct = cached_data.__sexp__
+                        del cached_data
+                        del cached_data_struct
+                        gc.collect()
 
                 positions = cur.fetchmany(size=n_rows_cached)
                 if not positions:
@@ -90,27 +255,29 @@ class BGENDosage:
                 rsids = [x[0] for x in positions]
                 positions = [x[1] for x in positions]
 
-                if include_rsid is None:
-                    ranges = pd.DataFrame({
-                        'chromosome': [self.chr_number],
-                        'start': [positions[0]],
-                        'end': [positions[-1]],
-                    })
+                with R_LOCK:
+                    if include_rsid is None:
+                        ranges = pd.DataFrame({
+                            'chromosome': [self.chr_number],
+                            'start': [positions[0]],
+                            'end': [positions[-1]],
+                        })
 
-                    # rbgen = importr('rbgen')
-                    cached_data = self.rbgen.bgen_load(self.bgen_path, ranges, index_filename = self.bgi_path)
+                        # rbgen = importr('rbgen')
+                        cached_data = self.rbgen.bgen_load(self.bgen_path, ranges, index_filename = self.bgi_path)
 
-                else:
-                    cached_data = self.rbgen.bgen_load(self.bgen_path, rsids=StrVector(rsids), index_filename = self.bgi_path)
+                    else:
+                        cached_data = self.rbgen.bgen_load(self.bgen_path, rsids=StrVector(rsids), index_filename = self.bgi_path)
 
-                all_variants = pandas2ri.ri2py(cached_data[0])
-                all_probs = pandas2ri.ri2py(cached_data[4])
+                    all_variants = pandas2ri.ri2py(cached_data[0])
+                    all_probs = pandas2ri.ri2py(cached_data[4])
 
                 iteration += 1
 
                 for row_idx, (rsid, row) in enumerate(all_variants.iterrows()):
                     dosage_row = row.rename({'chromosome': 'chr'})
                     dosage_row['chr'] = int(dosage_row.chr)
-                    dosage_row['dosages'] = np.dot(all_probs[row_idx, :, :], [0, 1, 2])
+                    probs = all_probs[row_idx, :, :] if sample_idxs is None else all_probs[row_idx, sample_idxs, :]
+                    dosage_row['dosages'] = np.dot(probs, [0, 1, 2])
 
                     yield dosage_row
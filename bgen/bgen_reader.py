@@ -0,0 +1,263 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# fixed-point dosages are stored as uint16 in units of 1 / FIXED_POINT_ONE, so that 2 (the largest dosage) fits
+FIXED_POINT_ONE = 32767
+# dosages are at most 2 * FIXED_POINT_ONE, so the largest uint16 is free to mark missing samples
+FIXED_POINT_MISSING = np.iinfo(np.uint16).max
+
+
+def from_fixed_point(dosages):
+    """
+    Float dosages of fixed-point dosages (see BGENReader.decode_dosages), with NaN for missing samples.
+    """
+    out = dosages * (1.0 / FIXED_POINT_ONE)
+    out[dosages == FIXED_POINT_MISSING] = np.nan
+    return out
+
+
+class BGENReader:
+    """
+    Native reader of BGEN variant blocks (layouts 1 and 2, zlib or zstd compressed), used to decode dosages without
+    going through rbgen. Variant blocks are located with the file_start_position and size_in_bytes columns of the
+    .bgi index. All methods are thread-safe: blocks are read with os.pread and decompressed with zlib/zstandard, which
+    release the GIL, so batches can be decoded by a thread pool.
+    """
+    def __init__(self, bgen_path):
+        self.bgen_path = bgen_path
+        # closed by __del__ even if the header cannot be used
+        self.fd = None
+
+        with open(bgen_path, 'rb') as f:
+            self.first_variant_offset, header_length = struct.unpack('<II', f.read(8))
+            self.variants_count, self.samples_count = struct.unpack('<II', f.read(8))
+            f.seek(4 + header_length - 4)
+            flags, = struct.unpack('<I', f.read(4))
+
+        self.compression = flags & 3
+        self.layout = (flags >> 2) & 15
+        if self.layout not in (1, 2):
+            raise ValueError("{}: unsupported BGEN layout {}".format(bgen_path, self.layout))
+        if self.compression == 2:
+            import zstandard
+            self._zstd = zstandard
+
+        self.fd = os.open(bgen_path, os.O_RDONLY)
+
+    def close(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+    def read_block(self, file_start_position, size_in_bytes):
+        return os.pread(self.fd, size_in_bytes, file_start_position)
+
+    def parse_variant(self, block):
+        """
+        Parses the identifying data of a variant block.
+        :return: (rsid, chromosome, position, alleles, offset of the genotype data in the block)
+        """
+        offset = 4 if self.layout == 1 else 0
+
+        def read_string(offset, length_format):
+            length_size = struct.calcsize(length_format)
+            length, = struct.unpack_from(length_format, block, offset)
+            offset += length_size
+            return block[offset:offset + length].decode(), offset + length
+
+        _, offset = read_string(offset, '<H')
+        rsid, offset = read_string(offset, '<H')
+        chromosome, offset = read_string(offset, '<H')
+        position, = struct.unpack_from('<I', block, offset)
+        offset += 4
+
+        if self.layout == 1:
+            n_alleles = 2
+        else:
+            n_alleles, = struct.unpack_from('<H', block, offset)
+            offset += 2
+
+        alleles = []
+        for _ in range(n_alleles):
+            allele, offset = read_string(offset, '<I')
+            alleles.append(allele)
+
+        return rsid, chromosome, position, alleles, offset
+
+    def _decompress(self, data, uncompressed_size=None):
+        if self.compression == 0:
+            return data
+        if self.compression == 1:
+            return zlib.decompress(data)
+        return self._zstd.ZstdDecompressor().decompress(data, max_output_size=uncompressed_size or 0)
+
+    def genotype_data(self, block, offset):
+        """
+        Returns the uncompressed probability data of a variant block, starting at the given offset.
+        """
+        if self.layout == 1:
+            if self.compression == 0:
+                return block[offset:offset + 6 * self.samples_count]
+            compressed_size, = struct.unpack_from('<I', block, offset)
+            return self._decompress(block[offset + 4:offset + 4 + compressed_size])
+
+        total_size, = struct.unpack_from('<I', block, offset)
+        if self.compression == 0:
+            return block[offset + 4:offset + 4 + total_size]
+        uncompressed_size, = struct.unpack_from('<I', block, offset + 4)
+        return self._decompress(block[offset + 8:offset + 4 + total_size], uncompressed_size)
+
+    def decode_dosages(self, data, out, sample_idxs=None):
+        """
+        Writes into out the expected count of the second allele of each sample, that is, the dot product of the
+        genotype probabilities with [0, 1, 2] for diploid samples. If out is a float array, missing samples are NaN;
+        if out is a uint16 array, dosages are written in fixed point (units of 1 / FIXED_POINT_ONE) and missing samples
+        are FIXED_POINT_MISSING (see from_fixed_point).
+        :param sample_idxs: if given, only these samples are decoded into out.
+        """
+        if self.layout == 2:
+            n_samples, n_alleles, min_ploidy, max_ploidy = struct.unpack_from('<IHBB', data, 0)
+            phased, bits = struct.unpack_from('<BB', data, 8 + n_samples)
+            if n_alleles == 2 and min_ploidy == max_ploidy == 2 and not phased and bits in (8, 16):
+                return self._decode_diploid_integers(data, n_samples, bits, out, sample_idxs)
+
+        dosages = self._decode_probabilities(data, np.empty(self.samples_count))
+        if sample_idxs is not None:
+            dosages = dosages[sample_idxs]
+
+        if out.dtype != np.uint16:
+            out[:] = dosages
+            return out
+        return self._to_fixed_point(np.round(dosages * FIXED_POINT_ONE), out)
+
+    def _decode_diploid_integers(self, data, n_samples, bits, out, sample_idxs=None):
+        """
+        Unphased, biallelic, diploid 8/16-bit probabilities (the usual imputed data): the dosage is
+        P(het) + 2 * P(hom second allele) = 2 - 2 * P(hom first allele) - P(het), computed on the stored integers
+        and scaled once, without building the probability tensor.
+        """
+        ploidy = np.frombuffer(data, dtype=np.uint8, count=n_samples, offset=8)
+        probs = np.frombuffer(data, dtype='<u{}'.format(bits // 8), count=2 * n_samples, offset=8 + n_samples + 2)
+        probs = probs.reshape(n_samples, 2)
+        max_value = 2 ** bits - 1
+
+        if sample_idxs is not None:
+            # gather the kept samples before any arithmetic
+            ploidy = ploidy[sample_idxs]
+            probs = probs[sample_idxs]
+
+        # in units of 1 / max_value; at most 2 * max_value, so it fits in 32 bits
+        dosages = np.int32(2 * max_value) - 2 * probs[:, 0].astype(np.int32) - probs[:, 1]
+
+        if out.dtype == np.uint16:
+            fixed_point = (dosages.astype(np.int64) * FIXED_POINT_ONE + max_value // 2) // max_value
+            return self._to_fixed_point(fixed_point, out, missing=(ploidy & 128) > 0)
+
+        np.multiply(dosages, 1.0 / max_value, out=out, casting='unsafe')
+        out[(ploidy & 128) > 0] = np.nan
+        return out
+
+    @staticmethod
+    def _to_fixed_point(fixed_point, out, missing=None):
+        if missing is None:
+            missing = np.isnan(fixed_point)
+        if missing.any():
+            fixed_point[missing] = FIXED_POINT_MISSING
+        out[:] = fixed_point
+        return out
+
+    def _decode_probabilities(self, data, out):
+        if self.layout == 1:
+            probs = np.frombuffer(data, dtype='<u2').reshape(-1, 3)
+            out[:] = np.dot(probs, [0.0, 1.0 / 32768, 2.0 / 32768])
+            out[(probs == 0).all(axis=1)] = np.nan
+            return out
+
+        n_samples, n_alleles, min_ploidy, max_ploidy = struct.unpack_from('<IHBB', data, 0)
+        if n_alleles != 2:
+            raise ValueError("{}: only biallelic variants are supported".format(self.bgen_path))
+        ploidy = np.frombuffer(data, dtype=np.uint8, count=n_samples, offset=8)
+        phased, bits = struct.unpack_from('<BB', data, 8 + n_samples)
+        probs_offset = 8 + n_samples + 2
+
+        # with two alleles, every sample stores as many probabilities as its ploidy, phased or not
+        sample_ploidy = (ploidy & 63).astype(np.int64)
+        n_values = int(sample_ploidy.sum())
+        values = self._unpack(data, probs_offset, n_values, bits)
+
+        if min_ploidy == max_ploidy == 2:
+            values = values.reshape(n_samples, 2)
+            if phased:
+                # probability of each haplotype carrying the first allele
+                out[:] = 2.0 - (values[:, 0] + values[:, 1])
+            else:
+                # P(first allele homozygous), P(heterozygous); P(second allele homozygous) is implied
+                out[:] = 2.0 - (2 * values[:, 0] + values[:, 1])
+        else:
+            starts = np.concatenate(([0], np.cumsum(sample_ploidy)[:-1]))
+            sums = np.add.reduceat(values, starts) if n_values > 0 else np.zeros(n_samples)
+            sums[sample_ploidy == 0] = 0
+            if phased:
+                out[:] = sample_ploidy - sums
+            else:
+                copies = np.arange(n_values) - np.repeat(starts, sample_ploidy)
+                weighted_sums = np.add.reduceat(values * copies, starts) if n_values > 0 else np.zeros(n_samples)
+                weighted_sums[sample_ploidy == 0] = 0
+                out[:] = weighted_sums + sample_ploidy * (1 - sums)
+
+        out[(ploidy & 128) > 0] = np.nan
+        return out
+
+    def genotype_moments(self, data):
+        """
+        Returns the expected count of the second allele (the dosage) and its expected square for each sample, computed
+        from the genotype probabilities (used for the INFO score). Missing samples, and samples that are not diploid,
+        are NaN.
+        """
+        if self.layout == 1:
+            probs = np.frombuffer(data, dtype='<u2').reshape(-1, 3) / 32768.0
+            missing = (probs == 0).all(axis=1)
+            dosages = probs[:, 1] + 2 * probs[:, 2]
+            squares = probs[:, 1] + 4 * probs[:, 2]
+        else:
+            n_samples, n_alleles, min_ploidy, max_ploidy = struct.unpack_from('<IHBB', data, 0)
+            if n_alleles != 2:
+                raise ValueError("{}: only biallelic variants are supported".format(self.bgen_path))
+            ploidy = np.frombuffer(data, dtype=np.uint8, count=n_samples, offset=8)
+            if not min_ploidy == max_ploidy == 2:
+                return np.full(n_samples, np.nan), np.full(n_samples, np.nan)
+            phased, bits = struct.unpack_from('<BB', data, 8 + n_samples)
+            values = self._unpack(data, 8 + n_samples + 2, 2 * n_samples, bits).reshape(n_samples, 2)
+            missing = (ploidy & 128) > 0
+            if phased:
+                # probability of each haplotype carrying the second allele
+                second = 1.0 - values
+                dosages = second.sum(axis=1)
+                squares = dosages ** 2 + (second * (1.0 - second)).sum(axis=1)
+            else:
+                het = values[:, 1]
+                hom_second = 1.0 - values[:, 0] - values[:, 1]
+                dosages = het + 2 * hom_second
+                squares = het + 4 * hom_second
+
+        dosages[missing] = np.nan
+        squares[missing] = np.nan
+        return dosages, squares
+
+    @staticmethod
+    def _unpack(data, offset, n_values, bits):
+        scale = 1.0 / (2 ** bits - 1)
+        if bits in (8, 16, 32):
+            return np.frombuffer(data, dtype='<u{}'.format(bits // 8), count=n_values, offset=offset) * scale
+
+        n_bytes = (n_values * bits + 7) // 8
+        packed = np.frombuffer(data, dtype=np.uint8, count=n_bytes, offset=offset)
+        # values are packed starting from the least significant bit of each byte
+        unpacked = np.unpackbits(packed).reshape(-1, 8)[:, ::-1].ravel()[:n_values * bits].reshape(n_values, bits)
+        return np.dot(unpacked, 2.0 ** np.arange(bits)) * scale
@@ -0,0 +1,92 @@
+import os
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+
+# one record per variant, in the order they are stored in the BGEN file
+SIDECAR_DTYPE = np.dtype([
+    ('position', '<u4'),
+    ('rsid_hash', '<u8'),
+    ('file_start_position', '<u8'),
+    ('size_in_bytes', '<u4'),
+])
+
+
+def rsid_hash(rsid):
+    """
+    Stable 64-bit hash of a variant ID (Python's hash() changes between processes).
+    """
+    return int.from_bytes(hashlib.blake2b(rsid.encode(), digest_size=8).digest(), 'little')
+
+
+def rsid_hashes(rsids):
+    return np.array([rsid_hash(rsid) for rsid in rsids], dtype=np.uint64)
+
+
+class BGISidecar:
+    """
+    Compact copy of the .bgi index of a BGEN file (position, rsid hash, file offset and size of each variant) in a
+    NumPy file next to it, so that opening a BGEN file and selecting variants does not query SQLite. The sidecar is
+    built the first time, and rebuilt whenever the size or modification time of the .bgi file changed.
+    """
+    def __init__(self, bgi_path):
+        self.bgi_path = bgi_path
+        self.path = bgi_path + '.npy'
+        self.metadata_path = bgi_path + '.json'
+
+        bgi_stat = os.stat(bgi_path)
+        self.bgi_stamp = {'bgi_size': bgi_stat.st_size, 'bgi_mtime_ns': bgi_stat.st_mtime_ns}
+
+        self.metadata = self._read_metadata()
+        if self.metadata is None:
+            self.metadata = self._build()
+
+        self.variants = np.load(self.path, mmap_mode='r')
+        self.variants_count = len(self.variants)
+        self.chr_number = self.metadata['chromosome']
+
+    def _read_metadata(self):
+        if not os.path.isfile(self.path) or not os.path.isfile(self.metadata_path):
+            return None
+        with open(self.metadata_path, 'r') as f:
+            metadata = json.load(f)
+        if any(metadata.get(key) != value for key, value in self.bgi_stamp.items()):
+            return None
+        return metadata
+
+    def _build(self):
+        with sqlite3.connect(self.bgi_path) as conn:
+            rows = conn.execute('select position, rsid, file_start_position, size_in_bytes from Variant order by file_start_position asc').fetchall()
+            # FIXME: only one chromosome per BGEN file is supported
+            chromosome = conn.execute('select distinct chromosome from Variant').fetchone()
+
+        variants = np.empty(len(rows), dtype=SIDECAR_DTYPE)
+        if rows:
+            positions, rsids, file_start_positions, sizes_in_bytes = zip(*rows)
+            variants['position'] = positions
+            variants['rsid_hash'] = rsid_hashes(rsids)
+            variants['file_start_position'] = file_start_positions
+            variants['size_in_bytes'] = sizes_in_bytes
+
+        metadata = dict(self.bgi_stamp, chromosome=chromosome[0] if chromosome else None)
+
+        # written to temporary files first, so that concurrent jobs never read a partial sidecar
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(self.path + tmp_suffix, 'wb') as f:
+            np.save(f, variants)
+        with open(self.metadata_path + tmp_suffix, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(self.path + tmp_suffix, self.path)
+        os.replace(self.metadata_path + tmp_suffix, self.metadata_path)
+
+        return metadata
+
+    def select(self, include_rsid=None):
+        """
+        Returns the records of the variants with rsids in include_rsid (all variants if None), in file order.
+        """
+        if include_rsid is None:
+            return self.variants
+        return self.variants[np.isin(self.variants['rsid_hash'], rsid_hashes(include_rsid))]
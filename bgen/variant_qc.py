@@ -0,0 +1,120 @@
+import os
+import json
+import sqlite3
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bgen.bgen_reader import BGENReader
+from bgen.bgi_sidecar import rsid_hashes
+
+# one record per variant, in the order they are stored in the BGEN file
+QC_DTYPE = np.dtype([
+    ('rsid_hash', '<u8'),
+    ('allele_frequency', '<f4'),
+    ('maf', '<f4'),
+    ('info', '<f4'),
+    ('missing_rate', '<f4'),
+])
+
+
+def variant_qc(dosages, squares):
+    """
+    Quality metrics of a variant from the expected dosage (count of the second allele) and expected squared dosage of
+    each sample (NaN if missing): frequency of the second allele, minor allele frequency, IMPUTE INFO score and rate
+    of missing samples.
+    """
+    observed = ~np.isnan(dosages)
+    n_observed = int(observed.sum())
+    missing_rate = 1.0 - n_observed / float(len(dosages)) if len(dosages) else 1.0
+    if n_observed == 0:
+        return np.nan, np.nan, np.nan, missing_rate
+
+    dosages = dosages[observed]
+    allele_frequency = dosages.mean() / 2
+    if 0 < allele_frequency < 1:
+        info = 1.0 - (squares[observed] - dosages ** 2).sum() / (2 * n_observed * allele_frequency * (1 - allele_frequency))
+    else:
+        # IMPUTE convention for monomorphic variants
+        info = 1.0
+    return allele_frequency, min(allele_frequency, 1 - allele_frequency), info, missing_rate
+
+
+class VariantQC:
+    """
+    Per-variant quality metrics (allele frequency, MAF, INFO score and missingness, see variant_qc) of a BGEN file,
+    stored in a NumPy file next to its .bgi index. They are computed from all the samples of the file in one pass
+    over the genotypes (with n_threads threads) the first time, and again whenever the BGEN or .bgi file changed.
+    """
+    def __init__(self, bgen_path, bgi_path, n_threads=1):
+        self.bgen_path = bgen_path
+        self.bgi_path = bgi_path
+        self.path = bgi_path + '.qc.npy'
+        self.metadata_path = bgi_path + '.qc.json'
+        self.n_threads = n_threads
+
+        bgen_stat, bgi_stat = os.stat(bgen_path), os.stat(bgi_path)
+        self.stamp = {'bgen_size': bgen_stat.st_size, 'bgen_mtime_ns': bgen_stat.st_mtime_ns,
+                      'bgi_size': bgi_stat.st_size, 'bgi_mtime_ns': bgi_stat.st_mtime_ns}
+
+        if not self._is_current():
+            self._build()
+        self.variants = np.load(self.path, mmap_mode='r')
+
+    def _is_current(self):
+        if not os.path.isfile(self.path) or not os.path.isfile(self.metadata_path):
+            return False
+        with open(self.metadata_path, 'r') as f:
+            metadata = json.load(f)
+        return all(metadata.get(key) == value for key, value in self.stamp.items())
+
+    def _build(self):
+        print("{} Computing variant QC of {}".format(datetime.datetime.now(), self.bgen_path))
+        with sqlite3.connect(self.bgi_path) as conn:
+            rows = conn.execute('select rsid, file_start_position, size_in_bytes from Variant order by file_start_position asc').fetchall()
+
+        reader = BGENReader(self.bgen_path)
+
+        def compute(block_location):
+            block = reader.read_block(*block_location)
+            offset = reader.parse_variant(block)[-1]
+            return variant_qc(*reader.genotype_moments(reader.genotype_data(block, offset)))
+
+        locations = [row[1:] for row in rows]
+        if self.n_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                metrics = list(pool.map(compute, locations))
+        else:
+            metrics = [compute(location) for location in locations]
+        reader.close()
+
+        variants = np.empty(len(rows), dtype=QC_DTYPE)
+        if rows:
+            variants['rsid_hash'] = rsid_hashes([row[0] for row in rows])
+            for column_idx, name in enumerate(QC_DTYPE.names[1:]):
+                variants[name] = [x[column_idx] for x in metrics]
+
+        # written to temporary files first, so that concurrent jobs never read a partial file
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(self.path + tmp_suffix, 'wb') as f:
+            np.save(f, variants)
+        with open(self.metadata_path + tmp_suffix, 'w') as f:
+            json.dump(self.stamp, f)
+        os.replace(self.path + tmp_suffix, self.path)
+        os.replace(self.metadata_path + tmp_suffix, self.metadata_path)
+
+    def excluded(self, rsids, min_info=None, min_maf=None):
+        """
+        Returns the rsids (among the given ones) of the variants of this file with an INFO score below min_info or a
+        minor allele frequency below min_maf. Variants with undefined metrics (all samples missing) are excluded. An
+        rsid stored several times is only excluded if all its variants are.
+        """
+        passed = np.ones(len(self.variants), dtype=bool)
+        if min_info is not None:
+            passed &= self.variants['info'] >= min_info
+        if min_maf is not None:
+            passed &= self.variants['maf'] >= min_maf
+        stored_hashes = set(self.variants['rsid_hash'].tolist())
+        passed_hashes = set(self.variants['rsid_hash'][passed].tolist())
+        return [rsid for rsid, h in zip(rsids, rsid_hashes(rsids).tolist()) if h in stored_hashes and h not in passed_hashes]
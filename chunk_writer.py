@@ -0,0 +1,66 @@
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def compress_chunk(chunk, chunk_shape, dtype, level, decimals=None):
+    """
+    Applies to a chunk the filters of a dataset created with shuffle=True and compression='gzip', as libhdf5 would
+    when writing it: the chunk is converted to the dtype of the dataset and padded to the full chunk shape (edge chunks
+    are stored whole), then its bytes are shuffled (all first bytes of the values, then all second bytes, ...) and
+    deflated into a zlib stream.
+    :param decimals: round the values to this number of decimals first.
+    """
+    if decimals is not None:
+        chunk = np.round(chunk.astype(np.float64), decimals)
+    data = np.zeros(chunk_shape, dtype=dtype)
+    data[:chunk.shape[0], :chunk.shape[1]] = chunk
+    shuffled = data.view(np.uint8).reshape(-1, data.itemsize).T.tobytes()
+    return zlib.compress(shuffled, level)
+
+
+class ChunkWriter:
+    """
+    Writes a 2D chunked dataset one block of gene chunks at a time: its chunks are compressed in a thread pool (zlib
+    releases the GIL) and written with the HDF5 direct chunk write (H5Dwrite_chunk), bypassing the single-threaded
+    filter pipeline of libhdf5. The file stays readable by any HDF5 reader.
+    """
+    def __init__(self, dataset, n_threads, decimals=None):
+        """
+        :param dataset: dataset created with chunks, shuffle=True and compression='gzip' as its only filters.
+        :param decimals: round the values to this number of decimals before they are converted to the dtype of the
+        dataset.
+        """
+        if dataset.chunks is None or not dataset.shuffle or dataset.compression != 'gzip' or dataset.scaleoffset is not None or dataset.fletcher32:
+            raise ValueError("direct chunk writes need a chunked dataset with only the shuffle and gzip filters")
+        self.dataset = dataset
+        self.decimals = decimals
+        self.level = dataset.compression_opts
+        self.pool = ThreadPoolExecutor(max(1, n_threads))
+        # chunks are written in submission order; at most max_pending compressed chunks wait to be written
+        self.pending = deque()
+        self.max_pending = 2 * max(1, n_threads)
+
+    def write_block(self, start, block):
+        """
+        Writes rows start to start + len(block) of the dataset. start must be the first row of a gene chunk, and the
+        block must end on a chunk boundary or at the last row. The block must not be modified afterwards.
+        """
+        n_genes_chunk, n_samples_chunk = self.dataset.chunks
+        for gene_start in range(0, block.shape[0], n_genes_chunk):
+            for sample_start in range(0, block.shape[1], n_samples_chunk):
+                chunk = block[gene_start:gene_start + n_genes_chunk, sample_start:sample_start + n_samples_chunk]
+                future = self.pool.submit(compress_chunk, chunk, self.dataset.chunks, self.dataset.dtype, self.level, self.decimals)
+                self.pending.append(((start + gene_start, sample_start), future))
+                self._write_pending()
+
+    def _write_pending(self, wait=False):
+        while self.pending and (wait or self.pending[0][1].done() or len(self.pending) > self.max_pending):
+            offset, future = self.pending.popleft()
+            self.dataset.id.write_direct_chunk(offset, future.result())
+
+    def close(self):
+        self._write_pending(wait=True)
+        self.pool.shutdown()
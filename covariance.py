@@ -0,0 +1,124 @@
+import gzip
+import datetime
+from collections import defaultdict
+
+import numpy as np
+
+COMPLEMENTS = {"A": "T", "C": "G", "G": "C", "T": "A"}
+
+
+class GeneCovariance:
+    """
+    Accumulates the covariance of each gene's model SNPs from the dosage rows streamed during prediction, so that
+    S-PrediXcan/MultiXcan covariances do not need a separate pass over the genotypes. Rows are kept only while a gene
+    that uses them is pending; a gene is written out as soon as all its model SNPs were seen (and the stream moved to
+    another variant ID), or when the stream moves to another chromosome.
+    """
+    def __init__(self, get_applications_of, output_file, desired_gene_list=None, sample_block_size=10000, model_rsids=None):
+        """
+        :param model_rsids: dict of genotype variant ID -> model rsid (variants matched by position), written to the
+        output instead of the IDs of the genotype variants.
+        """
+        self.get_applications_of = get_applications_of
+        self.output_file = output_file
+        self.sample_block_size = sample_block_size
+        self.desired_genes = set(desired_gene_list) if desired_gene_list is not None else None
+        self.model_rsids = model_rsids if model_rsids is not None else {}
+
+        self.n_snps = defaultdict(int)
+        for rsid, applications in get_applications_of.tuples.items():
+            for gene, _, _ in applications:
+                if self.desired_genes is None or gene in self.desired_genes:
+                    self.n_snps[gene] += 1
+
+        self.chromosome = None
+        self.last_rsid = None
+        # rsid -> list of (allele, dosage row) of each of its variants
+        self.rows = {}
+        self.rows_refs = defaultdict(int)
+        self.gene_snps = defaultdict(list)
+        self.completed = []
+
+        self.out = gzip.open(self.output_file, 'wt')
+        self.out.write('GENE RSID1 RSID2 VALUE\n')
+
+    def update(self, chromosome, rsid, allele, dosage_row):
+        if chromosome != self.chromosome:
+            self.finalize_pending()
+            self.chromosome = chromosome
+        elif rsid != self.last_rsid:
+            # the variants of a repeated rsid (e.g. multiallelic sites split in several variants) are adjacent
+            self.finalize_completed()
+        self.last_rsid = rsid
+
+        if rsid in self.rows:
+            # repeated rsid: TranscriptionMatrix applies the weight to each of its variants, so their dosages add up
+            self.rows[rsid].append((allele, np.asarray(dosage_row, dtype=np.float32)))
+            return
+
+        for gene, weight, ref_allele in self.get_applications_of(rsid):
+            if gene not in self.n_snps:
+                continue
+            self.gene_snps[gene].append((rsid, ref_allele))
+            self.rows_refs[rsid] += 1
+            if len(self.gene_snps[gene]) == self.n_snps[gene]:
+                self.completed.append(gene)
+
+        if self.rows_refs[rsid] > 0:
+            self.rows[rsid] = [(allele, np.asarray(dosage_row, dtype=np.float32))]
+        else:
+            del self.rows_refs[rsid]
+
+    def _snp_block(self, rsid, ref_allele, start):
+        """
+        Dosages of samples start to start + sample_block_size of a model SNP, summed over the variants of its rsid.
+        Same strand resolution as TranscriptionMatrix.update: flipped variants count as -dosage (their 2 - dosage
+        differs by a constant, which does not change covariances).
+        """
+        signs = [1.0 if (ref_allele == allele or COMPLEMENTS.get(ref_allele) == allele) else -1.0 for allele, _ in self.rows[rsid]]
+        return sum(sign * row[start:start + self.sample_block_size].astype(np.float64) for sign, (_, row) in zip(signs, self.rows[rsid]))
+
+    def finalize(self, gene):
+        snps = self.gene_snps.pop(gene)
+        rsids = [x[0] for x in snps]
+        n_samples = len(self.rows[rsids[0]][0][1])
+
+        # streaming sums over sample blocks, so that only a (n_snps x block) slice is ever materialized in float64
+        sums = np.zeros(len(rsids))
+        cross_products = np.zeros((len(rsids), len(rsids)))
+        for start in range(0, n_samples, self.sample_block_size):
+            block = np.vstack([self._snp_block(rsid, ref_allele, start) for rsid, ref_allele in snps])
+            sums += block.sum(axis=1)
+            cross_products += np.dot(block, block.T)
+
+        if n_samples > 1:
+            cov = (cross_products - np.outer(sums, sums) / n_samples) / (n_samples - 1)
+        else:
+            # the sample covariance is undefined
+            cov = np.full((len(rsids), len(rsids)), np.nan)
+
+        names = [self.model_rsids.get(rsid, rsid) for rsid in rsids]
+        for i in range(len(rsids)):
+            for j in range(i, len(rsids)):
+                self.out.write('{} {} {} {}\n'.format(gene, names[i], names[j], repr(float(cov[i, j]))))
+
+        for rsid in rsids:
+            self.rows_refs[rsid] -= 1
+            if self.rows_refs[rsid] == 0:
+                del self.rows_refs[rsid]
+                del self.rows[rsid]
+
+    def finalize_completed(self):
+        for gene in self.completed:
+            self.finalize(gene)
+        self.completed = []
+
+    def finalize_pending(self):
+        self.finalize_completed()
+        for gene in sorted(self.gene_snps.keys()):
+            self.finalize(gene)
+
+    def save(self):
+        self.finalize_pending()
+        self.out.close()
+        print("{} Covariance file complete!".format(datetime.datetime.now()))
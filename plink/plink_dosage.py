@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+
+from backends import VariantTableDosage, chromosome_number
+
+
+def _bed_lookup_table():
+    """
+    Maps each .bed byte (four 2-bit genotypes, first sample in the lowest bits) to the dosages of the four samples,
+    counting the A1 allele (fifth .bim column): 00 is homozygous A1, 10 heterozygous, 11 homozygous A2, 01 missing.
+    """
+    codes = np.array([2.0, np.nan, 1.0, 0.0])
+    packed = np.arange(256)
+    return codes[np.stack([(packed >> shift) & 3 for shift in (0, 2, 4, 6)], axis=1)]
+
+
+class BEDDosage(VariantTableDosage):
+    """
+    Hard-called genotypes from a PLINK 1 fileset (.bed/.bim/.fam). Variants are decoded with a 256-entry lookup table
+    straight from the memory-mapped, bit-packed .bed file.
+    """
+    def __init__(self, bed_path, sample_path=None, prefetch_depth=0, prefetch_max_bytes=256 * 1024 ** 2):
+        """
+        :param prefetch_depth: number of batches read ahead by the kernel (posix_fadvise) while the current one is
+        decoded, up to prefetch_max_bytes. 0 disables read-ahead.
+        """
+        self.bed_path = bed_path
+        prefix = os.path.splitext(bed_path)[0]
+        self.sample_path = sample_path if sample_path is not None else prefix + '.fam'
+
+        with open(prefix + '.fam', 'r') as f:
+            self.samples_count = sum(1 for line in f if line.strip())
+        self._read_variants(prefix + '.bim')
+
+        with open(bed_path, 'rb') as f:
+            magic = f.read(3)
+        if magic != b'\x6c\x1b\x01':
+            raise ValueError("{} is not a SNP-major PLINK .bed file".format(bed_path))
+
+        self.bytes_per_variant = (self.samples_count + 3) // 4
+        self.bed = np.memmap(bed_path, mode='r', dtype=np.uint8, offset=3,
+                             shape=(self.variants_count, self.bytes_per_variant))
+        self.lookup_table = _bed_lookup_table()
+
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_bytes = prefetch_max_bytes
+        if prefetch_depth > 0:
+            self.prefetch_fd = os.open(bed_path, os.O_RDONLY)
+
+    def close(self):
+        """
+        Closes the .bed file. Variants cannot be read afterwards.
+        """
+        if self.prefetch_fd is not None:
+            os.close(self.prefetch_fd)
+            self.prefetch_fd = None
+        self.bed = None
+
+    def __del__(self):
+        self.close()
+
+    def _batch_ranges(self, variant_idxs):
+        return [(3 + int(idx) * self.bytes_per_variant, self.bytes_per_variant) for idx in variant_idxs]
+
+    def _read_variants(self, variants_path):
+        self.chromosomes, self.positions, self.rsids, self.alleles0, self.alleles1 = [], [], [], [], []
+        with open(variants_path, 'r') as f:
+            for line in f:
+                chromosome, rsid, _, position, allele1, allele0 = line.split()[:6]
+                self.chromosomes.append(chromosome_number(chromosome))
+                self.positions.append(int(position))
+                self.rsids.append(rsid)
+                self.alleles0.append(allele0)
+                self.alleles1.append(allele1)
+        self.variants_count = len(self.rsids)
+
+    def _decode(self, variant_idxs):
+        packed = self.bed[variant_idxs]
+        dosages = self.lookup_table[packed].reshape(len(variant_idxs), -1)
+        return dosages[:, :self.samples_count]
+
+
+class PGENDosage(VariantTableDosage):
+    """
+    Dosages from a PLINK 2 fileset (.pgen/.pvar/.psam), read with pgenlib (PLINK 2 Python bindings). Dosages count the
+    ALT allele, and fall back to hard calls for variants without dosage information.
+    """
+    def __init__(self, pgen_path, sample_path=None, prefetch_depth=0, prefetch_max_bytes=256 * 1024 ** 2):
+        # pgenlib reads the .pgen file itself, so batches are not read ahead (the next file is still opened ahead)
+        try:
+            import pgenlib
+        except ImportError:
+            raise ImportError("Reading .pgen files needs pgenlib (pip install Pgenlib)")
+
+        self.pgen_path = pgen_path
+        prefix = os.path.splitext(pgen_path)[0]
+        self.sample_path = sample_path if sample_path is not None else prefix + '.psam'
+
+        with open(prefix + '.psam', 'r') as f:
+            self.samples_count = sum(1 for line in f if line.strip() and not line.startswith('#'))
+        self._read_variants(prefix + '.pvar')
+
+        self.reader = pgenlib.PgenReader(pgen_path.encode(), raw_sample_ct=self.samples_count)
+
+    def close(self):
+        """
+        Closes the .pgen file. Variants cannot be read afterwards.
+        """
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def _read_variants(self, variants_path):
+        self.chromosomes, self.positions, self.rsids, self.alleles0, self.alleles1 = [], [], [], [], []
+        columns = None
+        with open(variants_path, 'r') as f:
+            for line in f:
+                if line.startswith('##'):
+                    continue
+                if line.startswith('#'):
+                    columns = {name: idx for idx, name in enumerate(line[1:].split())}
+                    continue
+                fields = line.split()
+                if columns is None:
+                    # header-less .pvar files have the .bim column order
+                    columns = {'CHROM': 0, 'ID': 1, 'POS': 3, 'ALT': 4, 'REF': 5}
+                self.chromosomes.append(chromosome_number(fields[columns['CHROM']]))
+                self.positions.append(int(fields[columns['POS']]))
+                self.rsids.append(fields[columns['ID']])
+                self.alleles0.append(fields[columns['REF']])
+                self.alleles1.append(fields[columns['ALT']])
+        self.variants_count = len(self.rsids)
+
+    def _decode(self, variant_idxs):
+        dosages = np.empty((len(variant_idxs), self.samples_count), dtype=np.float64)
+        for row_idx, variant_idx in enumerate(variant_idxs):
+            self.reader.read_dosages(int(variant_idx), dosages[row_idx])
+        # pgenlib flags missing dosages with -9
+        dosages[dosages == -9] = np.nan
+        return dosages
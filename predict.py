@@ -3,14 +3,22 @@ import sys
 import gc
 import argparse
 import sqlite3
+import mmap
+import tempfile
 import datetime
-from collections import defaultdict
+import hashlib
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import h5py_cache
-from tqdm import tqdm
 
-from bgen.bgen_dosage import BGENDosage
+import backends
+
+
+def check_in_file(in_file):
+    if not os.path.exists(in_file):
+        print("ERROR: {} does not exist.".format(in_file))
+        sys.exit(1)
 
 
 def check_out_file(out_file):
@@ -73,11 +81,109 @@ class GetApplicationsOf:
                 yield tup
 
 
+class MatchedApplicationsOf:
+    """
+    Applications of the model SNPs matched to genotype variants by position (see match_variants_by_position), looked
+    up by the IDs of the genotype variants.
+    """
+    def __init__(self, get_applications_of, model_rsids):
+        """
+        :param model_rsids: dict of genotype variant ID -> model rsid.
+        """
+        self.tuples = {rsid: list(get_applications_of(model_rsid)) for rsid, model_rsid in model_rsids.items()}
+
+    def __call__(self, rsid):
+        for tup in self.tuples.get(rsid, []):
+            yield tup
+
+
+class ApplicationsExcept:
+    """
+    Applications of the model SNPs to all genes but the given ones, such as genes served by the result cache.
+    """
+    def __init__(self, get_applications_of, genes):
+        self.get_applications_of = get_applications_of
+        self.genes = set(genes)
+
+    def __call__(self, rsid):
+        for tup in self.get_applications_of(rsid):
+            if tup[0] not in self.genes:
+                yield tup
+
+
+def _kahan_add(total, compensation, value):
+    """
+    Adds value to total in place with Kahan compensated summation, compensation holding the low-order bits lost by
+    the previous additions.
+    """
+    corrected = np.subtract(value, compensation, dtype=total.dtype)
+    new_total = total + corrected
+    compensation[:] = (new_total - total) - corrected
+    total[:] = new_total
+
+
 class TranscriptionMatrix:
-    def __init__(self, beta_file, bgen_sample_file, output_binary_file, cache_size=int(50 * (1024 ** 2))):
+    def __init__(self, beta_file, bgen_sample_file, output_binary_file, cache_size=int(50 * (1024 ** 2)), keep_samples=None, swmr=False, gene_stats=False,
+                 scratch_dir=None, n_threads=1, partial=False, precision='float64', n_verify_genes=0, verify_seed=0, n_compression_threads=0,
+                 append=False, max_pending_size=int(1024 * (1024 ** 2))):
+        """
+        Gene rows are accumulated in memory and written to the output by finish_genes, once no more SNPs can
+        contribute to them (see GeneWindow), so only the rows of the genes around the current variant are kept.
+        :param swmr: write the output in HDF5 single-writer/multiple-reader mode: genes and samples are written when
+        the file is created, and finished genes are flagged in the 'complete' dataset and flushed, so that readers can
+        use them while the prediction is still running.
+        :param gene_stats: also write, in the 'gene_stats' group, the mean and variance of each gene's predicted
+        expression (computed from the finished row), and the number of model SNPs, of SNPs used and the sum of the
+        weights used.
+        :param scratch_dir: accumulate gene rows (float32) in a memory-mapped scratch file created in this directory
+        instead of in memory, and write pred_expr from it in one sequential sweep at the end, so the number of samples
+        is limited by disk instead of RAM.
+        :param n_threads: number of threads accumulating each batch of variants (see update_batch).
+        :param partial: write pred_expr as float64, without the scale-offset filter, so that outputs computed from
+        different genotype files can be summed exactly (see work_queue.py).
+        :param precision: precision of the gene rows and of the products of each batch of variants: 'float64',
+        'float32' (each batch is summed by the matrix product before being added to the rows, so rounding errors grow
+        with the number of batches, not of SNPs) or 'float32-kahan' (float32 with Kahan compensated summation across
+        batches, which keeps a float32 compensation row per gene).
+        :param n_verify_genes: number of randomly chosen genes (with verify_seed) also accumulated in float64; the
+        maximum absolute and relative errors of their finished rows are reported by save.
+        :param n_compression_threads: if greater than 0 (and not in SWMR mode), compress the chunks of pred_expr in this
+        number of threads and write them directly (see chunk_writer.py), instead of through the filters of libhdf5.
+        pred_expr then uses the shuffle and gzip filters, with values rounded to 4 decimals instead of the scale-offset
+        filter. Finished rows are kept (in the dtype of pred_expr) until all the genes of their gene chunk are finished.
+        :param max_pending_size: maximum size in bytes of the finished rows kept for direct chunk writes: above it, the
+        rows of the blocks of gene chunks holding the most are written through libhdf5 instead (as without
+        n_compression_threads), and so are the later rows of these blocks.
+        :param append: add the samples to an existing output of the same model (see create_output): pred_expr is
+        extended along its sample axis and only the new columns are written.
+        """
         self.D = None
+        self.swmr = swmr
+        self.gene_stats = gene_stats
+        self.scratch_dir = scratch_dir
+        self.scratch = None
+        self.rows = {}
+        self.n_threads = max(1, n_threads)
+        self.partial = partial
+        self.dtype = np.float64 if precision == 'float64' else np.float32
+        self.kahan = precision == 'float32-kahan'
+        self.compensations = {}
+        self.n_verify_genes = n_verify_genes
+        self.verify_seed = verify_seed
+        self.reference_rows = {}
+        self.max_abs_error = 0.0
+        self.max_rel_error = 0.0
+        self.n_verified_genes = 0
+        self.pool = None
+        # direct chunk writes need whole chunks, which appended columns do not start on
+        self.n_compression_threads = n_compression_threads if not swmr and not append else 0
+        self.append = append
+        self.first_sample = 0
+        self.chunk_writer = None
+        self.max_pending_size = max_pending_size
         self.beta_file = beta_file
         self.bgen_sample_file = bgen_sample_file
+        self.keep_samples = set(keep_samples) if keep_samples is not None else None
         self.cache_size = int(cache_size)
 
         if not any(output_binary_file.lower().endswith(hdf5_suffix) for hdf5_suffix in ('.h5', '.hdf5')):
@@ -99,44 +205,550 @@ class TranscriptionMatrix:
                     new_list.append(i)
             return new_list
 
-    def update(self, gene, weight, ref_allele, allele, dosage_row, max_gene_chunk_size, max_sample_chunk_size, desired_gene_list=None):
-        if self.D is None:
-            self.gene_list = self.get_gene_list(desired_gene_list)
-            self.gene_index = {gene: k for (k, gene) in enumerate(self.gene_list)}
+    def create_output(self, n_samples, max_gene_chunk_size, max_sample_chunk_size, desired_gene_list=None):
+        self.gene_list = self.get_gene_list(desired_gene_list)
+        self.gene_index = {gene: k for (k, gene) in enumerate(self.gene_list)}
+
+        self.n_genes = len(self.gene_list)
+        self.n_samples = n_samples
 
-            self.n_genes = len(self.gene_list)
-            self.n_samples = len(dosage_row)
+        if self.append:
+            self._open_appended_output()
+            return
 
+        if self.swmr:
+            import h5py
+            self.D_file = h5py.File(self.output_binary_file, 'w', libver='latest', rdcc_nbytes=self.cache_size)
+        else:
+            import h5py_cache
             self.D_file = h5py_cache.File(self.output_binary_file, 'w', chunk_cache_mem_size=self.cache_size)
-            n_genes_chunk = self.n_genes
-            n_samples_chunk = self.n_samples
-            if max_gene_chunk_size > 0:
-                n_genes_chunk = np.min((self.n_genes, max_gene_chunk_size))
-            if max_sample_chunk_size > 0:
-                n_samples_chunk = np.min((self.n_samples, max_sample_chunk_size))
+
+        n_genes_chunk = self.n_genes
+        n_samples_chunk = self.n_samples
+        if max_gene_chunk_size > 0:
+            n_genes_chunk = np.min((self.n_genes, max_gene_chunk_size))
+        if max_sample_chunk_size > 0:
+            n_samples_chunk = np.min((self.n_samples, max_sample_chunk_size))
+        if self.n_compression_threads > 0 and self.n_genes > 0 and self.n_samples > 0:
+            from chunk_writer import ChunkWriter
+            self.D = self.D_file.create_dataset("pred_expr", shape=(self.n_genes, self.n_samples),
+                                                chunks=(n_genes_chunk, n_samples_chunk), maxshape=(self.n_genes, None),
+                                                dtype=np.dtype('float64' if self.partial else 'float32'), shuffle=True, compression='gzip')
+            self.chunk_writer = ChunkWriter(self.D, self.n_compression_threads, decimals=None if self.partial else 4)
+            # finished rows of each block of gene chunks, written once all its genes are finished
+            self.pending_blocks = {}
+            self.pending_size = 0
+            self.written_blocks = set()
+            # blocks whose rows are written through libhdf5, once the pending rows took too much memory
+            self.filtered_blocks = set()
+        elif self.partial:
             self.D = self.D_file.create_dataset("pred_expr", shape=(self.n_genes, self.n_samples),
-                                                chunks=(n_genes_chunk, n_samples_chunk),
+                                                chunks=(n_genes_chunk, n_samples_chunk), maxshape=(self.n_genes, None),
+                                                dtype=np.dtype('float64'), compression='gzip')
+        else:
+            self.D = self.D_file.create_dataset("pred_expr", shape=(self.n_genes, self.n_samples),
+                                                chunks=(n_genes_chunk, n_samples_chunk), maxshape=(self.n_genes, None),
                                                 dtype=np.dtype('float32'), scaleoffset=4, compression='gzip')
+        # checked when samples are appended to the output (see _open_appended_output)
+        self.D.attrs['weights_fingerprint'] = self.get_weights_fingerprint()
+
+        if self.scratch_dir is not None:
+            self._create_scratch()
+
+        if self.n_verify_genes > 0 and self.n_genes > 0:
+            verify_idxs = np.random.RandomState(self.verify_seed).choice(self.n_genes, min(self.n_verify_genes, self.n_genes), replace=False)
+            self.verify_genes = set(verify_idxs.tolist())
+        else:
+            self.verify_genes = set()
+
+        if self.gene_stats:
+            self._init_stats()
+
+        if self.swmr:
+            # all datasets must exist before SWMR mode is switched on
+            samples = [np.string_(sample[0]) for sample in self.get_samples()]
+            self.D_file.create_dataset("samples", data=np.array(samples, dtype='S25'), maxshape=(None,))
+            self.D_file.create_dataset("genes", data=np.array([np.string_(str(gene)) for gene in self.gene_list], dtype='S30'))
+            self.complete = self.D_file.create_dataset("complete", shape=(self.n_genes,), dtype=np.uint8)
+            if self.gene_stats:
+                self._create_stats_datasets()
+            self.D_file.swmr_mode = True
+
+    def get_weights_fingerprint(self):
+        """
+        Hash of the weights of the genes of the output (see result_cache.weight_fingerprints), in their order.
+        """
+        from result_cache import weight_fingerprints
+        fingerprints = weight_fingerprints(self.beta_file, self.gene_list)
+        return hashlib.sha1('\n'.join('{} {}'.format(gene, fingerprints[gene]) for gene in self.gene_list).encode()).hexdigest()
+
+    def _open_appended_output(self):
+        """
+        Opens the existing output for appending samples. It must have the same genes and a resizable sample axis, have
+        been predicted with the same weights (checked by fingerprint), have none of the new samples, and have gene
+        statistics if they are requested. pred_expr is then extended by n_samples columns, where the new rows are
+        written.
+        """
+        import h5py_cache
+        self.D_file = h5py_cache.File(self.output_binary_file, 'a', chunk_cache_mem_size=self.cache_size)
+        self.D = self.D_file['pred_expr']
+        self.verify_genes = set()
+
+        problem = None
+        new_samples = [sample[0] for sample in self.get_samples()]
+        existing_samples = set(sample.decode() for sample in self.D_file['samples'][:])
+        if [gene.decode() for gene in self.D_file['genes'][:]] != [str(gene) for gene in self.gene_list]:
+            problem = "The genes of {} do not match the model (or the gene list).".format(self.output_binary_file)
+        elif self.D.maxshape[1] is not None or self.D_file['samples'].maxshape[0] is not None:
+            problem = "{} does not have a resizable sample axis (it was written by an earlier version).".format(self.output_binary_file)
+        elif self.D.attrs.get('weights_fingerprint') != self.get_weights_fingerprint():
+            problem = "{} was not predicted with the weights of {}.".format(self.output_binary_file, self.beta_file)
+        elif len(new_samples) != self.n_samples:
+            problem = "The number of rows in your sample file does not match the dosage files!"
+        elif existing_samples.intersection(new_samples):
+            problem = "{} samples are already in {}.".format(len(existing_samples.intersection(new_samples)), self.output_binary_file)
+        elif self.gene_stats and 'gene_stats' not in self.D_file:
+            problem = "{} has no gene statistics to update.".format(self.output_binary_file)
+        if problem is not None:
+            print("ERROR: {}".format(problem))
+            self.D_file.close()
+            sys.exit(1)
+
+        self.first_sample = self.D.shape[1]
+        self.D.resize(self.first_sample + self.n_samples, axis=1)
+
+        if self.scratch_dir is not None:
+            self._create_scratch()
+
+        if self.gene_stats:
+            self._init_stats()
+
+    def _init_stats(self):
+        n_snps_in_model = dict(WeightsDB(self.beta_file).query("SELECT gene, COUNT(*) FROM weights GROUP BY gene"))
+        self.stats = OrderedDict([
+            ('mean', np.zeros(self.n_genes)),
+            ('variance', np.zeros(self.n_genes)),
+            ('n_snps_in_model', np.array([n_snps_in_model.get(gene, 0) for gene in self.gene_list], dtype=np.int32)),
+            ('n_snps_used', np.zeros(self.n_genes, dtype=np.int32)),
+            ('sum_weights_used', np.zeros(self.n_genes)),
+        ])
+
+    def _create_scratch(self):
+        fd, self.scratch_file = tempfile.mkstemp(suffix='.scratch', dir=self.scratch_dir)
+        os.close(fd)
+        # sparse file: only the rows of the genes that get SNPs take disk space
+        self.scratch = np.memmap(self.scratch_file, mode='w+', dtype=np.float32, shape=(max(self.n_genes, 1), self.n_samples))
+        if self.kahan:
+            fd, self.scratch_compensation_file = tempfile.mkstemp(suffix='.scratch', dir=self.scratch_dir)
+            os.close(fd)
+            self.scratch_compensation = np.memmap(self.scratch_compensation_file, mode='w+', dtype=np.float32, shape=self.scratch.shape)
+        # rows are assigned in the order genes are reached by the genotype stream, so that the genes being
+        # accumulated at any time are contiguous in the file
+        self.scratch_rows = {}
+        self.finished_scratch_rows = set()
+        self.first_active_scratch_row = 0
+
+    def _release_scratch_rows(self, first_row, last_row):
+        """
+        Drops from memory the pages of scratch rows that are finished (their data stays in the file).
+        """
+        if not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        row_bytes = self.n_samples * self.scratch.itemsize
+        # whole pages only: the pages around them may hold rows still being accumulated
+        start = -(-first_row * row_bytes // mmap.PAGESIZE) * mmap.PAGESIZE
+        end = (last_row + 1) * row_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+        if end > start:
+            for scratch in (self.scratch, self.scratch_compensation) if self.kahan else (self.scratch,):
+                scratch.flush()
+                scratch._mmap.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def _create_stats_datasets(self):
+        stats_group = self.D_file.create_group("gene_stats")
+        self.stats_datasets = [stats_group.create_dataset(name, data=values) for name, values in self.stats.items()]
+
+    def update(self, gene, weight, ref_allele, allele, dosage_row, max_gene_chunk_size, max_sample_chunk_size, desired_gene_list=None):
+        if self.D is None:
+            self.create_output(len(dosage_row), max_gene_chunk_size, max_sample_chunk_size, desired_gene_list)
 
         if gene in self.gene_index:  # assumes dosage coding 0 to 2
             # assumes non-ambiguous SNPs to resolve strand issues:
             if ref_allele == allele or self.complements[ref_allele] == allele:
-                self.D[self.gene_index[gene], :] += dosage_row * weight
+                contribution = dosage_row * weight
             else:
-                self.D[self.gene_index[gene], :] += (2 - dosage_row) * weight  # Update all cases for that gene
+                contribution = (2 - dosage_row) * weight  # Update all cases for that gene
 
-    def get_samples(self):
-        with open(self.bgen_sample_file, 'r') as samples:
+            self._check_n_samples(len(dosage_row))
+
+            gene_idx = self.gene_index[gene]
+            if self.gene_stats:
+                self.stats['n_snps_used'][gene_idx] += 1
+                self.stats['sum_weights_used'][gene_idx] += weight
+            if self.scratch is not None and gene_idx not in self.scratch_rows:
+                self.scratch_rows[gene_idx] = len(self.scratch_rows)
+            self._accumulate(gene_idx, contribution)
+
+    def update_batch(self, dosages, applications, max_gene_chunk_size, max_sample_chunk_size, desired_gene_list=None, dosage_scale=None):
+        """
+        Same as update, for a batch of variants at once. The genes of the batch are split into n_threads disjoint
+        partitions: each one is a single matrix product of its (genes x variants) weights with the shared dosages, run
+        by the thread pool (NumPy releases the GIL), and adds to the rows of its own genes only, so no locks are needed.
+        :param dosages: (variants x samples) array.
+        :param applications: list of (gene, weight, ref_allele, allele, variant row in dosages).
+        :param dosage_scale: if given, dosages are fixed-point integers in units of dosage_scale (FIXED_POINT_MISSING for
+        missing samples): the scale is applied to the weights, so the integers are only converted for the product.
+        """
+        if self.D is None:
+            self.create_output(dosages.shape[1], max_gene_chunk_size, max_sample_chunk_size, desired_gene_list)
+        self._check_n_samples(dosages.shape[1])
+
+        # (2 - dosage) * weight = 2 * weight - dosage * weight, so flipped SNPs are a negative weight and an offset
+        gene_variants = OrderedDict()
+        for gene, weight, ref_allele, allele, variant_idx in applications:
+            if gene not in self.gene_index:
+                continue
+            gene_idx = self.gene_index[gene]
+            if gene_idx not in gene_variants:
+                gene_variants[gene_idx] = ([], [], [0.0])
+            variant_idxs, weights, offset = gene_variants[gene_idx]
+            variant_idxs.append(variant_idx)
+            if ref_allele == allele or self.complements[ref_allele] == allele:
+                weights.append(weight)
+            else:
+                weights.append(-weight)
+                offset[0] += 2 * weight
+            if self.gene_stats:
+                self.stats['n_snps_used'][gene_idx] += 1
+                self.stats['sum_weights_used'][gene_idx] += weight
+
+        gene_idxs = list(gene_variants)
+        if self.scratch is not None:
+            # scratch rows are assigned here, not by the threads
+            for gene_idx in gene_idxs:
+                if gene_idx not in self.scratch_rows:
+                    self.scratch_rows[gene_idx] = len(self.scratch_rows)
+
+        batch_dosages = np.asarray(dosages, dtype=self.dtype)
+        # missing dosages (NaN, or FIXED_POINT_MISSING in fixed point) must only make the samples of the genes using
+        # their variant NaN, as in update, so they are zeroed for the product (0 * NaN would be NaN for every gene of a
+        # partition) and set back afterwards
+        if dosage_scale is not None:
+            from bgen.bgen_reader import FIXED_POINT_MISSING
+            missing_mask = np.asarray(dosages) == FIXED_POINT_MISSING
+        else:
+            missing_mask = np.isnan(batch_dosages)
+        missing_variants = np.flatnonzero(missing_mask.any(axis=1))
+        missing = missing_mask[missing_variants]
+        if len(missing_variants) > 0:
+            batch_dosages = np.where(missing_mask, 0, batch_dosages).astype(self.dtype, copy=False)
+        reference_dosages = None
+        if self.verify_genes and self.dtype != np.float64:
+            reference_dosages = np.where(missing_mask, 0, np.asarray(dosages, dtype=np.float64))
+
+        def accumulate(partition):
+            weights = np.zeros((len(partition), dosages.shape[0]), dtype=np.float64)
+            offsets = np.empty(len(partition), dtype=np.float64)
+            for row_idx, gene_idx in enumerate(partition):
+                variant_idxs, gene_weights, offset = gene_variants[gene_idx]
+                np.add.at(weights[row_idx], variant_idxs, gene_weights)
+                offsets[row_idx] = offset[0]
+            if dosage_scale is not None:
+                # the offsets of flipped SNPs (2 * weight) are in dosage units already
+                weights *= dosage_scale
+            contributions = weights.astype(self.dtype, copy=False).dot(batch_dosages)
+            contributions += offsets[:, None].astype(self.dtype, copy=False)
+            missing_samples = None
+            if len(missing_variants) > 0:
+                uses_variant = np.zeros((len(partition), len(missing_variants)), dtype=bool)
+                for row_idx, gene_idx in enumerate(partition):
+                    uses_variant[row_idx] = np.isin(missing_variants, gene_variants[gene_idx][0])
+                missing_samples = uses_variant.astype(np.int64).dot(missing) > 0
+                contributions[missing_samples] = np.nan
+            for row_idx, gene_idx in enumerate(partition):
+                reference = None
+                if gene_idx in self.verify_genes and reference_dosages is not None:
+                    reference = weights[row_idx].dot(reference_dosages) + offsets[row_idx]
+                    if missing_samples is not None:
+                        reference[missing_samples[row_idx]] = np.nan
+                self._accumulate(gene_idx, contributions[row_idx], reference)
+
+        n_partitions = min(self.n_threads, len(gene_idxs))
+        if n_partitions <= 1:
+            if gene_idxs:
+                accumulate(gene_idxs)
+            return
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        partitions = [gene_idxs[idx::n_partitions] for idx in range(n_partitions)]
+        list(self.pool.map(accumulate, partitions))
+
+    def set_row(self, gene, row, n_snps_used=None, sum_weights_used=None):
+        """
+        Sets the row of a gene computed elsewhere, such as a row served by the result cache (see result_cache.py), with
+        its gene statistics if known.
+        """
+        gene_idx = self.gene_index[gene]
+        if self.gene_stats:
+            self.stats['n_snps_used'][gene_idx] = n_snps_used or 0
+            self.stats['sum_weights_used'][gene_idx] = sum_weights_used or 0.0
+        if self.scratch is not None and gene_idx not in self.scratch_rows:
+            self.scratch_rows[gene_idx] = len(self.scratch_rows)
+        # rows computed elsewhere are not verified
+        self.verify_genes.discard(gene_idx)
+        self._accumulate(gene_idx, np.asarray(row, dtype=np.float64))
+
+    def _check_n_samples(self, n_samples):
+        if (self.swmr or self.append) and n_samples != self.n_samples:
+            print("ERROR: The number of rows in your sample file does not match the dosage files!")
+            print("Make sure dosage files and sample files have the same number of individuals in the same order.")
+            if self.append:
+                # the existing output is left as it was
+                self.D.resize(self.first_sample, axis=1)
+                self.D_file.close()
+            else:
+                self.D_file.close()
+                os.remove(self.output_binary_file)
+            sys.exit(1)
+
+    def _accumulate(self, gene_idx, contribution, reference=None):
+        """
+        Adds the contribution of some SNPs to the row of a gene. reference is the same contribution computed in float64
+        (contribution itself if not given), added to the float64 row of the genes being verified.
+        """
+        if gene_idx in self.verify_genes:
+            reference = np.asarray(contribution if reference is None else reference, dtype=np.float64)
+            if gene_idx in self.reference_rows:
+                self.reference_rows[gene_idx] += reference
+            else:
+                self.reference_rows[gene_idx] = reference.copy()
+
+        if self.scratch is not None:
+            scratch_row = self.scratch_rows[gene_idx]
+            if self.kahan:
+                _kahan_add(self.scratch[scratch_row], self.scratch_compensation[scratch_row], contribution)
+            else:
+                self.scratch[scratch_row] += contribution
+        elif gene_idx in self.rows:
+            if self.kahan:
+                _kahan_add(self.rows[gene_idx], self.compensations[gene_idx], contribution)
+            else:
+                self.rows[gene_idx] += contribution
+        else:
+            self.rows[gene_idx] = np.array(contribution, dtype=self.dtype)
+            if self.kahan:
+                self.compensations[gene_idx] = np.zeros_like(self.rows[gene_idx])
+
+    def finish_genes(self, genes):
+        """
+        Writes the rows of the given genes to the output and frees them (with a scratch file, pred_expr is written at
+        the end by save, except in SWMR mode). In SWMR mode, also flags them as complete and flushes them to readers.
+        """
+        if self.D is None:
+            return
+        for gene in genes:
+            gene_idx = self.gene_index.get(gene)
+            if gene_idx is None:
+                continue
+            row = self._pop_row(gene_idx)
+            if self.chunk_writer is not None and self.scratch is None:
+                self._add_to_block(gene_idx, row)
+            if row is not None:
+                if self.chunk_writer is None and (self.scratch is None or self.swmr):
+                    self.D[gene_idx, self.first_sample:] = row
+                if self.gene_stats:
+                    self.stats['mean'][gene_idx] = row.mean(dtype=np.float64)
+                    self.stats['variance'][gene_idx] = row.var(ddof=1, dtype=np.float64) if len(row) > 1 else 0.0
+                if gene_idx in self.reference_rows:
+                    self._verify_row(row, self.reference_rows.pop(gene_idx))
+            if self.swmr:
+                self.complete[gene_idx] = 1
+                if self.gene_stats:
+                    for name, dataset in zip(self.stats, self.stats_datasets):
+                        dataset[gene_idx] = self.stats[name][gene_idx]
+
+        if self.swmr:
+            self.D.flush()
+            self.complete.flush()
+            if self.gene_stats:
+                for dataset in self.stats_datasets:
+                    dataset.flush()
+
+    def _add_to_block(self, gene_idx, row):
+        """
+        Keeps the finished row of a gene (None if it has no SNPs) with those of its block of gene chunks, and writes
+        the block through the chunk writer once all its genes are finished. While the kept rows take more than
+        max_pending_size bytes, the block holding the most is written through libhdf5 instead.
+        """
+        n_genes_block = self.D.chunks[0]
+        start = gene_idx // n_genes_block * n_genes_block
+        if start in self.written_blocks:
+            return
+        if start in self.filtered_blocks:
+            if row is not None:
+                self._write_filtered_row(gene_idx, row)
+            return
+        rows = self.pending_blocks.setdefault(start, {})
+        if gene_idx in rows:
+            return
+        rows[gene_idx] = row.astype(self.D.dtype) if row is not None else None
+        self.pending_size += rows[gene_idx].nbytes if row is not None else 0
+        if len(rows) == min(n_genes_block, self.n_genes - start):
+            block = np.zeros((len(rows), self.n_samples), dtype=self.D.dtype)
+            for block_gene_idx, block_row in self.pending_blocks.pop(start).items():
+                if block_row is not None:
+                    block[block_gene_idx - start] = block_row
+                    self.pending_size -= block_row.nbytes
+            self.chunk_writer.write_block(start, block)
+            self.written_blocks.add(start)
+
+        while self.pending_size > self.max_pending_size:
+            start = max(self.pending_blocks, key=lambda x: sum(1 for block_row in self.pending_blocks[x].values() if block_row is not None))
+            for block_gene_idx, block_row in self.pending_blocks.pop(start).items():
+                if block_row is not None:
+                    self._write_filtered_row(block_gene_idx, block_row)
+                    self.pending_size -= block_row.nbytes
+            self.filtered_blocks.add(start)
+
+    def _write_filtered_row(self, gene_idx, row):
+        """
+        Writes a finished row through libhdf5, converted and rounded as the chunk writer converts and rounds the values of
+        its chunks.
+        """
+        row = row.astype(self.D.dtype)
+        self.D[gene_idx, self.first_sample:] = row if self.partial else np.round(row.astype(np.float64), 4)
+
+    def _pop_row(self, gene_idx):
+        """
+        Returns the finished row of a gene (None if no SNP contributed to it), and frees it. Rows in the scratch file
+        are only read back if they are needed now (SWMR mode or gene statistics).
+        """
+        if self.scratch is None:
+            self.compensations.pop(gene_idx, None)
+            return self.rows.pop(gene_idx, None)
+
+        scratch_row = self.scratch_rows.get(gene_idx)
+        if scratch_row is None or scratch_row in self.finished_scratch_rows:
+            return None
+        self.finished_scratch_rows.add(scratch_row)
+        row = np.array(self.scratch[scratch_row], dtype=np.float64) if self.swmr or self.gene_stats or gene_idx in self.reference_rows else None
+
+        # finished rows before the first one still being accumulated are released from memory
+        first_active_row = self.first_active_scratch_row
+        while first_active_row in self.finished_scratch_rows:
+            first_active_row += 1
+        if first_active_row > self.first_active_scratch_row:
+            self._release_scratch_rows(self.first_active_scratch_row, first_active_row - 1)
+            self.first_active_scratch_row = first_active_row
+        return row
+
+    def _write_from_scratch(self):
+        """
+        Writes pred_expr from the scratch file, one block of gene chunks at a time, so every HDF5 chunk is compressed
+        and written once.
+        """
+        n_genes_block = self.D.chunks[0] if self.D.chunks is not None else self.n_genes
+        for start in range(0, self.n_genes, n_genes_block):
+            gene_idxs = range(start, min(start + n_genes_block, self.n_genes))
+            block = np.zeros((len(gene_idxs), self.n_samples), dtype=np.float32)
+            for block_idx, gene_idx in enumerate(gene_idxs):
+                if gene_idx in self.scratch_rows:
+                    block[block_idx] = self.scratch[self.scratch_rows[gene_idx]]
+            if self.chunk_writer is not None:
+                self.chunk_writer.write_block(start, block)
+            else:
+                self.D[start:start + len(gene_idxs), self.first_sample:] = block
+
+        self._remove_scratch()
+
+    def _remove_scratch(self):
+        self.scratch = None
+        os.remove(self.scratch_file)
+        if self.kahan:
+            self.scratch_compensation = None
+            os.remove(self.scratch_compensation_file)
+
+    def _verify_row(self, row, reference):
+        abs_error = float(np.abs(np.asarray(row, dtype=np.float64) - reference).max()) if len(reference) else 0.0
+        scale = float(np.abs(reference).max()) if len(reference) else 0.0
+        self.max_abs_error = max(self.max_abs_error, abs_error)
+        if scale > 0:
+            self.max_rel_error = max(self.max_rel_error, abs_error / scale)
+        self.n_verified_genes += 1
+
+    def report_accuracy(self):
+        """
+        Prints the maximum absolute and relative (to the largest absolute value of the gene's row) errors of the
+        verified genes, and stores them as attributes of pred_expr (except in SWMR mode).
+        """
+        print("{} Accumulation check: {} genes recomputed in float64, max absolute error {:.3g}, max relative error {:.3g}".format(
+            datetime.datetime.now(), self.n_verified_genes, self.max_abs_error, self.max_rel_error))
+        if not self.swmr:
+            self.D.attrs['accumulation_n_verified_genes'] = self.n_verified_genes
+            self.D.attrs['accumulation_max_abs_error'] = self.max_abs_error
+            self.D.attrs['accumulation_max_rel_error'] = self.max_rel_error
+
+    @staticmethod
+    def read_samples(bgen_sample_file):
+        """
+        Reads [ID_1, ID_2] from a BGEN .sample file, or [FID, IID] from a PLINK .fam/.psam file, or the sample IDs of
+        the header of a VCF file (as both FID and IID).
+        """
+        if bgen_sample_file.endswith(('.vcf', '.vcf.gz')):
+            from vcf.vcf_dosage import read_vcf_header
+            for sample_id in read_vcf_header(bgen_sample_file)[1]:
+                yield [sample_id, sample_id]
+            return
+
+        n_header_lines = 0 if bgen_sample_file.endswith(('.fam', '.psam')) else 2
+        fid_column, iid_column = 0, 1
+        with open(bgen_sample_file, 'r') as samples:
             for line_idx, line in enumerate(samples):
-                if line_idx <= 1:
+                if line.startswith('#'):
+                    # .psam header: the FID column is optional
+                    columns = line[1:].split()
+                    iid_column = columns.index('IID')
+                    fid_column = columns.index('FID') if 'FID' in columns else iid_column
+                    continue
+                if line_idx < n_header_lines:
                     continue
                 line_split = line.split()
-                yield [line_split[0], line_split[1]]
+                yield [line_split[fid_column], line_split[iid_column]]
+
+    def get_samples(self):
+        for sample in self.read_samples(self.bgen_sample_file):
+            if self.keep_samples is None or sample[0] in self.keep_samples:
+                yield sample
 
     def save(self):
+        # genes whose rows were not finished yet
+        self.finish_genes(self.gene_list)
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.scratch is not None:
+            if self.swmr:
+                self._remove_scratch()
+            else:
+                self._write_from_scratch()
+        if self.chunk_writer is not None:
+            self.chunk_writer.close()
+            self.chunk_writer = None
+        if self.verify_genes:
+            self.report_accuracy()
+        if self.append:
+            self._save_appended()
+            return
+        if self.gene_stats and not self.swmr:
+            self._create_stats_datasets()
+        if self.swmr:
+            self.D_file.close()
+            print("{} Predicted expression file complete!".format(datetime.datetime.now()))
+            return
+
         sample_generator = self.get_samples()
 
-        self.D_samples = self.D_file.create_dataset("samples", (self.n_samples,), dtype='S25')
+        self.D_samples = self.D_file.create_dataset("samples", (self.n_samples,), dtype='S25', maxshape=(None,))
         for col in range(0, self.D.shape[1]):
             try:
                 self.D_samples[col] = np.string_(next(sample_generator)[0])
@@ -166,15 +778,411 @@ class TranscriptionMatrix:
             sys.exit(1)
 
 
-def get_all_dosages_from_bgen(bgen_dir, bgen_prefix, rsids, args):
+    def _save_appended(self):
+        """
+        Appends the new samples to the samples dataset and, if the output has gene statistics, combines their mean and
+        variance with those of the new columns (the numbers of SNPs used stay those of the first run).
+        """
+        samples = self.D_file['samples']
+        samples.resize(self.first_sample + self.n_samples, axis=0)
+        samples[self.first_sample:] = np.array([np.string_(sample[0]) for sample in self.get_samples()], dtype='S25')
+
+        if self.gene_stats:
+            n_old, n_new = self.first_sample, self.n_samples
+            n_total = n_old + n_new
+            old_mean, old_variance = self.D_file['gene_stats/mean'][:], self.D_file['gene_stats/variance'][:]
+            new_mean, new_variance = self.stats['mean'], self.stats['variance']
+            # pairwise combination of the sums of squared deviations (Chan et al.)
+            sum_squares = old_variance * max(n_old - 1, 0) + new_variance * max(n_new - 1, 0) + (new_mean - old_mean) ** 2 * n_old * n_new / n_total
+            self.D_file['gene_stats/mean'][:] = (old_mean * n_old + new_mean * n_new) / n_total
+            self.D_file['gene_stats/variance'][:] = sum_squares / (n_total - 1) if n_total > 1 else 0.0
+
+        self.D_file.close()
+        print("{} Appended {} samples to the predicted expression file".format(datetime.datetime.now(), self.n_samples))
+
+    def write_text(self, text_file, n_threads=1, max_bytes=512 * 1024 ** 2):
+        """
+        Writes the saved output as text, in the layout of the original PrediXcan (FID, IID and one column per gene,
+        see text_output.write_text). After samples were appended, the samples of the earlier runs are taken from the
+        samples dataset, which only has their FID (also written as IID).
+        """
+        import h5py
+        from text_output import write_text
+        with h5py.File(self.output_binary_file, 'r') as hdf5_file:
+            samples = [[sample.decode()] * 2 for sample in hdf5_file['samples'][:self.first_sample]] + list(self.get_samples())
+            write_text(hdf5_file['pred_expr'], self.gene_list, samples, text_file, n_threads, max_bytes)
+        print("{} Text output file complete!".format(datetime.datetime.now()))
+
+
+class PredictedExpression:
+    """
+    Reader for the predicted expression files written by TranscriptionMatrix. Gene and sample names are mapped to
+    indexes once, and slices are served from whole HDF5 chunks kept in a LRU cache, so that selecting a few genes does
+    not read the whole matrix. Contiguous, uncompressed files are memory-mapped instead.
+    """
+    def __init__(self, hdf5_file, n_cached_chunks=64, use_mmap=True, swmr=False):
+        """
+        :param swmr: open a file that is still being written with --swmr; see get_complete_genes and refresh.
+        """
+        self.hdf5_file = hdf5_file
+        self.n_cached_chunks = n_cached_chunks
+
+        import h5py
+        if swmr:
+            self.D_file = h5py.File(hdf5_file, 'r', libver='latest', swmr=True)
+        else:
+            self.D_file = h5py.File(hdf5_file, 'r')
+        self.D = self.D_file['pred_expr']
+        self.complete = self.D_file['complete'] if 'complete' in self.D_file else None
+
+        self.genes = [x.decode() for x in self.D_file['genes'][:]]
+        self.samples = [x.decode() for x in self.D_file['samples'][:]]
+        self.gene_index = {gene: k for (k, gene) in enumerate(self.genes)}
+        self.sample_index = {sample: k for (k, sample) in enumerate(self.samples)}
+
+        self.chunks = self.D.chunks if self.D.chunks is not None else self.D.shape
+        self.cached_chunks = OrderedDict()
+
+        self.mmap = None
+        if use_mmap and self.D.chunks is None and self.D.compression is None and self.D.scaleoffset is None:
+            offset = self.D.id.get_offset()
+            if offset is not None:
+                self.mmap = np.memmap(hdf5_file, mode='r', dtype=self.D.dtype, offset=offset, shape=self.D.shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.mmap = None
+        self.cached_chunks.clear()
+        self.D_file.close()
+
+    def refresh(self):
+        """
+        Picks up the genes written since the file was opened (or last refreshed) in SWMR mode.
+        """
+        self.cached_chunks.clear()
+        self.D.refresh()
+        if self.complete is not None:
+            self.complete.refresh()
+
+    def get_complete_genes(self):
+        """
+        Returns the genes whose predicted expression is final. All genes are final in files not written with --swmr.
+        """
+        if self.complete is None:
+            return list(self.genes)
+        return [self.genes[idx] for idx in np.flatnonzero(self.complete[:])]
+
+    def _get_indexes(self, names, index, kind):
+        if names is None:
+            return np.arange(len(index))
+        try:
+            return np.array([index[name] for name in names], dtype=np.int64)
+        except KeyError as e:
+            raise KeyError("{} {} not found in {}".format(kind, e.args[0], self.hdf5_file))
+
+    def _get_chunk(self, gene_chunk, sample_chunk):
+        key = (gene_chunk, sample_chunk)
+        if key in self.cached_chunks:
+            self.cached_chunks.move_to_end(key)
+            return self.cached_chunks[key]
+
+        n_genes_chunk, n_samples_chunk = self.chunks
+        chunk = self.D[gene_chunk * n_genes_chunk:(gene_chunk + 1) * n_genes_chunk,
+                       sample_chunk * n_samples_chunk:(sample_chunk + 1) * n_samples_chunk]
+
+        self.cached_chunks[key] = chunk
+        if len(self.cached_chunks) > self.n_cached_chunks:
+            self.cached_chunks.popitem(last=False)
+
+        return chunk
+
+    def get(self, genes=None, samples=None):
+        """
+        Returns the predicted expression of the given genes (rows) and samples (columns), in the given order.
+        :param genes: list of gene names; all genes if None.
+        :param samples: list of sample IDs; all samples if None.
+        :return: a (len(genes), len(samples)) float32 array.
+        """
+        gene_idxs = self._get_indexes(genes, self.gene_index, 'Gene')
+        sample_idxs = self._get_indexes(samples, self.sample_index, 'Sample')
+
+        if self.mmap is not None:
+            return np.array(self.mmap[np.ix_(gene_idxs, sample_idxs)])
+
+        out = np.empty((len(gene_idxs), len(sample_idxs)), dtype=self.D.dtype)
+        n_genes_chunk, n_samples_chunk = self.chunks
+        gene_chunks = gene_idxs // n_genes_chunk
+        sample_chunks = sample_idxs // n_samples_chunk
+
+        for gene_chunk in np.unique(gene_chunks):
+            out_rows = np.flatnonzero(gene_chunks == gene_chunk)
+            chunk_rows = gene_idxs[out_rows] - gene_chunk * n_genes_chunk
+            for sample_chunk in np.unique(sample_chunks):
+                out_cols = np.flatnonzero(sample_chunks == sample_chunk)
+                chunk_cols = sample_idxs[out_cols] - sample_chunk * n_samples_chunk
+                chunk = self._get_chunk(gene_chunk, sample_chunk)
+                out[np.ix_(out_rows, out_cols)] = chunk[np.ix_(chunk_rows, chunk_cols)]
+
+        return out
+
+    def get_genes(self, genes):
+        return self.get(genes=genes)
+
+    def get_samples(self, samples):
+        return self.get(samples=samples)
+
+
+def open_genotypes(backend, genotype_path, **kwargs):
+    return backends.get_backend(backend)(genotype_path, **kwargs)
+
+def get_genotype_files(bgen_dir, bgen_prefix, args):
     if args.autosomes is True:
         if '{chr_num}' not in bgen_prefix:
             print("--bgens-prefix should have {chr_num} if --autosomes are used")
             sys.exit()
         candidate_prefix = tuple([ bgen_prefix.format(chr_num = j) for j in range(1, 23) ])
-        bgen_files = [x for x in sorted(os.listdir(bgen_dir)) if x.startswith(candidate_prefix) and x.endswith(".bgen")]
     else:
-        bgen_files = [x for x in sorted(os.listdir(bgen_dir)) if x.startswith(bgen_prefix) and x.endswith(".bgen")]
+        candidate_prefix = (bgen_prefix,)
+
+    # BGEN files, or PLINK .bed/.pgen filesets or bgzipped VCF files if there are no BGEN files
+    return backends.find_genotype_files(bgen_dir, candidate_prefix)
+
+def open_genotype_file(backend, bgen_dir, chrfile, args, open_genotypes=open_genotypes):
+    if backend == 'bgen':
+        return open_genotypes(backend, os.path.join(bgen_dir, chrfile), bgen_bgi=os.path.join(args.bgens_bgi_dir, chrfile), sample_path=args.bgens_sample_file,
+                              decoder=args.bgens_decoder, n_threads=args.bgens_n_threads, fixed_point=args.bgens_fixed_point,
+                              bgi_sidecar=args.bgens_bgi_sidecar, **get_prefetch_kwargs(backend, args))
+    if backend == 'vcf':
+        return open_genotypes(backend, os.path.join(bgen_dir, chrfile), sample_path=args.bgens_sample_file, n_threads=args.bgens_n_threads,
+                              **get_prefetch_kwargs(backend, args))
+    return open_genotypes(backend, os.path.join(bgen_dir, chrfile), sample_path=args.bgens_sample_file, **get_prefetch_kwargs(backend, args))
+
+def get_prefetch_depth(backend, args):
+    """
+    Read-ahead depth of the genotype files: 0 for BGEN files read through rbgen, whose R objects must not be created
+    or used outside the main thread (see prefetch.open_ahead).
+    """
+    if backend == 'bgen' and args.bgens_decoder == 'rbgen':
+        return 0
+    return args.bgens_prefetch_depth
+
+def get_prefetch_kwargs(backend, args):
+    return {'prefetch_depth': get_prefetch_depth(backend, args), 'prefetch_max_bytes': args.bgens_prefetch_max_mb * (1024 ** 2)}
+
+def match_variants_by_position(bgen_dir, bgen_prefix, weights_file, rsids, args, open_genotypes=open_genotypes):
+    """
+    Matches model SNPs to genotype variants by chromosome, position and alleles (in any order), using the varID column
+    of the weights table (chr1_13550_G_A_b38). Both sides are encoded as 64-bit variant keys and merge-joined.
+    :return: dict of genotype variant ID -> model rsid. Genotype IDs that are not unique are left out, since genotype
+    variants are selected by ID.
+    """
+    from variant_keys import variant_keys, parse_var_ids, merge_join
+
+    try:
+        var_ids = dict(WeightsDB(weights_file).query("SELECT DISTINCT rsid, varID FROM weights"))
+    except sqlite3.OperationalError:
+        print("ERROR: --variant-matching position needs a varID column (chr_position_ref_alt_build) in the weights table of {}".format(weights_file))
+        sys.exit(1)
+    model_rsids = [rsid for rsid in rsids if var_ids.get(rsid)]
+    model_keys = variant_keys(*parse_var_ids([var_ids[rsid] for rsid in model_rsids]))
+
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+    matched = {}
+    matched_models = set()
+    n_ambiguous = 0
+    for chrfile in bgen_files:
+        bgen_dosage = open_genotype_file(backend, bgen_dir, chrfile, args, open_genotypes)
+        genotype_rsids, chromosomes, positions, alleles0, alleles1 = bgen_dosage.variant_table()
+        del bgen_dosage
+
+        model_idxs, genotype_idxs = merge_join(model_keys, variant_keys(chromosomes, positions, alleles0, alleles1))
+        matched_ids = {genotype_rsids[idx] for idx in genotype_idxs}
+        id_counts = defaultdict(int)
+        for rsid in genotype_rsids:
+            if rsid in matched_ids:
+                id_counts[rsid] += 1
+
+        for model_idx, genotype_idx in zip(model_idxs, genotype_idxs):
+            genotype_rsid = genotype_rsids[genotype_idx]
+            if id_counts[genotype_rsid] > 1 or genotype_rsid in matched:
+                n_ambiguous += 1
+            elif model_idx not in matched_models:
+                matched[genotype_rsid] = model_rsids[model_idx]
+                matched_models.add(model_idx)
+
+    print("{} Matched {} of {} model SNPs by position".format(datetime.datetime.now(), len(matched_models), len(model_rsids)))
+    if n_ambiguous > 0:
+        print("WARNING: {} matched genotype variants were skipped because their IDs are not unique".format(n_ambiguous))
+    return matched
+
+def check_genotype_inputs(bgen_dir, bgen_prefix, n_samples, args):
+    """
+    Checks, before anything is decoded, that there are genotype files, that BGEN files are indexed and that every
+    genotype file has as many samples as the sample file.
+    :param n_samples: number of samples in the sample file.
+    :return: list of problems found.
+    """
+    import preflight
+
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+    if not bgen_files:
+        return ["No genotype files in {} start with {}".format(bgen_dir, bgen_prefix)]
+
+    problems = []
+    for chrfile in bgen_files:
+        if backend == 'bgen' and not os.path.isfile(os.path.join(args.bgens_bgi_dir, chrfile) + '.bgi'):
+            problems.append("{} has no .bgi index in {}".format(chrfile, args.bgens_bgi_dir))
+        if backend == 'vcf' and not any(os.path.isfile(os.path.join(bgen_dir, chrfile) + extension) for extension in ('.tbi', '.csi')):
+            problems.append("{} has no tabix (.tbi) or CSI (.csi) index".format(chrfile))
+        genotype_samples = preflight.genotype_samples_count(backend, os.path.join(bgen_dir, chrfile))
+        if genotype_samples != n_samples:
+            problems.append("{} has {} samples, but {} has {}".format(chrfile, genotype_samples, args.bgens_sample_file, n_samples))
+    return problems
+
+def filter_variants_by_qc(bgen_dir, bgen_prefix, rsids, args):
+    """
+    Drops the variants with an INFO score below --min-info or a MAF below --min-maf, read from the QC file next to
+    each .bgi index (see bgen.variant_qc), so that they are never read nor decoded.
+    :return: the rsids that passed.
+    """
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+    if backend != 'bgen':
+        print("WARNING: --min-info and --min-maf are only applied to BGEN files")
+        return rsids
+
+    from bgen.variant_qc import VariantQC
+    excluded = set()
+    for chrfile in bgen_files:
+        variant_qc = VariantQC(os.path.join(bgen_dir, chrfile), os.path.join(args.bgens_bgi_dir, chrfile) + '.bgi', args.bgens_n_threads)
+        excluded.update(variant_qc.excluded(rsids, args.min_info, args.min_maf))
+    print("{} {} of {} model SNPs excluded by --min-info/--min-maf".format(datetime.datetime.now(), len(excluded), len(rsids)))
+    return [rsid for rsid in rsids if rsid not in excluded]
+
+def dry_run(bgen_dir, bgen_prefix, rsids, get_applications_of, n_genes, sample_idxs, n_samples, args, open_genotypes=open_genotypes):
+    """
+    Prints, without running the prediction, the model SNPs found in each genotype file and an estimate of the
+    variants to decode, bytes to read, accumulator memory, output size and runtime. The runtime is extrapolated from
+    the time taken to decode one batch of variants with the chosen backend and options.
+    """
+    import preflight
+    from time import time
+
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+    variant_positions_by_file = []
+    n_bytes = 0
+    seconds_per_variant = None
+    print("Model SNPs found per genotype file:")
+    for chrfile in bgen_files:
+        bgen_dosage = open_genotype_file(backend, bgen_dir, chrfile, args, open_genotypes)
+        variant_positions = bgen_dosage.variant_positions(rsids)
+        variant_positions_by_file.append(variant_positions)
+        found_rsids = sorted({rsid for rsid, _ in variant_positions})
+        print("  {}: {} variants ({} model SNPs)".format(chrfile, len(variant_positions), len(found_rsids)))
+
+        n_bytes += preflight.bytes_to_read(backend, os.path.join(bgen_dir, chrfile), os.path.join(args.bgens_bgi_dir, chrfile) + '.bgi',
+                                           found_rsids, len(variant_positions), n_samples)
+
+        if seconds_per_variant is None and found_rsids:
+            calibration_rsids = found_rsids[:args.bgens_n_cache]
+            start_time = time()
+            n_decoded = sum(1 for _ in bgen_dosage.items(n_rows_cached=args.bgens_n_cache, include_rsid=calibration_rsids, sample_idxs=sample_idxs))
+            seconds_per_variant = (time() - start_time) / max(n_decoded, 1)
+        del bgen_dosage
+
+    n_variants = sum(len(x) for x in variant_positions_by_file)
+    n_found = len({rsid for x in variant_positions_by_file for rsid, _ in x})
+    n_active_genes = preflight.peak_active_genes(variant_positions_by_file, get_applications_of)
+
+    print("Model SNPs found: {} of {}".format(n_found, len(rsids)))
+    print("Variants to decode: {}".format(n_variants))
+    print("Bytes to read: {}".format(preflight.format_bytes(n_bytes)))
+    # float32-kahan keeps a float32 compensation next to each float32 value
+    kahan = args.accumulation_precision == 'float32-kahan'
+    if args.scratch_dir is not None:
+        print("Scratch file: at most {} in {}".format(preflight.format_bytes(n_genes * n_samples * (8 if kahan else 4)), args.scratch_dir))
+    else:
+        value_size = 4 if args.accumulation_precision == 'float32' else 8
+        print("Accumulator memory: {} ({} genes held at a time)".format(preflight.format_bytes(n_active_genes * n_samples * value_size), n_active_genes))
+    print("Output size: at most {} ({} genes x {} samples, before compression)".format(preflight.format_bytes(n_genes * n_samples * 4), n_genes, n_samples))
+    if seconds_per_variant is not None:
+        print("Expected runtime: {} ({:.2f} ms per variant)".format(preflight.format_seconds(seconds_per_variant * n_variants), seconds_per_variant * 1000))
+
+
+def get_genes_last_variant(bgen_dir, bgen_prefix, rsids, get_applications_of, args, open_genotypes=open_genotypes):
+    """
+    Finds, from the genotype indexes, the last variant of each gene's model SNPs, as (genotype file index, position).
+    The position is None for files whose model SNPs are not sorted by position, where genes can only be finished at
+    the end of the file. Genes without SNPs in the genotype files are not returned.
+    """
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+    genes_last_variant = {}
+    for idx, chrfile in enumerate(bgen_files):
+        bgen_dosage = open_genotype_file(backend, bgen_dir, chrfile, args, open_genotypes)
+        variant_positions = bgen_dosage.variant_positions(rsids)
+        del bgen_dosage
+
+        positions = [position for _, position in variant_positions]
+        is_sorted = all(positions[i] <= positions[i + 1] for i in range(len(positions) - 1))
+        for rsid, position in variant_positions:
+            for gene, _, _ in get_applications_of(rsid):
+                genes_last_variant[gene] = (idx, position if is_sorted else None)
+    return genes_last_variant
+
+class GeneWindow:
+    """
+    Tracks the genes whose model SNPs are still ahead in the genotype stream. Since a gene's SNPs sit within a cis
+    window, a gene can be finished as soon as the stream passes its last SNP, so the accumulator only holds the genes
+    overlapping the current position.
+    """
+    def __init__(self, gene_list, genes_last_variant):
+        self.file_idx = 0
+        # per genotype file, genes sorted by descending last position, so the next ones to finish are popped from the end
+        self.pending = defaultdict(list)
+        self.unused_genes = []
+        for gene in gene_list:
+            if gene not in genes_last_variant:
+                self.unused_genes.append(gene)
+                continue
+            file_idx, position = genes_last_variant[gene]
+            self.pending[file_idx].append((float('inf') if position is None else position, gene))
+        for genes in self.pending.values():
+            genes.sort(reverse=True)
+
+    def passed(self, position):
+        """
+        Returns the genes of the current genotype file whose last SNP is before position.
+        """
+        genes = self.pending.get(self.file_idx)
+        finished = []
+        while genes and genes[-1][0] < position:
+            finished.append(genes.pop()[1])
+        return finished
+
+    def file_done(self, file_idx):
+        """
+        Returns the remaining genes of a genotype file that was fully processed, and moves on to the next one.
+        """
+        self.file_idx = file_idx + 1
+        return [gene for _, gene in self.pending.pop(file_idx, [])]
+
+def get_all_dosages_from_bgen(bgen_dir, bgen_prefix, rsids, args, open_genotypes=open_genotypes, sample_idxs=None, on_file_done=None):
+    """
+    Yields (chromosome, position, rsid, allele, dosages, dosage_scale) for each variant. With --bgens-fixed-point,
+    dosages are the uint16 values decoded, in units of dosage_scale, so that they are only converted by the batch
+    product that applies the weights (see TranscriptionMatrix.update_batch); otherwise dosage_scale is None.
+    :param on_file_done: if given, called with the index of each genotype file once all its variants were consumed.
+    """
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+
+    # with read-ahead, the next genotype file is opened (and its index read) while the current one is processed
+    import prefetch
+    opened_files = prefetch.open_ahead(lambda chrfile: open_genotype_file(backend, bgen_dir, chrfile, args, open_genotypes),
+                                       bgen_files, enabled=get_prefetch_depth(backend, args) > 0)
 
     for idx, chrfile in enumerate(bgen_files):
         print("{} Processing {}".format(datetime.datetime.now(), chrfile))
@@ -182,10 +1190,51 @@ def get_all_dosages_from_bgen(bgen_dir, bgen_prefix, rsids, args):
         if idx > 0:
             del bgen_dosage
             gc.collect()
-        bgen_dosage = BGENDosage(os.path.join(bgen_dir, chrfile), bgen_bgi=os.path.join(args.bgens_bgi_dir, chrfile), sample_path=args.bgens_sample_file)
+        bgen_dosage = next(opened_files)
+
+        dosage_scale = getattr(bgen_dosage, 'dosage_scale', None)
+
+        for variant_info in bgen_dosage.items(n_rows_cached=args.bgens_n_cache, include_rsid=rsids, sample_idxs=sample_idxs):
+            yield variant_info.chr, variant_info.position, variant_info.rsid, variant_info.allele1, variant_info.dosages, dosage_scale
+
+        if on_file_done is not None:
+            on_file_done(idx)
+
+def get_result_cache_keys(bgen_dir, bgen_prefix, weights_file, genes, samples, args):
+    """
+    Keys of the rows of the given genes in the result cache: a hash of each gene's weights, of the genotype files and
+    decoding options, and of the samples.
+    """
+    import result_cache
+    backend, bgen_files = get_genotype_files(bgen_dir, bgen_prefix, args)
+    options = {'decoder': args.bgens_decoder, 'fixed_point': args.bgens_fixed_point, 'variant_matching': args.variant_matching,
+               'min_info': args.min_info, 'min_maf': args.min_maf, 'accumulation_precision': args.accumulation_precision}
+    genotype_hash = result_cache.genotype_identity(bgen_dir, bgen_files, options)
+    return result_cache.gene_keys(result_cache.weight_fingerprints(weights_file, genes), genotype_hash, result_cache.sample_set_hash(samples))
+
+
+def store_in_result_cache(gene_result_cache, output_file, keys, first_sample=0):
+    """
+    Stores the rows of the given genes of a finished output, as written to pred_expr, one block of gene chunks at a time.
+    :param keys: dict of gene -> cache key.
+    :param first_sample: first column of the samples the keys were computed for (the appended samples).
+    """
+    import h5py
+    with h5py.File(output_file, 'r') as hdf5_file:
+        genes = [gene.decode() for gene in hdf5_file['genes'][:]]
+        pred_expr = hdf5_file['pred_expr']
+        stats = hdf5_file['gene_stats'] if 'gene_stats' in hdf5_file else None
+        n_genes_block = pred_expr.chunks[0] if pred_expr.chunks is not None else len(genes)
+        for start in range(0, len(genes), n_genes_block):
+            gene_idxs = [gene_idx for gene_idx in range(start, min(start + n_genes_block, len(genes))) if genes[gene_idx] in keys]
+            if not gene_idxs:
+                continue
+            block = pred_expr[start:start + n_genes_block, first_sample:]
+            gene_result_cache.put((keys[genes[gene_idx]], block[gene_idx - start],
+                                   int(stats['n_snps_used'][gene_idx]) if stats is not None else None,
+                                   float(stats['sum_weights_used'][gene_idx]) if stats is not None else None)
+                                  for gene_idx in gene_idxs)
 
-        for variant_info in bgen_dosage.items(n_rows_cached=args.bgens_n_cache, include_rsid=rsids):
-            yield variant_info.rsid, variant_info.allele1, variant_info.dosages
 
 def load_gene_list(gene_list):
     if gene_list is None:
@@ -197,30 +1246,122 @@ def load_gene_list(gene_list):
             out.append(l.strip())
     return out
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--weights-file', required=True, help="SQLite database with rsid weights.")
-    parser.add_argument('--output-file', required=True, help="Predicted expression file from earlier run of PrediXcan")
-    parser.add_argument('--bgens-dir', required=True, help="Path to a directory of BGEN files.")
+def load_keep_samples(keep_samples):
+    """
+    Reads the sample IDs to keep: the first column of each row (without header).
+    """
+    if keep_samples is None:
+        return None
+    with open(keep_samples, 'r') as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+def get_sample_idxs(bgen_sample_file, keep_samples):
+    """
+    Resolves the IDs to keep (first column of the sample file) to their indexes in the BGEN sample order.
+    :return: sorted array of sample indexes, or None if all samples are kept.
+    """
+    if keep_samples is None:
+        return None
+    keep_samples = set(keep_samples)
+    sample_ids = [sample[0] for sample in TranscriptionMatrix.read_samples(bgen_sample_file)]
+    sample_idxs = np.array([idx for idx, sample_id in enumerate(sample_ids) if sample_id in keep_samples], dtype=np.int64)
+    if len(sample_idxs) < len(keep_samples):
+        print("WARNING: {} of the samples to keep are not in {}".format(len(keep_samples) - len(sample_idxs), bgen_sample_file))
+    return sample_idxs
+
+def add_genotype_arguments(parser):
+    parser.add_argument('--bgens-dir', required=True, help="Path to a directory of BGEN files (or PLINK .bed/.bim/.fam or .pgen/.pvar/.psam filesets, or .vcf.gz files with a DS field, indexed with tabix or bcftools).")
     parser.add_argument('--bgens-bgi-dir', default=None, help="Path to a directory of BGEN BGI files (the filename should match the corresponding BGEN files).")
     parser.add_argument('--bgens-prefix', default='', help="Prefix of filenames of BGEN files.")
-    parser.add_argument('--bgens-sample-file', required=True, help="BGEN sample file.")
+    parser.add_argument('--bgens-sample-file', required=True, help="BGEN sample file (.fam or .psam file for PLINK filesets, or one of the .vcf.gz files for VCF files).")
     parser.add_argument('--bgens-n-cache', type=int, default=100, help="Number of variants to process at a time.")
+    parser.add_argument('--bgens-decoder', choices=('rbgen', 'native'), default='rbgen', help="Decode BGEN files through the rbgen R package, or natively in Python (no R needed; layouts 1 and 2, zlib or zstd compression). Default: rbgen")
+    parser.add_argument('--bgens-n-threads', type=int, default=1, help="Number of threads decoding each batch of variants with --bgens-decoder native. Default: 1")
+    parser.add_argument('--bgens-fixed-point', action="store_true", help="With --bgens-decoder native, decode dosages straight from the stored probability integers into 16-bit fixed point (precision 3e-5), kept until the weights are applied. Missing genotypes stay missing, as without it.")
+    parser.add_argument('--bgens-bgi-sidecar', action="store_true", help="Keep a NumPy copy of each .bgi index next to it (built on first use, rebuilt when the .bgi file changes) and select variants from it instead of querying SQLite. The .bgi directory must be writable.")
+    parser.add_argument('--variant-matching', choices=('rsid', 'position'), default='rsid', help="Match model SNPs to genotype variants by rsid, or by chromosome, position and alleles (needs the varID column of predictdb models). Default: rsid")
+    parser.add_argument('--min-info', type=float, default=None, help="Exclude BGEN variants with an IMPUTE INFO score below this value. Variant metrics are computed from all the samples of each BGEN file on first use, and stored next to its .bgi index (.bgi.qc.npy), so the .bgi directory must be writable.")
+    parser.add_argument('--min-maf', type=float, default=None, help="Exclude BGEN variants with a minor allele frequency below this value (see --min-info).")
+    parser.add_argument('--bgens-prefetch-depth', type=int, default=2, help="Number of batches of variants read ahead (posix_fadvise) while the current one is decoded, with --bgens-decoder native or .bed files. If greater than 0, the next genotype file is also opened in the background. Not used with --bgens-decoder rbgen. Set to 0 to disable read-ahead. Default: 2")
+    parser.add_argument('--bgens-prefetch-max-mb', type=int, default=256, help="Maximum size of the batches read ahead, in MB. Default: 256")
+    parser.add_argument('--n-accumulation-threads', type=int, default=1, help="Number of threads applying the model weights to each batch of --bgens-n-cache variants, each one on a disjoint set of genes. Independent of --bgens-n-threads. Default: 1")
+    parser.add_argument('--accumulation-precision', choices=('float64', 'float32', 'float32-kahan'), default='float64', help="Precision of the accumulated gene rows and of the products of each batch of variants. float32 halves the memory of the rows and uses faster single-precision products; each batch is summed before being added to the rows, so rounding errors grow with the number of batches. float32-kahan adds Kahan compensated summation across batches (with a float32 compensation row per gene). Default: float64")
+    parser.add_argument('--verify-accumulation', type=int, default=0, help="Also accumulate this number of randomly chosen genes in float64, and report the maximum absolute and relative error of their rows at the end (also stored as attributes of pred_expr). Default: 0")
     parser.add_argument('--bgens-writing-cache-size', type=int, default=50, help="BGEN reading cache size in MB.")
     parser.add_argument('--max-sample-chunk-size', type=int, default=-1, help="Maximum number of chunks on sample axis (column). Set to -1 if do not want to use chunk. Default: -1")
     parser.add_argument('--max-gene-chunk-size', type=int, default=10, help="Maximum number of chunks on gene axis (row). Set to -1 if do not want to use chunk. Default: 10")
+    parser.add_argument('--n-compression-threads', type=int, default=0, help="Number of threads compressing the chunks of pred_expr, which are then written directly instead of being compressed by libhdf5 in a single thread. pred_expr then uses the shuffle and gzip filters, with values rounded to 4 decimals, instead of the scale-offset filter (it stays readable by any HDF5 reader). Finished gene rows are kept in memory until all the genes of their chunk are finished, up to --compression-max-pending-mb. Ignored with --swmr. Default: 0 (compressed by libhdf5)")
+    parser.add_argument('--compression-max-pending-mb', type=int, default=1024, help="With --n-compression-threads, maximum size in MB of the finished gene rows kept until all the genes of their chunk are finished. Above it, the chunks holding the most rows are compressed by libhdf5 instead. Default: 1024")
     parser.add_argument('--no-progress-bar', action="store_true", help="Disable progress bar")
     parser.add_argument('--autosomes', action="store_true", help="Use all autosomes 1..22. If set true, --bgens-prefix should contain {chr_num}")
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights-file', required=True, help="SQLite database with rsid weights.")
+    parser.add_argument('--output-file', required=True, help="Predicted expression file from earlier run of PrediXcan")
+    add_genotype_arguments(parser)
     parser.add_argument('--gene-list', default=None, help="a list of gene to work with (one gene per row without header)")
+    parser.add_argument('--keep-samples', default=None, help="a list of sample IDs (first column of --bgens-sample-file) to predict for, one per row without header. Other samples are dropped while decoding the genotypes.")
+    parser.add_argument('--covariance-output', default=None, help="If given, also compute the covariance of each gene's model SNPs during the prediction pass and write it here (gzipped, GENE RSID1 RSID2 VALUE format).")
+    parser.add_argument('--dry-run', action="store_true", help="Check the inputs (genotype files and indexes, sample counts, model SNPs found in each genotype file) and estimate the variants to decode, bytes to read, memory, output size and runtime, without running the prediction.")
+    parser.add_argument('--gene-stats', action="store_true", help="Also write, in the 'gene_stats' group of the output, the mean and variance of each gene's predicted expression, its number of model SNPs and of SNPs found in the genotypes, and the sum of the weights used.")
+    parser.add_argument('--scratch-dir', default=None, help="Accumulate predicted expression in a memory-mapped scratch file (float32, genes x samples) created in this directory, preferably on a local disk, instead of in memory. pred_expr is written from it in one sequential pass at the end.")
+    parser.add_argument('--text-output', default=None, help="Also write the predicted expression as text, in the layout of the original PrediXcan (FID, IID and one column per gene, tab-delimited, 6 decimals). Compressed with BGZF (gzip compatible) if the name ends with .gz.")
+    parser.add_argument('--text-output-n-threads', type=int, default=1, help="Number of threads formatting and compressing --text-output. Default: 1")
+    parser.add_argument('--result-cache-dir', default=None, help="Directory of a local cache of predicted gene rows, keyed by each gene's weights, the genotype files and the samples. Genes found in it are not predicted again, and the newly predicted genes are added to it. Cannot be used with --partial-output.")
+    parser.add_argument('--result-cache-max-mb', type=int, default=10240, help="Maximum size of the result cache in MB; the least recently used gene rows are evicted above it. Default: 10240")
+    parser.add_argument('--partial-output', action="store_true", help="Write pred_expr as float64 without the scale-offset filter, so that the outputs of runs over different genotype files can be summed exactly (used by work_queue.py).")
+    parser.add_argument('--append-samples', action="store_true", help="Add the samples of the genotype files to an existing --output-file predicted with the same weights (checked by fingerprint) and genes, instead of creating it: pred_expr is extended along its sample axis and only the new samples are predicted. Cannot be used with --swmr or --partial-output.")
+    parser.add_argument('--swmr', action="store_true", help="Write the output in HDF5 single-writer/multiple-reader mode: genes and samples are written first, and each gene row is written (and flagged in the 'complete' dataset) as soon as its last genotype file was processed, so it can be read while the prediction runs.")
+    return parser
 
-    args = parser.parse_args()
-    
+def run(args, get_applications_of=None, open_genotypes=open_genotypes):
+    """
+    Runs a prediction. Already loaded weights (get_applications_of) and opened genotype files (open_genotypes) can be given by
+    long-running callers, such as predict_server.py, to skip their loading.
+    """
     if args.bgens_bgi_dir is None:
         args.bgens_bgi_dir = args.bgens_dir
 
-    check_out_file(args.output_file)
-    get_applications_of = GetApplicationsOf(args.weights_file, True)
-    transcription_matrix = TranscriptionMatrix(args.weights_file, args.bgens_sample_file, args.output_file, cache_size=(args.bgens_writing_cache_size * (1024 ** 2)))
+    for in_file in (args.weights_file, args.bgens_dir, args.bgens_bgi_dir, args.bgens_sample_file, args.gene_list, args.keep_samples):
+        if in_file is not None:
+            check_in_file(in_file)
+    if args.append_samples:
+        check_in_file(args.output_file)
+        if args.swmr or args.partial_output:
+            print("ERROR: --append-samples cannot be used with --swmr or --partial-output")
+            sys.exit(1)
+    else:
+        check_out_file(args.output_file)
+    if args.result_cache_dir is not None and args.partial_output:
+        # the cache holds float32 rows read from the rounded pred_expr of normal outputs
+        print("ERROR: --result-cache-dir cannot be used with --partial-output")
+        sys.exit(1)
+
+    def remove_output():
+        # an output samples are appended to is kept
+        if not args.append_samples:
+            os.remove(args.output_file)
+
+    if args.text_output is not None:
+        check_out_file(args.text_output)
+    problems = check_genotype_inputs(args.bgens_dir, args.bgens_prefix, sum(1 for _ in TranscriptionMatrix.read_samples(args.bgens_sample_file)), args)
+    if problems:
+        for problem in problems:
+            print("ERROR: {}".format(problem))
+        remove_output()
+        sys.exit(1)
+
+    if get_applications_of is None:
+        get_applications_of = GetApplicationsOf(args.weights_file, True)
+    keep_samples = load_keep_samples(args.keep_samples)
+
+    transcription_matrix = TranscriptionMatrix(args.weights_file, args.bgens_sample_file, args.output_file, cache_size=(args.bgens_writing_cache_size * (1024 ** 2)), keep_samples=keep_samples, swmr=args.swmr, gene_stats=args.gene_stats,
+                                               scratch_dir=args.scratch_dir, n_threads=args.n_accumulation_threads, partial=args.partial_output,
+                                               precision=args.accumulation_precision, n_verify_genes=args.verify_accumulation,
+                                               n_compression_threads=args.n_compression_threads, append=args.append_samples,
+                                               max_pending_size=args.compression_max_pending_mb * (1024 ** 2))
+    sample_idxs = get_sample_idxs(args.bgens_sample_file, keep_samples)
     
     # load desired gene list
     desired_gene_list = load_gene_list(args.gene_list)
@@ -229,15 +1370,126 @@ if __name__ == '__main__':
     
     if len(unique_rsids) == 0:
         print('The genes in gene list do not appear in the predictdb. Exit!')
-        os.remove(args.output_file)
+        remove_output()
         sys.exit()
 
-    all_dosages = get_all_dosages_from_bgen(args.bgens_dir, args.bgens_prefix, unique_rsids, args)
+    if args.variant_matching == 'position':
+        model_rsids = match_variants_by_position(args.bgens_dir, args.bgens_prefix, args.weights_file, unique_rsids, args, open_genotypes=open_genotypes)
+        get_applications_of = MatchedApplicationsOf(get_applications_of, model_rsids)
+        unique_rsids = sorted(model_rsids)
+        if len(unique_rsids) == 0:
+            print('No model SNPs match the genotype variants by position. Exit!')
+            remove_output()
+            sys.exit()
+
+    if args.min_info is not None or args.min_maf is not None:
+        unique_rsids = filter_variants_by_qc(args.bgens_dir, args.bgens_prefix, unique_rsids, args)
+        if len(unique_rsids) == 0:
+            print('No model SNPs pass --min-info/--min-maf. Exit!')
+            remove_output()
+            sys.exit()
+
+    if args.dry_run:
+        remove_output()
+        n_samples = len(sample_idxs) if sample_idxs is not None else sum(1 for _ in transcription_matrix.get_samples())
+        dry_run(args.bgens_dir, args.bgens_prefix, unique_rsids, get_applications_of, len(transcription_matrix.get_gene_list(desired_gene_list)),
+                sample_idxs, n_samples, args, open_genotypes=open_genotypes)
+        return
+
+    from tqdm import tqdm
+    from covariance import GeneCovariance
+    from bgen.bgen_reader import from_fixed_point
+
+    covariance = None
+    if args.covariance_output is not None:
+        check_out_file(args.covariance_output)
+        covariance = GeneCovariance(get_applications_of, args.covariance_output, desired_gene_list,
+                                    model_rsids=model_rsids if args.variant_matching == 'position' else None)
+
+    gene_result_cache, cache_keys, cached_rows = None, {}, {}
+    if args.result_cache_dir is not None:
+        from result_cache import GeneResultCache
+        gene_result_cache = GeneResultCache(args.result_cache_dir, args.result_cache_max_mb * (1024 ** 2))
+        samples = [sample[0] for sample in transcription_matrix.get_samples()]
+        cache_keys = get_result_cache_keys(args.bgens_dir, args.bgens_prefix, args.weights_file, transcription_matrix.get_gene_list(desired_gene_list), samples, args)
+        # covariances need the dosages of every model SNP, so cached rows are only stored
+        if covariance is None:
+            found = gene_result_cache.get(cache_keys.values(), len(samples))
+            cached_rows = {gene: found[key] for gene, key in cache_keys.items() if key in found and (found[key][1] is not None or not args.gene_stats)}
+        print("{} {} of {} genes found in the result cache".format(datetime.datetime.now(), len(cached_rows), len(cache_keys)))
+
+    if cached_rows:
+        # only the model SNPs of the other genes are decoded
+        get_applications_of = ApplicationsExcept(get_applications_of, cached_rows)
+        missed_genes = set(cache_keys) - set(cached_rows)
+        unique_rsids = [rsid for rsid in unique_rsids if any(tup[0] in missed_genes for tup in get_applications_of(rsid))]
+
+    # with --n-compression-threads, the genes without SNPs must be counted as finished in their blocks
+    if args.swmr or cached_rows or args.n_compression_threads > 0 or args.append_samples:
+        n_samples = len(sample_idxs) if sample_idxs is not None else sum(1 for _ in transcription_matrix.get_samples())
+        transcription_matrix.create_output(n_samples, args.max_gene_chunk_size, args.max_sample_chunk_size, desired_gene_list)
+    for gene, (row, n_snps_used, sum_weights_used) in cached_rows.items():
+        transcription_matrix.set_row(gene, row, n_snps_used, sum_weights_used)
+    transcription_matrix.finish_genes(list(cached_rows))
+
+    genes_last_variant = get_genes_last_variant(args.bgens_dir, args.bgens_prefix, unique_rsids, get_applications_of, args, open_genotypes=open_genotypes) if unique_rsids else {}
+    gene_window = GeneWindow(transcription_matrix.get_gene_list(desired_gene_list), genes_last_variant)
+    # genes without any SNP in the genotype files are already complete
+    transcription_matrix.finish_genes(gene_window.unused_genes)
+
+    # variants are applied in batches of --bgens-n-cache; genes passed by the stream are finished once the batch
+    # holding their last SNPs was applied
+    # batches never span genotype files, so all the dosages of a batch have the same scale
+    batch_dosages, batch_applications, passed_genes, batch_scale = [], [], [], [None]
+
+    def apply_batch():
+        if batch_dosages:
+            transcription_matrix.update_batch(np.vstack(batch_dosages), batch_applications, args.max_gene_chunk_size, args.max_sample_chunk_size, desired_gene_list,
+                                              dosage_scale=batch_scale[0])
+            del batch_dosages[:]
+            del batch_applications[:]
+        transcription_matrix.finish_genes(passed_genes)
+        del passed_genes[:]
+
+    def on_file_done(file_idx):
+        passed_genes.extend(gene_window.file_done(file_idx))
+        apply_batch()
+
+    all_dosages = get_all_dosages_from_bgen(args.bgens_dir, args.bgens_prefix, unique_rsids, args, open_genotypes=open_genotypes, sample_idxs=sample_idxs, on_file_done=on_file_done) if unique_rsids else []
     
-    for rsid, allele, dosage_row in tqdm(all_dosages, total=len(unique_rsids), disable=args.no_progress_bar):
-        for gene, weight, ref_allele in get_applications_of(rsid):
-            transcription_matrix.update(gene, weight, ref_allele, allele, dosage_row, args.max_gene_chunk_size, args.max_sample_chunk_size, desired_gene_list)
+    for chromosome, position, rsid, allele, dosage_row, dosage_scale in tqdm(all_dosages, total=len(unique_rsids), disable=args.no_progress_bar):
+        passed_genes.extend(gene_window.passed(position))
+
+        applications = list(get_applications_of(rsid))
+        if applications:
+            batch_applications.extend((gene, weight, ref_allele, allele, len(batch_dosages)) for gene, weight, ref_allele in applications)
+            batch_dosages.append(dosage_row)
+            batch_scale[0] = dosage_scale
 
+        if covariance is not None:
+            covariance.update(chromosome, rsid, allele, from_fixed_point(dosage_row) if dosage_scale is not None else dosage_row)
 
+        if len(batch_dosages) >= args.bgens_n_cache:
+            apply_batch()
+
+    apply_batch()
+
+    if transcription_matrix.D is None:
+        # none of the model SNPs was found in the genotype files
+        n_samples = len(sample_idxs) if sample_idxs is not None else sum(1 for _ in transcription_matrix.get_samples())
+        transcription_matrix.create_output(n_samples, args.max_gene_chunk_size, args.max_sample_chunk_size, desired_gene_list)
     transcription_matrix.save()
 
+    if args.text_output is not None:
+        transcription_matrix.write_text(args.text_output, args.text_output_n_threads)
+
+    if gene_result_cache is not None:
+        store_in_result_cache(gene_result_cache, transcription_matrix.output_binary_file, {gene: key for gene, key in cache_keys.items() if gene not in cached_rows},
+                              first_sample=transcription_matrix.first_sample)
+        gene_result_cache.close()
+
+    if covariance is not None:
+        covariance.save()
+
+if __name__ == '__main__':
+    run(get_argument_parser().parse_args())
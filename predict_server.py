@@ -0,0 +1,255 @@
+import os
+import sys
+import copy
+import json
+import argparse
+import datetime
+import threading
+import socketserver
+import socket
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import predict
+
+
+class ModelCache:
+    """
+    Keeps the weights of the most recently used models loaded (GetApplicationsOf preloads all of them), evicting the
+    least recently used one when more than max_models are cached. A model is reloaded if its file changed.
+    """
+    def __init__(self, max_models=8):
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, weights_file):
+        key = os.path.abspath(weights_file)
+        mtime = os.path.getmtime(key)
+
+        with self.lock:
+            if key in self.models and self.models[key][0] == mtime:
+                self.models.move_to_end(key)
+                return self.models[key][1]
+
+            get_applications_of = predict.GetApplicationsOf(key, True)
+            self.models[key] = (mtime, get_applications_of)
+            self.models.move_to_end(key)
+            while len(self.models) > self.max_models:
+                evicted, _ = self.models.popitem(last=False)
+                print("{} Evicted model {}".format(datetime.datetime.now(), evicted))
+
+            return get_applications_of
+
+    def keys(self):
+        with self.lock:
+            return list(self.models.keys())
+
+
+class GenotypeCache:
+    """
+    Keeps the most recently used genotype files open (with the index information read when opening them), evicting
+    the least recently used one when more than max_files are cached. An evicted file is closed right away, or once
+    the last job using it releases it (see release).
+    """
+    def __init__(self, max_files=64):
+        self.max_files = max_files
+        # key -> [opened genotype file, number of running jobs using it]
+        self.genotypes = OrderedDict()
+        # evicted entries still used by running jobs
+        self.evicted = []
+        self.lock = threading.Lock()
+
+    def open(self, backend, genotype_path, job_entries=None, **kwargs):
+        """
+        :param job_entries: list of the entries used by the calling job, to which the opened file is added; the job
+        releases them when it is done. Without it, the file may be closed as soon as it is evicted.
+        """
+        key = (backend, genotype_path, tuple(sorted(kwargs.items())))
+        with self.lock:
+            if key not in self.genotypes:
+                self.genotypes[key] = [predict.open_genotypes(backend, genotype_path, **kwargs), 0]
+            self.genotypes.move_to_end(key)
+            entry = self.genotypes[key]
+            if job_entries is not None and not any(x is entry for x in job_entries):
+                entry[1] += 1
+                job_entries.append(entry)
+            while len(self.genotypes) > self.max_files:
+                (_, evicted, _), evicted_entry = self.genotypes.popitem(last=False)
+                print("{} Evicted genotype file {}".format(datetime.datetime.now(), evicted))
+                if evicted_entry[1] > 0:
+                    self.evicted.append(evicted_entry)
+                else:
+                    evicted_entry[0].close()
+
+            return entry[0]
+
+    def release(self, job_entries):
+        """
+        Releases the entries used by a finished job, closing the evicted ones no other job uses.
+        """
+        with self.lock:
+            for entry in job_entries:
+                entry[1] -= 1
+                if entry[1] == 0 and any(x is entry for x in self.evicted):
+                    self.evicted = [x for x in self.evicted if x is not entry]
+                    entry[0].close()
+
+
+class PredictionServer:
+    def __init__(self, args):
+        self.args = args
+        self.models = ModelCache(args.max_cached_models)
+        self.genotypes = GenotypeCache(args.max_cached_genotype_files)
+        self.pool = ThreadPoolExecutor(max_workers=args.n_workers)
+
+    def run_job(self, job):
+        """
+        Runs one prediction job: a dict with 'weights_file' and 'output_file', and optionally 'gene_list' and
+        'keep_samples' (paths to files with one gene or sample ID per row), 'covariance_output', 'swmr',
+        'gene_stats', 'scratch_dir', 'result_cache_dir', 'result_cache_max_mb', 'text_output',
+        'text_output_n_threads' and 'append_samples'.
+        """
+        args = copy.copy(self.args)
+        args.weights_file = job['weights_file']
+        args.output_file = job['output_file']
+        args.gene_list = job.get('gene_list')
+        args.keep_samples = job.get('keep_samples')
+        args.covariance_output = job.get('covariance_output')
+        args.swmr = job.get('swmr', False)
+        args.gene_stats = job.get('gene_stats', False)
+        args.scratch_dir = job.get('scratch_dir')
+        args.result_cache_dir = job.get('result_cache_dir')
+        args.result_cache_max_mb = job.get('result_cache_max_mb', 10240)
+        args.text_output = job.get('text_output')
+        args.text_output_n_threads = job.get('text_output_n_threads', 1)
+        args.dry_run = False
+        args.partial_output = False
+        args.append_samples = job.get('append_samples', False)
+        args.no_progress_bar = True
+
+        print("{} Running job {}".format(datetime.datetime.now(), json.dumps(job)))
+        job_entries = []
+
+        def open_genotypes(backend, genotype_path, **kwargs):
+            return self.genotypes.open(backend, genotype_path, job_entries, **kwargs)
+
+        try:
+            predict.run(args, get_applications_of=self.models.get(args.weights_file), open_genotypes=open_genotypes)
+        except SystemExit as e:
+            if e.code:
+                return {'status': 'failed', 'output_file': args.output_file, 'error': 'exit code {}'.format(e.code)}
+            if not os.path.isfile(args.output_file):
+                return {'status': 'failed', 'output_file': args.output_file, 'error': 'no genes to predict'}
+        except Exception:
+            return {'status': 'failed', 'output_file': args.output_file, 'error': traceback.format_exc()}
+        finally:
+            self.genotypes.release(job_entries)
+
+        return {'status': 'done', 'output_file': args.output_file}
+
+    def submit(self, job):
+        return self.pool.submit(self.run_job, job)
+
+    def status(self):
+        return {'status': 'running', 'cached_models': self.models.keys(), 'n_workers': self.args.n_workers}
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+        except ValueError as e:
+            response = {'status': 'failed', 'error': 'invalid request: {}'.format(e)}
+        else:
+            if request.get('command') == 'status':
+                response = self.server.prediction_server.status()
+            elif 'weights_file' not in request or 'output_file' not in request:
+                response = {'status': 'failed', 'error': 'jobs need weights_file and output_file'}
+            else:
+                response = self.server.prediction_server.submit(request).result()
+
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    prediction_server = PredictionServer(args)
+    with _UnixServer(args.socket, _JobHandler) as server:
+        server.prediction_server = prediction_server
+        print("{} Listening on {}".format(datetime.datetime.now(), args.socket))
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(args.socket)
+
+
+def submit(socket_path, job):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(job) + '\n').encode())
+        with conn.makefile('r') as f:
+            return json.loads(f.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keeps models and BGEN indexes loaded and runs prediction jobs sent "
+                                                 "through a Unix socket. Use --submit to send a job.")
+    parser.add_argument('--socket', required=True, help="Path of the Unix socket to listen on (or to submit to).")
+    parser.add_argument('--submit', action="store_true", help="Submit a job to a running server and wait for it to finish.")
+    parser.add_argument('--status', action="store_true", help="Print the status of a running server.")
+
+    job_args = parser.add_argument_group('job (with --submit)')
+    job_args.add_argument('--weights-file', help="SQLite database with rsid weights.")
+    job_args.add_argument('--output-file', help="Predicted expression output file.")
+    job_args.add_argument('--gene-list', default=None, help="a list of gene to work with (one gene per row without header)")
+    job_args.add_argument('--keep-samples', default=None, help="a list of sample IDs to predict for (one ID per row without header)")
+    job_args.add_argument('--covariance-output', default=None, help="Also write the covariance of each gene's model SNPs here.")
+    job_args.add_argument('--swmr', action="store_true", help="Write the output in HDF5 single-writer/multiple-reader mode.")
+    job_args.add_argument('--gene-stats', action="store_true", help="Also write per-gene summary statistics to the output.")
+    job_args.add_argument('--scratch-dir', default=None, help="Accumulate predicted expression in a memory-mapped scratch file in this directory.")
+    job_args.add_argument('--result-cache-dir', default=None, help="Serve genes from, and add predicted genes to, a local result cache in this directory.")
+    job_args.add_argument('--result-cache-max-mb', type=int, default=10240, help="Maximum size of the result cache in MB. Default: 10240")
+    job_args.add_argument('--text-output', default=None, help="Also write the predicted expression as text (FID, IID and one column per gene).")
+    job_args.add_argument('--text-output-n-threads', type=int, default=1, help="Number of threads formatting and compressing --text-output. Default: 1")
+    job_args.add_argument('--append-samples', action="store_true", help="Add the samples of the genotype files to an existing --output-file predicted with the same weights and genes.")
+
+    if '--submit' in sys.argv or '--status' in sys.argv:
+        args = parser.parse_args()
+        if args.status:
+            response = submit(args.socket, {'command': 'status'})
+        else:
+            if args.weights_file is None or args.output_file is None:
+                parser.error("--submit needs --weights-file and --output-file")
+            response = submit(args.socket, {
+                'weights_file': os.path.abspath(args.weights_file),
+                'output_file': os.path.abspath(args.output_file),
+                'gene_list': os.path.abspath(args.gene_list) if args.gene_list else None,
+                'keep_samples': os.path.abspath(args.keep_samples) if args.keep_samples else None,
+                'covariance_output': os.path.abspath(args.covariance_output) if args.covariance_output else None,
+                'swmr': args.swmr,
+                'gene_stats': args.gene_stats,
+                'scratch_dir': os.path.abspath(args.scratch_dir) if args.scratch_dir else None,
+                'result_cache_dir': os.path.abspath(args.result_cache_dir) if args.result_cache_dir else None,
+                'result_cache_max_mb': args.result_cache_max_mb,
+                'text_output': os.path.abspath(args.text_output) if args.text_output else None,
+                'text_output_n_threads': args.text_output_n_threads,
+                'append_samples': args.append_samples,
+            })
+        print(json.dumps(response, indent=2))
+        sys.exit(0 if response.get('status') != 'failed' else 1)
+
+    server_args = parser.add_argument_group('server')
+    server_args.add_argument('--n-workers', type=int, default=1, help="Number of jobs run at the same time. Default: 1")
+    server_args.add_argument('--max-cached-models', type=int, default=8, help="Number of models kept loaded. Default: 8")
+    server_args.add_argument('--max-cached-genotype-files', type=int, default=64, help="Number of genotype files kept open. Default: 64")
+    predict.add_genotype_arguments(server_args)
+
+    serve(parser.parse_args())
@@ -0,0 +1,95 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def coalesce(ranges):
+    """
+    Merges (offset, length) byte ranges that are adjacent or overlapping, once sorted by offset.
+    """
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset, last_length = merged[-1]
+            merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def advise_willneed(fd, ranges):
+    """
+    Asks the kernel to start reading the given (offset, length) byte ranges of fd into the page cache, without
+    waiting for them. A length of 0 means up to the end of the file. Does nothing where posix_fadvise is missing.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for offset, length in coalesce(ranges):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+
+def advise_file(path):
+    """
+    Read-ahead hint for a whole file, such as a genotype index.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        advise_willneed(fd, [(0, 0)])
+    finally:
+        os.close(fd)
+
+
+def read_ahead(batches, get_ranges, fd, depth=2, max_bytes=256 * 1024 ** 2):
+    """
+    Yields the batches of an iterator while the byte ranges of the following ones are being read by the kernel: up to
+    depth batches ahead, and at most max_bytes ahead (at least one batch is always read ahead).
+    :param get_ranges: function returning the (offset, length) byte ranges of fd that a batch will read.
+    """
+    if depth <= 0 or fd is None:
+        for batch in batches:
+            yield batch
+        return
+
+    batches = iter(batches)
+    pending = deque()
+    pending_bytes = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) <= depth and (len(pending) < 2 or pending_bytes < max_bytes):
+            try:
+                batch = next(batches)
+            except StopIteration:
+                exhausted = True
+                break
+            ranges = get_ranges(batch)
+            advise_willneed(fd, ranges)
+            n_bytes = sum(length for _, length in ranges)
+            pending.append((batch, n_bytes))
+            pending_bytes += n_bytes
+
+        if not pending:
+            return
+        batch, n_bytes = pending.popleft()
+        pending_bytes -= n_bytes
+        yield batch
+
+
+def open_ahead(open_file, items, enabled=True):
+    """
+    Yields open_file(item) for each item. If enabled, the next item is opened by a background thread while the
+    current one is being used, so that opening a genotype file and reading its index overlap with computing.
+    """
+    if not enabled:
+        for item in items:
+            yield open_file(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(open_file, items[0]) if items else None
+        for idx in range(len(items)):
+            opened = future.result()
+            future = executor.submit(open_file, items[idx + 1]) if idx + 1 < len(items) else None
+            yield opened
+            del opened
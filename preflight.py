@@ -0,0 +1,85 @@
+import os
+import struct
+import sqlite3
+from collections import defaultdict
+
+
+def genotype_samples_count(backend, genotype_path):
+    """
+    Number of samples of a genotype file, read from the BGEN or VCF header or from the .fam/.psam file of PLINK
+    filesets.
+    """
+    if backend == 'bgen':
+        with open(genotype_path, 'rb') as f:
+            return struct.unpack('<IIII', f.read(16))[3]
+    if backend == 'vcf':
+        from vcf.vcf_dosage import read_vcf_header
+        return len(read_vcf_header(genotype_path)[1])
+
+    prefix = os.path.splitext(genotype_path)[0]
+    sample_path = prefix + ('.fam' if backend == 'bed' else '.psam')
+    with open(sample_path, 'r') as f:
+        return sum(1 for line in f if line.strip() and not line.startswith('#'))
+
+
+def bytes_to_read(backend, genotype_path, bgi_path, include_rsid, n_variants, n_samples):
+    """
+    Estimated number of bytes read from a genotype file to decode the variants with rsids in include_rsid.
+    """
+    if backend == 'bgen':
+        stm = 'select sum(size_in_bytes) from Variant where rsid in ({})'.format(', '.join(["'{}'".format(x) for x in include_rsid]))
+        with sqlite3.connect(bgi_path) as conn:
+            return conn.execute(stm).fetchone()[0] or 0
+    if backend == 'bed':
+        return n_variants * ((n_samples + 3) // 4)
+    if backend == 'vcf':
+        # imputation server fields (GT:DS:HDS:GP, about 20 characters) compress to about 4 bytes per sample
+        return n_variants * n_samples * 4
+    # .pgen: dosages take up to two bytes per sample
+    return n_variants * n_samples * 2
+
+
+def peak_active_genes(variant_positions_by_file, get_applications_of):
+    """
+    Largest number of genes whose model SNPs span the current position of the genotype stream, which is the number
+    of gene rows held in memory at a time (see predict.GeneWindow).
+    :param variant_positions_by_file: list with the (rsid, position) of the model SNPs of each genotype file.
+    """
+    peak = 0
+    for variant_positions in variant_positions_by_file:
+        first, last = {}, {}
+        for rsid, position in variant_positions:
+            for gene, _, _ in get_applications_of(rsid):
+                first[gene] = min(first.get(gene, position), position)
+                last[gene] = max(last.get(gene, position), position)
+
+        positions = [position for _, position in variant_positions]
+        if any(positions[i] > positions[i + 1] for i in range(len(positions) - 1)):
+            # genes of files not sorted by position are only finished at the end of the file
+            peak = max(peak, len(first))
+            continue
+
+        # +1 when a gene starts, -1 once its last SNP was passed
+        events = defaultdict(int)
+        for gene in first:
+            events[first[gene]] += 1
+            events[last[gene] + 1] -= 1
+        active = 0
+        for position in sorted(events):
+            active += events[position]
+            peak = max(peak, active)
+    return peak
+
+
+def format_bytes(n_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n_bytes < 1024:
+            return '{:.1f} {}'.format(n_bytes, unit)
+        n_bytes /= 1024.0
+    return '{:.1f} TB'.format(n_bytes)
+
+
+def format_seconds(seconds):
+    hours, seconds = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '{}h {:02d}m {:02d}s'.format(hours, minutes, seconds)
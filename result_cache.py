@@ -0,0 +1,137 @@
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+
+
+def weight_fingerprints(weights_file, genes=None):
+    """
+    Hash of the weights table rows of each gene (all columns, in a stable order), so that any change in a gene's model
+    changes its fingerprint.
+    :return: dict of gene -> hex digest.
+    """
+    with sqlite3.connect(weights_file) as conn:
+        cursor = conn.execute("SELECT * FROM weights")
+        gene_column = [column[0] for column in cursor.description].index('gene')
+        gene_rows = defaultdict(list)
+        for row in cursor:
+            gene_rows[row[gene_column]].append(repr(row))
+
+    genes = gene_rows.keys() if genes is None else genes
+    return {gene: hashlib.sha1('\n'.join(sorted(gene_rows.get(gene, []))).encode()).hexdigest() for gene in genes}
+
+
+def genotype_identity(genotype_dir, genotype_files, options):
+    """
+    Hash of the genotype files (path, size and modification time, with the variant table of PLINK filesets) and of the
+    options that change the decoded dosages.
+    :param options: dict of option name -> value.
+    """
+    identity = []
+    for genotype_file in genotype_files:
+        path = os.path.abspath(os.path.join(genotype_dir, genotype_file))
+        prefix = os.path.splitext(path)[0]
+        for file_path in [path] + [prefix + extension for extension in ('.bim', '.pvar') if os.path.isfile(prefix + extension)]:
+            stat = os.stat(file_path)
+            identity.append('{}:{}:{}'.format(file_path, stat.st_size, stat.st_mtime_ns))
+    identity.extend('{}={!r}'.format(name, options[name]) for name in sorted(options))
+    return hashlib.sha1('\n'.join(identity).encode()).hexdigest()
+
+
+def sample_set_hash(samples):
+    """
+    Hash of the sample IDs of the output, in order.
+    """
+    return hashlib.sha1('\n'.join(str(sample) for sample in samples).encode()).hexdigest()
+
+
+def gene_keys(fingerprints, genotype_hash, sample_hash):
+    """
+    :return: dict of gene -> cache key.
+    """
+    return {gene: hashlib.sha1('{}|{}|{}'.format(fingerprint, genotype_hash, sample_hash).encode()).hexdigest()
+            for gene, fingerprint in fingerprints.items()}
+
+
+class GeneResultCache:
+    """
+    Local cache of finished gene rows of predicted expression, looked up by content keys (see gene_keys): a changed
+    model, genotype file or sample set gives new keys, so stale rows are never served. Rows are stored as
+    zlib-compressed float32 blobs, with the gene statistics of the run that computed them, in a SQLite file shared by
+    all runs using the same cache directory. The least recently used rows are evicted when the stored rows exceed
+    max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, 'gene_results.db')
+        self.max_bytes = int(max_bytes)
+        self.conn = sqlite3.connect(self.path, timeout=600)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS gene_rows
+                ( "key" TEXT PRIMARY KEY,
+                  "row" BLOB,
+                  "n_bytes" INTEGER,
+                  "n_snps_used" INTEGER,
+                  "sum_weights_used" REAL,
+                  "last_used" REAL
+                );
+            """)
+            self.conn.execute('CREATE INDEX IF NOT EXISTS gene_rows_last_used ON gene_rows (last_used)')
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, keys, n_samples):
+        """
+        Returns the cached rows of the given keys, and marks them as used.
+        :return: dict of key -> (float32 row, n_snps_used, sum_weights_used), for the keys found only (the statistics
+        are None if the run that stored the row did not compute them).
+        """
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            stm = 'SELECT key, row, n_snps_used, sum_weights_used FROM gene_rows WHERE key IN ({})'.format(', '.join('?' * len(batch)))
+            for key, blob, n_snps_used, sum_weights_used in self.conn.execute(stm, batch):
+                row = np.frombuffer(zlib.decompress(blob), dtype=np.float32)
+                if len(row) == n_samples:
+                    found[key] = (row, n_snps_used, sum_weights_used)
+
+        with self.conn:
+            now = time.time()
+            self.conn.executemany('UPDATE gene_rows SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+        return found
+
+    def put(self, entries):
+        """
+        Stores rows, then evicts the least recently used ones above max_bytes.
+        :param entries: iterable of (key, row, n_snps_used, sum_weights_used); the statistics are None if they were not
+        computed.
+        """
+        now = time.time()
+        records = []
+        for key, row, n_snps_used, sum_weights_used in entries:
+            blob = zlib.compress(np.ascontiguousarray(row, dtype=np.float32).tobytes(), 1)
+            records.append((key, sqlite3.Binary(blob), len(blob), n_snps_used, sum_weights_used, now))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO gene_rows VALUES (?, ?, ?, ?, ?, ?)', records)
+        self.evict()
+
+    def evict(self):
+        with self.conn:
+            total_bytes = self.conn.execute('SELECT COALESCE(SUM(n_bytes), 0) FROM gene_rows').fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return
+            to_delete = []
+            for key, n_bytes in self.conn.execute('SELECT key, n_bytes FROM gene_rows ORDER BY last_used ASC'):
+                if total_bytes <= self.max_bytes:
+                    break
+                to_delete.append((key,))
+                total_bytes -= n_bytes
+            self.conn.executemany('DELETE FROM gene_rows WHERE key = ?', to_delete)
@@ -1,9 +1,16 @@
+import os
+import gc
+import sys
+import shutil
+import struct
+import tempfile
 import unittest
 from time import time
 
 import numpy as np
 
 from bgen.bgen_dosage import BGENDosage
+from bgen.bgen_reader import BGENReader, FIXED_POINT_MISSING, from_fixed_point
 from tests.utils import get_repository_path, truncate
 
 
@@ -378,3 +385,195 @@ class BGENDosageTest(unittest.TestCase):
         assert all_items[rsid_idx].dosages.shape == (300,)
         assert truncate(all_items[rsid_idx].dosages[1]) == truncate(np.dot([0.01371, 0.09542, 0.89091], [0, 1, 2])) == 1.8772, truncate(all_items[rsid_idx].dosages[1])
         assert truncate(all_items[rsid_idx].dosages[2]) == truncate(np.dot([0.07391, 0.09607, 0.83011], [0, 1, 2])) == 1.7562, truncate(all_items[rsid_idx].dosages[2])
+
+    def test_native_get_first_row(self):
+        # Prepare
+        bgen_dosage = BGENDosage(get_repository_path('set00/chr1impv1.bgen'), decoder='native')
+
+        # Run
+        dosage_row = bgen_dosage.get_row(0)
+
+        assert dosage_row.chr == 1
+        assert dosage_row.rsid == 'rs1'
+        assert dosage_row.position == 100
+        assert dosage_row.allele0 == 'G'
+        assert dosage_row.allele1 == 'A'
+        assert dosage_row.dosages.shape == (300,)
+
+        assert round(dosage_row.dosages[0], 4) == round(np.dot([0.74909, 0.01333, 0.23758], [0, 1, 2]), 4) == 0.4885, dosage_row.dosages[0]
+        assert round(dosage_row.dosages[2], 4) == round(np.dot([0.05437, 0.91567, 0.02996], [0, 1, 2]), 4) == 0.9756, dosage_row.dosages[2]
+        assert round(dosage_row.dosages[3], 4) == round(np.dot([0.00650, 0.02577, 0.96773], [0, 1, 2]), 4) == 1.9612, dosage_row.dosages[3]
+
+    def test_native_get_iterator_multithreaded(self):
+        # Prepare
+        bgen_dosage = BGENDosage(get_repository_path('set00/chr2impv1.bgen'), decoder='native', n_threads=4)
+
+        # Run
+        all_items = list(bgen_dosage.items(n_rows_cached=10))
+        assert len(all_items) == 150
+
+        # snp 1
+        assert all_items[0].chr == 2
+        assert all_items[0].position == 100
+        assert all_items[0].allele0 == 'A'
+        assert all_items[0].allele1 == 'G'
+        assert all_items[0].rsid == 'rs2000000'
+        assert all_items[0].dosages.shape == (300,)
+        assert truncate(all_items[0].dosages[0]) == truncate(np.dot([0.94401, 0.02976, 0.02623], [0, 1, 2])) == 0.0822
+        assert truncate(all_items[0].dosages[2]) == truncate(np.dot([0.00658, 0.92760, 0.06582], [0, 1, 2])) == 1.0592
+
+        # snp middle
+        assert all_items[99].rsid == 'rs2000099'
+        assert truncate(all_items[99].dosages[0]) == 1.1071
+        assert truncate(all_items[99].dosages[5]) == truncate(np.dot([0.04327, 0.89103, 0.06570], [0, 1, 2])) == 1.0224
+
+        # snp last
+        assert all_items[149].rsid == 'rs2000149'
+        assert truncate(all_items[149].dosages[1]) == 1.8772
+        assert truncate(all_items[149].dosages[2]) == 1.7562
+
+    def test_native_get_iterator_filter_by_rsid_repeated_positions(self):
+        # Prepare
+        bgen_dosage = BGENDosage(get_repository_path('set06_repeated_positions/chr2impv1.bgen'), decoder='native', n_threads=2)
+
+        # Run
+        all_items = list(bgen_dosage.items(n_rows_cached=2, include_rsid=['rs2000000', 'rs2000011']))
+        assert len(all_items) == 3
+
+        # variants with the same position are returned in file order
+        assert all_items[0].rsid == 'rs2000000'
+        assert all_items[0].allele0 == 'C'
+        assert truncate(all_items[0].dosages[0]) == truncate(np.dot([0.86648, 0.00133, 0.13219], [0, 1, 2])) == 0.2657
+
+        assert all_items[1].rsid == 'rs2000000'
+        assert all_items[1].allele0 == 'A'
+        assert truncate(all_items[1].dosages[0]) == truncate(np.dot([0.02759, 0.17211, 0.80030], [0, 1, 2])) == 1.7727
+
+        assert all_items[2].rsid == 'rs2000011'
+        assert truncate(all_items[2].dosages[19]) == truncate(np.dot([0.11567, 0.05896, 0.82537], [0, 1, 2])) == 1.7097
+
+    def test_native_fixed_point_dosages(self):
+        # Prepare
+        float_items = list(BGENDosage(get_repository_path('set00/chr2impv1.bgen'), decoder='native').items(n_rows_cached=20))
+
+        # Run
+        bgen_dosage = BGENDosage(get_repository_path('set00/chr2impv1.bgen'), decoder='native', fixed_point=True)
+        fixed_items = list(bgen_dosage.items(n_rows_cached=20))
+
+        # Validate
+        assert len(fixed_items) == len(float_items) == 150
+        assert fixed_items[0].dosages.dtype == np.dtype('uint16')
+        for float_item, fixed_item in zip(float_items, fixed_items):
+            assert fixed_item.rsid == float_item.rsid
+            assert np.abs(fixed_item.dosages * bgen_dosage.dosage_scale - float_item.dosages).max() < 2e-5
+
+        assert truncate(fixed_items[0].dosages[0] * bgen_dosage.dosage_scale) == 0.0822
+
+    def test_native_missing_samples_in_both_modes(self):
+        # Prepare
+        reader = BGENReader.__new__(BGENReader)
+        reader.layout, reader.samples_count = 2, 3
+        # unphased diploid 8-bit probabilities; the second sample is missing (ploidy byte with bit 128 set)
+        probs = [[255, 0], [0, 0], [64, 128]]
+        data = struct.pack('<IHBB', 3, 2, 2, 2) + bytes([2, 2 | 128, 2]) + bytes([0, 8]) + bytes(x for pair in probs for x in pair)
+
+        # Run
+        float_dosages = reader.decode_dosages(data, np.empty(3))
+        fixed_dosages = reader.decode_dosages(data, np.empty(3, dtype=np.uint16))
+
+        # Validate
+        assert np.isnan(float_dosages[1])
+        assert fixed_dosages[1] == FIXED_POINT_MISSING
+        assert np.allclose(from_fixed_point(fixed_dosages), float_dosages, atol=2e-5, equal_nan=True)
+
+    def test_native_unsupported_layout(self):
+        # Prepare
+        bgen_path = os.path.join(tempfile.mkdtemp(), 'layout3.bgen')
+        with open(bgen_path, 'wb') as f:
+            # header block of 20 bytes, with layout 3 in the flags
+            f.write(struct.pack('<IIII', 24, 20, 0, 0) + b'bgen' + struct.pack('<I', 3 << 2))
+        unraisable = []
+        sys.unraisablehook, previous_hook = unraisable.append, sys.unraisablehook
+
+        # Run
+        try:
+            with self.assertRaises(ValueError):
+                BGENReader(bgen_path)
+            gc.collect()
+        finally:
+            sys.unraisablehook = previous_hook
+
+        # Validate
+        # the half-initialized reader is deleted without errors
+        assert unraisable == []
+
+    def test_native_unpack_any_number_of_bits(self):
+        # Prepare
+        bits = 10
+        values = np.array([0, 1, 1023, 512, 77, 300, 1000])
+        packed_bits = np.array([(v >> b) & 1 for v in values for b in range(bits)], dtype=np.uint8)
+        packed = np.packbits(np.concatenate((packed_bits, np.zeros(-len(packed_bits) % 8, dtype=np.uint8))).reshape(-1, 8)[:, ::-1])
+
+        # Run
+        unpacked = BGENReader._unpack(b'xx' + packed.tobytes(), 2, len(values), bits)
+
+        # Validate
+        assert np.allclose(unpacked, values / 1023.0)
+
+    def test_native_get_iterator_sample_subset(self):
+        # Prepare
+        all_items = list(BGENDosage(get_repository_path('set00/chr2impv1.bgen'), decoder='native').items(n_rows_cached=10))
+        sample_idxs = np.array([2, 0, 299])
+
+        # Run
+        bgen_dosage = BGENDosage(get_repository_path('set00/chr2impv1.bgen'), decoder='native')
+        subset_items = list(bgen_dosage.items(n_rows_cached=10, sample_idxs=sample_idxs))
+
+        # Validate
+        assert len(subset_items) == 150
+        for item, subset_item in zip(all_items, subset_items):
+            assert subset_item.dosages.shape == (3,)
+            assert np.array_equal(subset_item.dosages, item.dosages[sample_idxs])
+
+    def test_native_bgi_sidecar(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        for filename in ('chr2impv1.bgen', 'chr2impv1.bgen.bgi'):
+            shutil.copy(get_repository_path('set00/' + filename), tmpdir)
+        bgen_path = os.path.join(tmpdir, 'chr2impv1.bgen')
+        include_rsid = ['rs2000149', 'rs2000003', 'rs2000004', 'rs_missing']
+        sqlite_items = list(BGENDosage(bgen_path, decoder='native').items(n_rows_cached=2, include_rsid=include_rsid))
+
+        # Run
+        bgen_dosage = BGENDosage(bgen_path, decoder='native', bgi_sidecar=True)
+        sidecar_items = list(bgen_dosage.items(n_rows_cached=2, include_rsid=include_rsid))
+
+        # Validate
+        assert os.path.isfile(bgen_path + '.bgi.npy')
+        assert bgen_dosage.variants_count == 150
+        assert bgen_dosage.chr_number == '02'
+        assert [x.rsid for x in sidecar_items] == [x.rsid for x in sqlite_items] == ['rs2000003', 'rs2000004', 'rs2000149']
+        for sqlite_item, sidecar_item in zip(sqlite_items, sidecar_items):
+            assert np.array_equal(sqlite_item.dosages, sidecar_item.dosages)
+        assert bgen_dosage.variant_positions(include_rsid) == BGENDosage(bgen_path, decoder='native').variant_positions(include_rsid)
+
+        # a changed index invalidates the sidecar
+        stat = os.stat(bgen_path + '.bgi')
+        os.utime(bgen_path + '.bgi', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        sidecar_mtime = os.stat(bgen_path + '.bgi.npy').st_mtime_ns
+        assert BGENDosage(bgen_path, decoder='native', bgi_sidecar=True).variants_count == 150
+        assert os.stat(bgen_path + '.bgi.npy').st_mtime_ns != sidecar_mtime
+
+    def test_native_get_iterator_with_read_ahead(self):
+        # Prepare
+        bgen_path = get_repository_path('set00/chr2impv1.bgen')
+        all_items = list(BGENDosage(bgen_path, decoder='native').items(n_rows_cached=7))
+
+        # Run
+        bgen_dosage = BGENDosage(bgen_path, decoder='native', n_threads=2, prefetch_depth=3, prefetch_max_bytes=20000)
+        read_ahead_items = list(bgen_dosage.items(n_rows_cached=7))
+
+        # Validate
+        assert [x.rsid for x in read_ahead_items] == [x.rsid for x in all_items]
+        for item, read_ahead_item in zip(all_items, read_ahead_items):
+            assert np.array_equal(item.dosages, read_ahead_item.dosages)
@@ -0,0 +1,120 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from covariance import GeneCovariance
+
+
+class _Applications:
+    def __init__(self, tuples):
+        self.tuples = tuples
+
+    def __call__(self, rsid):
+        for tup in self.tuples.get(rsid, []):
+            yield tup
+
+
+def _read_covariance(path):
+    with gzip.open(path, 'rt') as f:
+        header = f.readline().split()
+        values = {}
+        for line in f:
+            gene, rsid1, rsid2, value = line.split()
+            values[(gene, rsid1, rsid2)] = float(value)
+    return header, values
+
+
+class GeneCovarianceTest(unittest.TestCase):
+    def test_covariance_of_model_snps(self):
+        # Prepare
+        output_file = os.path.join(tempfile.mkdtemp(), 'cov.txt.gz')
+        applications = _Applications({
+            'rs1': [('gene00', 0.3712, 'A'), ('gene01', 0.1, 'G')],
+            'rs2': [('gene00', 0.0807, 'C')],
+            'rs10': [('gene01', 0.6188, 'T')],
+        })
+        dosages = np.random.RandomState(0).uniform(0, 2, size=(3, 300))
+
+        # Run
+        covariance = GeneCovariance(applications, output_file, sample_block_size=64)
+        covariance.update(1, 'rs1', 'A', dosages[0])
+        covariance.update(1, 'rs2', 'C', dosages[1])
+        covariance.update(2, 'rs10', 'A', dosages[2])
+        covariance.save()
+
+        # Validate
+        header, values = _read_covariance(output_file)
+        assert header == ['GENE', 'RSID1', 'RSID2', 'VALUE']
+        assert len(values) == 5, values
+
+        expected = np.cov(dosages[:2])
+        assert round(values[('gene00', 'rs1', 'rs1')], 5) == round(expected[0, 0], 5)
+        assert round(values[('gene00', 'rs1', 'rs2')], 5) == round(expected[0, 1], 5)
+        assert round(values[('gene00', 'rs2', 'rs2')], 5) == round(expected[1, 1], 5)
+
+        assert round(values[('gene01', 'rs10', 'rs10')], 5) == round(np.var(dosages[2], ddof=1), 5)
+
+    def test_flipped_snp_changes_sign(self):
+        # Prepare
+        output_file = os.path.join(tempfile.mkdtemp(), 'cov.txt.gz')
+        applications = _Applications({
+            'rs1': [('gene00', 0.3712, 'A')],
+            'rs2': [('gene00', 0.0807, 'T')],
+        })
+        dosages = np.random.RandomState(1).uniform(0, 2, size=(2, 50))
+
+        # Run
+        covariance = GeneCovariance(applications, output_file)
+        covariance.update(1, 'rs1', 'A', dosages[0])
+        covariance.update(1, 'rs2', 'C', dosages[1])
+        covariance.save()
+
+        # Validate
+        _, values = _read_covariance(output_file)
+        assert round(values[('gene00', 'rs1', 'rs2')], 5) == round(-np.cov(dosages)[0, 1], 5)
+
+    def test_repeated_rsid_adds_up_its_variants(self):
+        # Prepare
+        output_file = os.path.join(tempfile.mkdtemp(), 'cov.txt.gz')
+        applications = _Applications({
+            'rs1': [('gene00', 0.3712, 'A')],
+            'rs2': [('gene00', 0.0807, 'C')],
+        })
+        dosages = np.random.RandomState(2).uniform(0, 2, size=(3, 80))
+
+        # Run
+        covariance = GeneCovariance(applications, output_file, sample_block_size=32)
+        covariance.update(1, 'rs1', 'A', dosages[0])
+        covariance.update(1, 'rs2', 'C', dosages[1])
+        covariance.update(1, 'rs2', 'T', dosages[2])
+        covariance.save()
+
+        # Validate
+        _, values = _read_covariance(output_file)
+        # the second variant of rs2 is flipped: it contributes (2 - dosage) to the predicted expression
+        expected = np.cov(np.vstack([dosages[0], dosages[1] + 2 - dosages[2]]))
+        assert len(values) == 3, values
+        assert round(values[('gene00', 'rs1', 'rs2')], 5) == round(expected[0, 1], 5)
+        assert round(values[('gene00', 'rs2', 'rs2')], 5) == round(expected[1, 1], 5)
+
+    def test_model_rsids_and_single_sample(self):
+        # Prepare
+        output_file = os.path.join(tempfile.mkdtemp(), 'cov.txt.gz')
+        applications = _Applications({
+            '1:100': [('gene00', 0.3712, 'A')],
+            '1:200': [('gene00', 0.0807, 'C')],
+        })
+
+        # Run
+        covariance = GeneCovariance(applications, output_file, model_rsids={'1:100': 'rs1', '1:200': 'rs2'})
+        covariance.update(1, '1:100', 'A', np.array([1.0]))
+        covariance.update(1, '1:200', 'C', np.array([0.5]))
+        covariance.save()
+
+        # Validate
+        _, values = _read_covariance(output_file)
+        assert sorted(values) == [('gene00', 'rs1', 'rs1'), ('gene00', 'rs1', 'rs2'), ('gene00', 'rs2', 'rs2')]
+        assert np.isnan(list(values.values())).all()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from plink.plink_dosage import BEDDosage
+
+
+def _create_bed(prefix, genotypes, rsids):
+    """
+    Writes a PLINK 1 fileset; genotypes is a (variants x samples) array of A1 allele counts, with -1 for missing.
+    """
+    n_variants, n_samples = genotypes.shape
+    codes = {2: 0b00, -1: 0b01, 1: 0b10, 0: 0b11}
+
+    with open(prefix + '.bed', 'wb') as f:
+        f.write(b'\x6c\x1b\x01')
+        for variant in genotypes:
+            packed = bytearray((n_samples + 3) // 4)
+            for sample_idx, genotype in enumerate(variant):
+                packed[sample_idx // 4] |= codes[genotype] << (2 * (sample_idx % 4))
+            f.write(bytes(packed))
+
+    with open(prefix + '.bim', 'w') as f:
+        for idx, rsid in enumerate(rsids):
+            f.write('1\t{}\t0\t{}\tA\tG\n'.format(rsid, 100 * (idx + 1)))
+
+    with open(prefix + '.fam', 'w') as f:
+        for sample_idx in range(n_samples):
+            f.write('{0} {0} 0 0 0 -9\n'.format(sample_idx + 1))
+
+
+class BEDDosageTest(unittest.TestCase):
+    def test_get_iterator(self):
+        # Prepare
+        prefix = os.path.join(tempfile.mkdtemp(), 'chr1')
+        genotypes = np.random.RandomState(0).randint(0, 3, size=(7, 11))
+        _create_bed(prefix, genotypes, ['rs{}'.format(i + 1) for i in range(7)])
+
+        # Run
+        all_items = list(BEDDosage(prefix + '.bed').items(n_rows_cached=3))
+
+        # Validate
+        assert len(all_items) == 7
+        assert all_items[0].chr == 1
+        assert all_items[0].rsid == 'rs1'
+        assert all_items[0].position == 100
+        assert all_items[0].allele0 == 'G'
+        assert all_items[0].allele1 == 'A'
+        for idx, item in enumerate(all_items):
+            assert item.dosages.shape == (11,)
+            assert np.array_equal(item.dosages, genotypes[idx])
+
+    def test_get_iterator_filter_by_rsid_and_missing(self):
+        # Prepare
+        prefix = os.path.join(tempfile.mkdtemp(), 'chr1')
+        genotypes = np.array([
+            [0, 1, 2, 2, 1],
+            [2, -1, 0, 1, 1],
+            [1, 1, 1, 1, 1],
+        ])
+        _create_bed(prefix, genotypes, ['rs1', 'rs2', 'rs3'])
+
+        # Run
+        all_items = list(BEDDosage(prefix + '.bed').items(n_rows_cached=10, include_rsid=['rs2', 'rs3']))
+
+        # Validate
+        assert [x.rsid for x in all_items] == ['rs2', 'rs3']
+        assert np.array_equal(all_items[0].dosages, [2, 1, 0, 1, 1])
+        assert np.array_equal(all_items[1].dosages, [1, 1, 1, 1, 1])
+
+    def test_get_iterator_with_read_ahead(self):
+        # Prepare
+        prefix = os.path.join(tempfile.mkdtemp(), 'chr1')
+        genotypes = np.random.RandomState(1).randint(0, 3, size=(9, 13))
+        _create_bed(prefix, genotypes, ['rs{}'.format(i + 1) for i in range(9)])
+
+        # Run
+        bed_dosage = BEDDosage(prefix + '.bed', prefetch_depth=2, prefetch_max_bytes=8)
+        all_items = list(bed_dosage.items(n_rows_cached=2, include_rsid=['rs2', 'rs3', 'rs4', 'rs8', 'rs9']))
+
+        # Validate
+        assert bed_dosage._batch_ranges([0, 2]) == [(3, 4), (11, 4)]
+        assert [x.rsid for x in all_items] == ['rs2', 'rs3', 'rs4', 'rs8', 'rs9']
+        for item, variant_idx in zip(all_items, [1, 2, 3, 7, 8]):
+            assert np.array_equal(item.dosages, genotypes[variant_idx])
@@ -1,5 +1,7 @@
+import io
 import os
 import unittest
+from contextlib import redirect_stdout
 from subprocess import call, check_output
 import tempfile
 import sqlite3
@@ -7,12 +9,21 @@ import sqlite3
 import h5py
 import numpy as np
 
+from bgen.bgen_reader import FIXED_POINT_MISSING, FIXED_POINT_ONE, from_fixed_point
+from predict import PredictedExpression, TranscriptionMatrix, GeneWindow, get_argument_parser, run
 from tests.utils import get_full_path, truncate, get_out, get_repository_path
 
 
 DOSAGES = 'dosages'
 
 
+def _create_predicted_expression(path, values, chunks=None, compression=None):
+    with h5py.File(path, 'w') as hdf5_file:
+        hdf5_file.create_dataset('pred_expr', data=values, chunks=chunks, compression=compression)
+        hdf5_file.create_dataset('genes', data=np.array(['gene{:0>2d}'.format(i) for i in range(values.shape[0])], dtype='S30'))
+        hdf5_file.create_dataset('samples', data=np.array([str(i + 1) for i in range(values.shape[1])], dtype='S25'))
+
+
 def _count_datasets(name, data):
     global entries
     if isinstance(data, h5py.Dataset):
@@ -232,6 +243,81 @@ class PrediXcanTests(unittest.TestCase):
                 0.6188 * (np.dot([0.03509, 0.82789, 0.13705], [0, 1, 2]))
             ) == 0.6819, preds[1, 298]
 
+    def test_keep_samples(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        output_file = os.path.join(tmpdir, 'output.hdf5')
+        keep_samples_file = os.path.join(tmpdir, 'keep.txt')
+        with open(keep_samples_file, 'w') as f:
+            f.write('300\n1\n')
+
+        model_name = 'model00'
+        model_path = _create_model(model_name, [
+            ['rs1', 'gene00', 0.3712, 'A', 'G'], # ambiguous
+            ['rs2', 'gene00', 0.0807, 'G', 'C'], # non-ambiguous
+        ])
+
+        options = [
+            self.python_path,
+            self.predixcan_path,
+            '--bgens-dir', get_full_path('tests/data/set00/'),
+            '--bgens-prefix', 'chr',
+            '--bgens-sample-file', get_full_path('tests/data/set00/impv1.sample'),
+            '--weights-file', model_path,
+            '--output-file', output_file,
+            '--keep-samples', keep_samples_file,
+        ]
+
+        return_code = call(options)
+        assert return_code == 0
+
+        assert os.path.isfile(output_file)
+        with h5py.File(output_file, 'r') as hdf5_file:
+            samples = hdf5_file['samples']
+            assert samples.shape == (2,)
+            assert all(samples[:].astype(str) == np.array(['1', '300']))
+
+            preds = hdf5_file['pred_expr']
+            assert preds.shape == (1, 2)
+
+            assert truncate(preds[0, 0]) == truncate(
+                0.3712 * (2 - np.dot([0.74909, 0.01339, 0.23758], [0, 1, 2])) +
+                0.0807 * (np.dot([0.75232, 0.11729, 0.13050], [0, 1, 2]))
+            ), preds[0, 0]
+
+            assert truncate(preds[0, 1]) == truncate(
+                0.3712 * (2 - np.dot([0.05763, 0.77338, 0.16910], [0, 1, 2])) +
+                0.0807 * (np.dot([0.00937, 0.13421, 0.85658], [0, 1, 2]))
+            ), preds[0, 1]
+
+    def test_missing_weights_file_fails_before_loading_genotypes(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        output_file = os.path.join(tmpdir, 'output.hdf5')
+
+        args = get_argument_parser().parse_args([
+            '--bgens-dir', get_full_path('tests/data/set00/'),
+            '--bgens-prefix', 'chr',
+            '--bgens-sample-file', get_full_path('tests/data/set00/impv1.sample'),
+            '--weights-file', os.path.join(tmpdir, 'missing.db'),
+            '--output-file', output_file,
+        ])
+        opened = []
+
+        def open_genotypes(backend, genotype_path, **kwargs):
+            opened.append(genotype_path)
+            raise AssertionError("genotype file opened before the weights file was checked")
+
+        # Run
+        with self.assertRaises(SystemExit) as context, redirect_stdout(io.StringIO()) as output:
+            run(args, open_genotypes=open_genotypes)
+
+        # Validate
+        assert context.exception.code == 1
+        assert 'missing.db does not exist' in output.getvalue()
+        assert opened == []
+        assert not os.path.isfile(output_file)
+
     def test_chunks(self):
         # Prepare
         tmpdir = tempfile.mkdtemp()
@@ -518,3 +604,381 @@ class PrediXcanTests(unittest.TestCase):
                 0.2754 * (np.dot([0.18570, 0.81029, 0.00390], [0, 1, 2])) +
                 0.2754 * (np.dot([0.21121, 0.01581, 0.77310], [0, 1, 2]))
             ) == 0.6554, preds[33, 299]
+
+
+class PredictedExpressionTests(unittest.TestCase):
+    def test_get_genes_and_samples_chunked(self):
+        # Prepare
+        output_file = os.path.join(tempfile.mkdtemp(), 'output.hdf5')
+        values = np.random.RandomState(0).rand(23, 300).astype('float32')
+        _create_predicted_expression(output_file, values, chunks=(5, 64), compression='gzip')
+
+        # Run
+        with PredictedExpression(output_file, n_cached_chunks=2) as pred_expr:
+            assert pred_expr.mmap is None
+            assert pred_expr.genes[22] == 'gene22'
+            assert pred_expr.samples[0] == '1'
+
+            genes = pred_expr.get_genes(['gene07', 'gene01', 'gene22'])
+            samples = pred_expr.get_samples(['300', '2'])
+            subset = pred_expr.get(['gene10', 'gene11'], ['65', '64', '1'])
+
+            assert len(pred_expr.cached_chunks) == 2
+
+        # Validate
+        assert genes.shape == (3, 300)
+        assert np.array_equal(genes, values[[7, 1, 22], :])
+        assert samples.shape == (23, 2)
+        assert np.array_equal(samples, values[:, [299, 1]])
+        assert np.array_equal(subset, values[np.ix_([10, 11], [64, 63, 0])])
+
+    def test_get_genes_contiguous_uses_mmap(self):
+        # Prepare
+        output_file = os.path.join(tempfile.mkdtemp(), 'output.hdf5')
+        values = np.random.RandomState(1).rand(4, 20).astype('float32')
+        _create_predicted_expression(output_file, values)
+
+        # Run
+        with PredictedExpression(output_file) as pred_expr:
+            assert pred_expr.mmap is not None
+            subset = pred_expr.get(['gene03', 'gene00'], ['20', '5'])
+
+            try:
+                pred_expr.get_genes(['gene99'])
+            except KeyError:
+                pass
+            else:
+                raise AssertionError('unknown genes should fail')
+
+        # Validate
+        assert np.array_equal(subset, values[np.ix_([3, 0], [19, 4])])
+
+    def test_swmr_complete_genes_readable_while_writing(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        output_file = os.path.join(tmpdir, 'output.hdf5')
+        model_path = _create_model('model_swmr', [
+            ['rs1', 'gene00', 0.5, 'A', 'G'],
+            ['rs2', 'gene01', 0.25, 'G', 'C'],
+        ])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n1 1 0\n2 2 0\n3 3 0\n')
+
+        transcription_matrix = TranscriptionMatrix(model_path, sample_file, output_file, swmr=True)
+        transcription_matrix.create_output(3, 10, -1)
+        transcription_matrix.update('gene00', 0.5, 'G', 'G', np.array([0.0, 1.0, 2.0]), 10, -1)
+        transcription_matrix.update('gene01', 0.25, 'C', 'C', np.array([2.0, 2.0, 2.0]), 10, -1)
+        transcription_matrix.finish_genes(['gene00'])
+
+        # Run
+        with PredictedExpression(output_file, swmr=True) as pred_expr:
+            assert pred_expr.samples == ['1', '2', '3']
+            assert pred_expr.get_complete_genes() == ['gene00']
+            assert np.allclose(pred_expr.get_genes(['gene00']), [[0.0, 0.5, 1.0]])
+
+            transcription_matrix.save()
+            pred_expr.refresh()
+
+            # Validate
+            assert pred_expr.get_complete_genes() == ['gene00', 'gene01']
+            assert np.allclose(pred_expr.get_genes(['gene01']), [[0.5, 0.5, 0.5]])
+
+
+class TranscriptionMatrixTests(unittest.TestCase):
+    def test_gene_stats(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        output_file = os.path.join(tmpdir, 'output.hdf5')
+        model_path = _create_model('model_stats', [
+            ['rs1', 'gene00', 0.5, 'A', 'G'],
+            ['rs2', 'gene00', -0.25, 'G', 'C'],
+            ['rs3', 'gene00', 1.0, 'G', 'C'],
+            ['rs2', 'gene01', 0.25, 'G', 'C'],
+        ])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n1 1 0\n2 2 0\n3 3 0\n4 4 0\n')
+
+        # Run
+        transcription_matrix = TranscriptionMatrix(model_path, sample_file, output_file, gene_stats=True)
+        transcription_matrix.update('gene00', 0.5, 'G', 'G', np.array([0.0, 1.0, 2.0, 1.0]), 10, -1)
+        transcription_matrix.update('gene00', -0.25, 'C', 'C', np.array([2.0, 0.0, 1.0, 1.0]), 10, -1)
+        transcription_matrix.update('gene01', 0.25, 'C', 'C', np.array([2.0, 2.0, 2.0, 2.0]), 10, -1)
+        transcription_matrix.save()
+
+        # Validate
+        expected = np.array([0.0 - 0.5, 0.5, 1.0 - 0.25, 0.5 - 0.25])
+        with h5py.File(output_file, 'r') as hdf5_file:
+            assert len(hdf5_file.keys()) == 4
+            stats = hdf5_file['gene_stats']
+            assert np.allclose(stats['mean'][:], [expected.mean(), 0.5])
+            assert np.allclose(stats['variance'][:], [expected.var(ddof=1), 0.0])
+            assert stats['n_snps_in_model'][:].tolist() == [3, 1]
+            assert stats['n_snps_used'][:].tolist() == [2, 1]
+            assert np.allclose(stats['sum_weights_used'][:], [0.25, 0.25])
+
+    def test_scratch_file_accumulator(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        scratch_dir = tempfile.mkdtemp()
+        output_file = os.path.join(tmpdir, 'output.hdf5')
+        n_samples = 3000
+        model_path = _create_model('model_scratch', [
+            ['rs{}'.format(i), 'gene{:0>2d}'.format(i // 2), 0.1, 'A', 'G'] for i in range(10)
+        ])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n')
+            f.writelines('{0} {0} 0\n'.format(i + 1) for i in range(n_samples))
+        dosages = np.random.RandomState(0).rand(10, n_samples) * 2
+
+        # Run
+        transcription_matrix = TranscriptionMatrix(model_path, sample_file, output_file, scratch_dir=scratch_dir)
+        # genes reached in reverse order, and finished as the stream passes them
+        for i in reversed(range(10)):
+            transcription_matrix.update('gene{:0>2d}'.format(i // 2), 0.1, 'G', 'G', dosages[i], 2, -1)
+            if i % 2 == 0:
+                transcription_matrix.finish_genes(['gene{:0>2d}'.format(i // 2)])
+        assert len(os.listdir(scratch_dir)) == 1
+        transcription_matrix.save()
+
+        # Validate
+        assert os.listdir(scratch_dir) == []
+        with h5py.File(output_file, 'r') as hdf5_file:
+            preds = hdf5_file['pred_expr'][:]
+            assert preds.shape == (5, n_samples)
+            assert np.abs(preds - 0.1 * (dosages[0::2] + dosages[1::2])).max() < 1e-4
+
+
+    def test_update_batch_with_threads(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        n_samples = 50
+        genes = ['gene{:0>2d}'.format(i) for i in range(7)]
+        model_path = _create_model('model_batch', [['rs1', gene, 0.1, 'A', 'G'] for gene in genes])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n')
+            f.writelines('{0} {0} 0\n'.format(i + 1) for i in range(n_samples))
+        rng = np.random.RandomState(0)
+        dosages = rng.rand(12, n_samples) * 2
+        # (gene, weight, ref_allele, allele, variant row), with flipped SNPs and the same variant twice for a gene
+        applications = [(genes[rng.randint(len(genes))], float(rng.randn()), 'G', allele, variant_idx)
+                        for variant_idx in range(12) for allele in ('G', 'A', 'C')]
+        applications.append(applications[0])
+
+        # Run
+        expected = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, 'expected.hdf5'), gene_stats=True)
+        for gene, weight, ref_allele, allele, variant_idx in applications:
+            expected.update(gene, weight, ref_allele, allele, dosages[variant_idx], 2, -1)
+        expected.save()
+
+        batched = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, 'batched.hdf5'), gene_stats=True, n_threads=3)
+        batched.update_batch(dosages[:5], [x for x in applications if x[4] < 5], 2, -1)
+        batched.update_batch(dosages[5:], [x[:4] + (x[4] - 5,) for x in applications if x[4] >= 5], 2, -1)
+        batched.save()
+
+        # Validate
+        with h5py.File(os.path.join(tmpdir, 'expected.hdf5'), 'r') as expected_file, h5py.File(os.path.join(tmpdir, 'batched.hdf5'), 'r') as batched_file:
+            assert np.abs(expected_file['pred_expr'][:] - batched_file['pred_expr'][:]).max() < 1e-3
+            for name in ('n_snps_used', 'sum_weights_used', 'mean'):
+                assert np.allclose(expected_file['gene_stats'][name][:], batched_file['gene_stats'][name][:], atol=1e-3)
+
+    def test_update_batch_missing_dosage_only_in_genes_using_the_variant(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        model_path = _create_model('model_batch_missing', [['rs1', 'gene00', 0.1, 'A', 'G'], ['rs2', 'gene01', 0.1, 'A', 'G']])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n')
+            f.writelines('{0} {0} 0\n'.format(i + 1) for i in range(3))
+        # the second sample is missing in the variant of gene00 only
+        dosages = np.array([[1.0, np.nan, 2.0], [0.5, 1.0, 1.5]])
+        applications = [('gene00', 0.5, 'G', 'G', 0), ('gene01', 0.5, 'G', 'G', 1), ('gene01', 0.25, 'G', 'A', 1)]
+
+        # Run
+        expected = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, 'expected.hdf5'))
+        for gene, weight, ref_allele, allele, variant_idx in applications:
+            expected.update(gene, weight, ref_allele, allele, dosages[variant_idx], 2, -1)
+        batched = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, 'batched.hdf5'), n_threads=2, n_verify_genes=2, precision='float32')
+        batched.update_batch(dosages, applications, 2, -1)
+
+        # Validate
+        for gene_idx in (0, 1):
+            assert np.allclose(batched.rows[gene_idx], expected.rows[gene_idx], equal_nan=True)
+        assert np.isnan(batched.rows[0][1]) and not np.isnan(batched.rows[1]).any()
+        assert np.allclose(batched.reference_rows[1], expected.rows[1])
+        expected.D_file.close()
+        batched.D_file.close()
+
+    def test_update_batch_fixed_point_dosages(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        model_path = _create_model('model_batch_fixed_point', [['rs1', 'gene00', 0.1, 'A', 'G'], ['rs2', 'gene01', 0.1, 'A', 'G']])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n')
+            f.writelines('{0} {0} 0\n'.format(i + 1) for i in range(20))
+        fixed_point = np.random.RandomState(0).randint(0, 2 * FIXED_POINT_ONE + 1, size=(3, 20)).astype(np.uint16)
+        fixed_point[1, 4] = FIXED_POINT_MISSING
+        # flipped SNPs: the offset (2 * weight) is not scaled
+        applications = [('gene00', 0.5, 'G', 'G', 0), ('gene00', -0.3, 'G', 'A', 1), ('gene01', 0.25, 'G', 'A', 2)]
+
+        # Run
+        expected = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, 'expected.hdf5'))
+        expected.update_batch(from_fixed_point(fixed_point), applications, 2, -1)
+        scaled = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, 'scaled.hdf5'))
+        scaled.update_batch(fixed_point, applications, 2, -1, dosage_scale=1.0 / FIXED_POINT_ONE)
+
+        # Validate
+        for gene_idx in (0, 1):
+            assert np.allclose(scaled.rows[gene_idx], expected.rows[gene_idx], equal_nan=True)
+        # the missing sample only in gene00, which uses the variant
+        assert np.isnan(scaled.rows[0][4]) and not np.isnan(scaled.rows[1]).any()
+        expected.D_file.close()
+        scaled.D_file.close()
+
+    def test_float32_accumulation_verified_against_float64(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        n_samples = 40
+        genes = ['gene{:0>2d}'.format(i) for i in range(4)]
+        model_path = _create_model('model_precision', [['rs1', gene, 0.1, 'A', 'G'] for gene in genes])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n')
+            f.writelines('{0} {0} 0\n'.format(i + 1) for i in range(n_samples))
+        rng = np.random.RandomState(0)
+        # many small contributions added to a large value, which float32 sums lose without compensation
+        batches = [rng.rand(2, n_samples) * 2 for _ in range(500)]
+        applications = [(gene, 1e-3, 'G', 'G', variant_idx) for gene in genes for variant_idx in range(2)]
+
+        # Run
+        errors = {}
+        for precision in ('float32', 'float32-kahan'):
+            transcription_matrix = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, precision + '.hdf5'), precision=precision, n_verify_genes=2)
+            transcription_matrix.update_batch(np.full((1, n_samples), 1000.0), [(gene, 1.0, 'G', 'G', 0) for gene in genes], 2, -1)
+            for dosages in batches:
+                transcription_matrix.update_batch(dosages, applications, 2, -1)
+            transcription_matrix.save()
+            errors[precision] = transcription_matrix.max_abs_error
+
+        # Validate
+        expected = 1000.0 + sum(dosages.sum(axis=0) for dosages in batches) * 1e-3
+        with h5py.File(os.path.join(tmpdir, 'float32-kahan.hdf5'), 'r') as hdf5_file:
+            assert hdf5_file['pred_expr'].attrs['accumulation_n_verified_genes'] == 2
+            assert hdf5_file['pred_expr'].attrs['accumulation_max_abs_error'] == errors['float32-kahan']
+            assert np.abs(hdf5_file['pred_expr'][:] - expected).max() < 2e-4
+        assert errors['float32-kahan'] < 1e-4 < errors['float32']
+
+    def test_chunks_compressed_in_threads_and_written_directly(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        n_samples = 45
+        genes = ['gene{:0>2d}'.format(i) for i in range(7)]
+        model_path = _create_model('model_direct_chunks', [['rs1', gene, 0.1, 'A', 'G'] for gene in genes])
+        sample_file = os.path.join(tmpdir, 'samples.sample')
+        with open(sample_file, 'w') as f:
+            f.write('ID_1 ID_2 missing\n0 0 0\n')
+            f.writelines('{0} {0} 0\n'.format(i + 1) for i in range(n_samples))
+        rows = np.random.RandomState(0).randn(len(genes), n_samples) * 3
+        # gene03 has no SNPs and gene04 is finished by save; genes are finished out of order, and the last chunks
+        # are edge chunks
+        finish_order = ['gene05', 'gene00', 'gene03', 'gene06', 'gene02', 'gene01']
+
+        # Run
+        # with at most one finished row kept (180 bytes), only the block of gene06 is written directly
+        for name, n_compression_threads, max_pending_size in (('filtered', 0, None), ('direct', 3, None), ('bounded', 3, 200)):
+            transcription_matrix = TranscriptionMatrix(model_path, sample_file, os.path.join(tmpdir, '{}.hdf5'.format(name)),
+                                                       n_compression_threads=n_compression_threads, **({'max_pending_size': max_pending_size} if max_pending_size else {}))
+            transcription_matrix.create_output(n_samples, 3, 20)
+            for gene in finish_order:
+                if gene != 'gene03':
+                    transcription_matrix.set_row(gene, rows[genes.index(gene)])
+                transcription_matrix.finish_genes([gene])
+            transcription_matrix.set_row('gene04', rows[4])
+            if name == 'bounded':
+                assert transcription_matrix.filtered_blocks == {0, 3}
+            transcription_matrix.save()
+
+        # Validate
+        # finished rows are kept as float32, and rounded when their chunks are compressed
+        expected = rows.astype(np.float32).astype(np.float64)
+        expected[3] = 0
+        with h5py.File(os.path.join(tmpdir, 'direct.hdf5'), 'r') as direct, h5py.File(os.path.join(tmpdir, 'filtered.hdf5'), 'r') as filtered, \
+                h5py.File(os.path.join(tmpdir, 'bounded.hdf5'), 'r') as bounded:
+            assert direct['pred_expr'].chunks == (3, 20)
+            assert direct['pred_expr'].shuffle and direct['pred_expr'].compression == 'gzip'
+            assert direct['pred_expr'].scaleoffset is None
+            assert np.array_equal(direct['pred_expr'][:], np.round(expected, 4).astype(np.float32))
+            assert np.abs(direct['pred_expr'][:] - filtered['pred_expr'][:]).max() <= 2e-4
+            assert np.array_equal(direct['genes'][:], filtered['genes'][:])
+            assert np.array_equal(bounded['pred_expr'][:], direct['pred_expr'][:])
+
+    def test_append_samples(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        genes = ['gene00', 'gene01', 'gene02']
+        model_path = _create_model('model_append', [['rs1', gene, 0.1, 'A', 'G'] for gene in genes])
+        changed_model_path = _create_model('model_append_changed', [['rs1', gene, 0.2, 'A', 'G'] for gene in genes])
+        sample_files = []
+        for first_sample, n_samples in ((1, 30), (31, 12)):
+            sample_files.append(os.path.join(tmpdir, 'samples{}.sample'.format(first_sample)))
+            with open(sample_files[-1], 'w') as f:
+                f.write('ID_1 ID_2 missing\n0 0 0\n')
+                f.writelines('{0} {0} 0\n'.format(i) for i in range(first_sample, first_sample + n_samples))
+        rows = np.random.RandomState(0).randn(len(genes), 42)
+        output_file = os.path.join(tmpdir, 'output.hdf5')
+
+        # Run
+        for sample_file, columns, append in ((sample_files[0], slice(0, 30), False), (sample_files[1], slice(30, 42), True)):
+            transcription_matrix = TranscriptionMatrix(model_path, sample_file, output_file, gene_stats=True, append=append)
+            transcription_matrix.create_output(columns.stop - columns.start, 2, 8)
+            for gene_idx in (0, 2):
+                transcription_matrix.set_row(genes[gene_idx], rows[gene_idx, columns])
+            transcription_matrix.save()
+        transcription_matrix.write_text(os.path.join(tmpdir, 'output.txt'))
+
+        # Validate
+        expected = rows.copy()
+        expected[1] = 0
+        with open(os.path.join(tmpdir, 'output.txt')) as f:
+            lines = [line.rstrip('\n').split('\t') for line in f]
+        assert lines[0] == ['FID', 'IID'] + genes
+        assert [line[:2] for line in lines[1:]] == [[str(i), str(i)] for i in range(1, 43)]
+        assert np.abs(np.array([line[2:] for line in lines[1:]], dtype=float).T - expected).max() < 1e-4
+        with h5py.File(output_file, 'r') as hdf5_file:
+            assert hdf5_file['pred_expr'].shape == (3, 42)
+            assert [sample.decode() for sample in hdf5_file['samples'][:]] == [str(i) for i in range(1, 43)]
+            assert np.abs(hdf5_file['pred_expr'][:] - expected).max() < 1e-4
+            assert np.allclose(hdf5_file['gene_stats/mean'][:], expected.mean(axis=1))
+            assert np.allclose(hdf5_file['gene_stats/variance'][:], expected.var(axis=1, ddof=1))
+        # samples predicted with other weights are not appended
+        transcription_matrix = TranscriptionMatrix(changed_model_path, sample_files[1], output_file, append=True)
+        with self.assertRaises(SystemExit):
+            transcription_matrix.create_output(12, 2, 8)
+        with h5py.File(output_file, 'r') as hdf5_file:
+            assert hdf5_file['pred_expr'].shape == (3, 42)
+
+
+class GeneWindowTests(unittest.TestCase):
+    def test_genes_finished_when_stream_passes_last_snp(self):
+        # Prepare
+        gene_window = GeneWindow(['gene00', 'gene01', 'gene02', 'gene03', 'gene04'], {
+            'gene00': (0, 181),
+            'gene01': (0, 100),
+            'gene02': (1, 500),
+            'gene03': (1, None),  # genotype file not sorted by position
+        })
+
+        # Run and validate
+        assert gene_window.unused_genes == ['gene04']
+        assert gene_window.passed(100) == []
+        assert gene_window.passed(150) == ['gene01']
+        assert gene_window.passed(181) == []
+        assert gene_window.file_done(0) == ['gene00']
+
+        assert gene_window.passed(501) == ['gene02']
+        assert gene_window.passed(10 ** 9) == []
+        assert gene_window.file_done(1) == ['gene03']
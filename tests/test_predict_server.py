@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import h5py
+import numpy as np
+
+import predict
+from predict_server import GenotypeCache, ModelCache, PredictionServer, _JobHandler, _UnixServer, submit
+from tests.utils import get_repository_path
+
+
+def _create_model(path, values):
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE weights (rsid TEXT, gene TEXT, weight REAL, ref_allele TEXT, eff_allele TEXT)')
+        conn.executemany('INSERT INTO weights VALUES (?, ?, ?, ?, ?)', values)
+    return path
+
+
+def _get_args(weights_file, output_file):
+    args = predict.get_argument_parser().parse_args([
+        '--bgens-dir', get_repository_path('set00/'), '--bgens-prefix', 'chr', '--bgens-sample-file', get_repository_path('set00/impv1.sample'),
+        '--bgens-decoder', 'native', '--weights-file', weights_file, '--output-file', output_file, '--no-progress-bar'])
+    args.n_workers = 1
+    args.max_cached_models = 8
+    args.max_cached_genotype_files = 64
+    return args
+
+
+class ModelCacheTest(unittest.TestCase):
+    def test_model_loaded_once(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        model_paths = [_create_model(os.path.join(tmpdir, 'model{}.db'.format(idx)), [('rs1', 'gene1', 0.3, 'A', 'G')]) for idx in range(2)]
+        models = ModelCache(max_models=1)
+
+        # Run
+        first = models.get(model_paths[0])
+        second = models.get(model_paths[0])
+        models.get(model_paths[1])
+        third = models.get(model_paths[0])
+
+        # Validate
+        assert first is second
+        # evicted by the second model
+        assert third is not first
+        assert models.keys() == [os.path.abspath(model_paths[0])]
+
+
+class GenotypeCacheTest(unittest.TestCase):
+    def test_evicted_files_are_closed(self):
+        # Prepare
+        paths = [get_repository_path('set00/chr{}impv1.bgen'.format(chromosome)) for chromosome in (1, 2)]
+        genotypes = GenotypeCache(max_files=1)
+        job_entries = []
+
+        # Run
+        first = genotypes.open('bgen', paths[0], decoder='native')
+        second = genotypes.open('bgen', paths[1], job_entries, decoder='native')
+        reopened = genotypes.open('bgen', paths[0], decoder='native')
+        second_fd_while_used = second.reader.fd
+        genotypes.release(job_entries)
+
+        # Validate
+        assert first.reader.fd is None
+        assert reopened is not first
+        # the second file was evicted while a job used it, and closed when the job released it
+        assert second_fd_while_used is not None
+        assert second.reader.fd is None
+        assert reopened.reader.fd is not None
+        assert len(genotypes.genotypes) == 1
+
+
+class PredictionServerTest(unittest.TestCase):
+    def test_submitted_job_same_as_run(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        model_path = _create_model(os.path.join(tmpdir, 'model.db'), [
+            ('rs1', 'gene1', 0.3, 'A', 'G'), ('rs2000002', 'gene1', -0.7, 'A', 'G'),
+            ('rs3', 'gene2', 1.1, 'G', 'A'), ('rs2000004', 'gene3', 0.5, 'A', 'G'),
+        ])
+        predict.run(_get_args(model_path, os.path.join(tmpdir, 'run.h5')))
+        socket_path = os.path.join(tmpdir, 'server.sock')
+        server = _UnixServer(socket_path, _JobHandler)
+        server.prediction_server = PredictionServer(_get_args(model_path, os.path.join(tmpdir, 'unused.h5')))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        # Run
+        try:
+            responses = [submit(socket_path, {'weights_file': model_path, 'output_file': os.path.join(tmpdir, 'job{}.h5'.format(idx))}) for idx in range(2)]
+            status = submit(socket_path, {'command': 'status'})
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        # Validate
+        assert [response['status'] for response in responses] == ['done', 'done']
+        assert status['cached_models'] == [os.path.abspath(model_path)]
+        with h5py.File(os.path.join(tmpdir, 'run.h5'), 'r') as expected:
+            for idx in range(2):
+                with h5py.File(os.path.join(tmpdir, 'job{}.h5'.format(idx)), 'r') as job:
+                    assert np.array_equal(job['genes'][:], expected['genes'][:])
+                    assert np.array_equal(job['samples'][:], expected['samples'][:])
+                    assert np.array_equal(job['pred_expr'][:], expected['pred_expr'][:])
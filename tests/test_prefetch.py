@@ -0,0 +1,89 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import predict
+from prefetch import coalesce, read_ahead, open_ahead
+from tests.utils import get_repository_path
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_coalesce(self):
+        # Run and validate
+        assert coalesce([(100, 10), (0, 50), (50, 10), (105, 20)]) == [(0, 60), (100, 25)]
+
+    def test_read_ahead_depth_and_max_bytes(self):
+        # Prepare
+        fd = os.open(tempfile.mkstemp()[1], os.O_RDONLY)
+        batches = [[(idx * 10, 10)] for idx in range(6)]
+        advised = []
+
+        def get_ranges(batch):
+            advised.append(batch[0][0])
+            return batch
+
+        # Run
+        consumed = []
+        for batch in read_ahead(batches, get_ranges, fd, depth=2):
+            consumed.append(batch)
+            # batches are read ahead up to depth batches after the one being used
+            assert len(advised) == min(len(consumed) + 2, len(batches))
+
+        advised_capped = []
+        for batch in read_ahead(batches, lambda batch: advised_capped.append(batch) or batch, fd, depth=4, max_bytes=10):
+            # the byte limit keeps only one batch ahead
+            assert len(advised_capped) == min(batches.index(batch) + 2, len(batches))
+
+        os.close(fd)
+
+        # Validate
+        assert consumed == batches
+        assert advised == [0, 10, 20, 30, 40, 50]
+
+    def test_open_ahead(self):
+        # Prepare
+        opened = []
+        second_file_opened = threading.Event()
+
+        def open_file(name):
+            opened.append(name)
+            if name == 'chr2':
+                second_file_opened.set()
+            return name.upper()
+
+        # Run
+        results = []
+        for result in open_ahead(open_file, ['chr1', 'chr2', 'chr3']):
+            results.append(result)
+            if result == 'CHR1':
+                # the next file is opened while the current one is used
+                assert second_file_opened.wait(5)
+
+        # Validate
+        assert results == ['CHR1', 'CHR2', 'CHR3']
+        assert opened == ['chr1', 'chr2', 'chr3']
+
+    def test_no_open_ahead_with_rbgen(self):
+        # Prepare
+        opened_in = []
+
+        class NoVariants:
+            def items(self, **kwargs):
+                return iter(())
+
+        def open_genotypes(backend, genotype_path, **kwargs):
+            opened_in.append((threading.current_thread() is threading.main_thread(), kwargs['prefetch_depth']))
+            return NoVariants()
+
+        args = predict.get_argument_parser().parse_args(['--weights-file', 'model.db', '--output-file', 'out.h5', '--bgens-dir', get_repository_path('set00/'),
+                                                         '--bgens-prefix', 'chr', '--bgens-sample-file', get_repository_path('set00/impv1.sample')])
+        args.bgens_bgi_dir = args.bgens_dir
+
+        # Run
+        list(predict.get_all_dosages_from_bgen(args.bgens_dir, args.bgens_prefix, ['rs1'], args, open_genotypes=open_genotypes))
+
+        # Validate
+        # R objects are only created in the main thread, and nothing is read ahead for rbgen
+        assert args.bgens_decoder == 'rbgen' and args.bgens_prefetch_depth > 0
+        assert opened_in == [(True, 0), (True, 0)]
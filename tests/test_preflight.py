@@ -0,0 +1,42 @@
+import unittest
+
+from preflight import genotype_samples_count, bytes_to_read, peak_active_genes
+from tests.utils import get_repository_path
+
+
+class _Applications:
+    def __init__(self, tuples):
+        self.tuples = tuples
+
+    def __call__(self, rsid):
+        for tup in self.tuples.get(rsid, []):
+            yield tup
+
+
+class PreflightTest(unittest.TestCase):
+    def test_bgen_samples_count_and_bytes(self):
+        # Prepare
+        bgen_path = get_repository_path('set00/chr1impv1.bgen')
+
+        # Run
+        n_samples = genotype_samples_count('bgen', bgen_path)
+        n_bytes = bytes_to_read('bgen', bgen_path, bgen_path + '.bgi', ['rs1', 'rs2'], 2, n_samples)
+
+        # Validate
+        assert n_samples == 300
+        assert n_bytes == 1289 + 1285
+
+    def test_peak_active_genes(self):
+        # Prepare
+        get_applications_of = _Applications({
+            'rs1': [('gene00', 0.1, 'A')],
+            'rs2': [('gene01', 0.1, 'A')],
+            'rs3': [('gene00', 0.1, 'A'), ('gene02', 0.1, 'A')],
+            'rs4': [('gene03', 0.1, 'A')],
+        })
+
+        # Run and validate
+        # gene00 spans 100-300 and overlaps gene01 (200) and gene02 (300); gene03 starts after gene00 ended
+        assert peak_active_genes([[('rs1', 100), ('rs2', 200), ('rs3', 300), ('rs4', 400)]], get_applications_of) == 2
+        # files not sorted by position keep all their genes until the end
+        assert peak_active_genes([[('rs4', 400), ('rs1', 100), ('rs2', 200), ('rs3', 300)]], get_applications_of) == 4
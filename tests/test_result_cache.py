@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from result_cache import GeneResultCache, weight_fingerprints, gene_keys, sample_set_hash
+
+
+class GeneResultCacheTest(unittest.TestCase):
+    def test_get_and_put(self):
+        # Prepare
+        cache = GeneResultCache(os.path.join(tempfile.mkdtemp(), 'cache'), 1024 ** 2)
+        row = np.arange(10, dtype=np.float32) / 3
+
+        # Run
+        cache.put([('key1', row, 3, 0.5), ('key2', row * 2, None, None)])
+        found = cache.get(['key1', 'key2', 'key3'], 10)
+
+        # Validate
+        assert sorted(found) == ['key1', 'key2']
+        assert np.array_equal(found['key1'][0], row)
+        assert found['key1'][1:] == (3, 0.5)
+        assert found['key2'][1:] == (None, None)
+        # rows of another number of samples are not served
+        assert cache.get(['key1'], 11) == {}
+
+    def test_least_recently_used_rows_are_evicted(self):
+        # Prepare
+        rng = np.random.RandomState(0)
+        rows = {'key{}'.format(idx): rng.rand(1000).astype(np.float32) for idx in range(3)}
+        cache = GeneResultCache(tempfile.mkdtemp(), 1024 ** 2)
+        cache.put([('key0', rows['key0'], None, None)])
+        cache.put([('key1', rows['key1'], None, None)])
+        n_bytes = cache.conn.execute('SELECT MAX(n_bytes) FROM gene_rows').fetchone()[0]
+
+        # Run
+        cache.get(['key0'], 1000)
+        cache.max_bytes = 2 * n_bytes + 100
+        cache.put([('key2', rows['key2'], None, None)])
+
+        # Validate
+        assert sorted(cache.get(rows.keys(), 1000)) == ['key0', 'key2']
+
+    def test_keys_change_with_weights_and_samples(self):
+        # Prepare
+        model_path = os.path.join(tempfile.mkdtemp(), 'model.db')
+        with sqlite3.connect(model_path) as conn:
+            conn.execute('CREATE TABLE weights (rsid TEXT, gene TEXT, weight REAL, ref_allele TEXT, eff_allele TEXT)')
+            conn.executemany('INSERT INTO weights VALUES (?, ?, ?, ?, ?)',
+                             [('rs1', 'gene0', 0.5, 'A', 'G'), ('rs2', 'gene0', 0.1, 'A', 'G'), ('rs1', 'gene1', 0.2, 'A', 'G')])
+
+        # Run
+        keys = gene_keys(weight_fingerprints(model_path, ['gene0', 'gene1']), 'genotypes', sample_set_hash(['1', '2']))
+        with sqlite3.connect(model_path) as conn:
+            conn.execute("UPDATE weights SET weight = 0.3 WHERE gene = 'gene1'")
+        new_keys = gene_keys(weight_fingerprints(model_path, ['gene0', 'gene1']), 'genotypes', sample_set_hash(['1', '2']))
+        other_samples_keys = gene_keys(weight_fingerprints(model_path, ['gene0', 'gene1']), 'genotypes', sample_set_hash(['2', '1']))
+
+        # Validate
+        assert keys['gene0'] == new_keys['gene0']
+        assert keys['gene1'] != new_keys['gene1']
+        assert not set(new_keys.values()) & set(other_samples_keys.values())
@@ -0,0 +1,71 @@
+import os
+import gzip
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from text_output import BGZFWriter, format_rows, write_text
+
+
+class TextOutputTest(unittest.TestCase):
+    def test_format_rows(self):
+        # Prepare
+        values = np.random.RandomState(0).randn(20, 7) * [[1, 10, 100, 1000, 1e-7, 0, 3]]
+
+        # Run
+        text = format_rows(['{0}\t{0}\t'.format(idx) for idx in range(20)], values).decode()
+
+        # Validate
+        expected = ''.join('{0}\t{0}\t'.format(idx) + '\t'.join('{:.6f}'.format(x) for x in row) + '\n' for idx, row in enumerate(values))
+        # '%f' keeps the sign of values rounded to zero
+        assert text == expected.replace('-0.000000', '0.000000')
+
+    def test_format_rows_non_finite_values(self):
+        # Prepare
+        values = np.array([[1.0, np.nan, np.inf, 0.5], [-np.inf, -2.25, np.nan, np.nan]])
+
+        # Run
+        texts = [format_rows(['a\ta\t', 'b\tb\t'], values, decimals) for decimals in (6, 0)]
+
+        # Validate
+        assert texts[0] == b'a\ta\t1.000000\tnan\tinf\t0.500000\nb\tb\t-inf\t-2.250000\tnan\tnan\n'
+        assert texts[1] == b'a\ta\t1\tnan\tinf\t0\nb\tb\t-inf\t-2\tnan\tnan\n'
+
+    def test_bgzf_writer_is_gzip_readable(self):
+        # Prepare
+        path = os.path.join(tempfile.mkdtemp(), 'out.txt.gz')
+        data = b''.join('line {}\n'.format(idx).encode() for idx in range(50000))
+
+        # Run
+        with BGZFWriter(path, n_threads=3) as writer:
+            writer.write(data[:1000])
+            writer.write(data[1000:])
+
+        # Validate
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == data
+        with open(path, 'rb') as f:
+            # every BGZF block has the 'BC' extra field
+            assert f.read(16)[12:14] == b'BC'
+
+    def test_write_text_in_sample_blocks(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        values = np.random.RandomState(1).randn(5, 23).astype(np.float32)
+        with h5py.File(os.path.join(tmpdir, 'pred.h5'), 'w') as hdf5_file:
+            hdf5_file.create_dataset('pred_expr', data=values, chunks=(2, 4))
+        genes = ['gene{}'.format(idx) for idx in range(5)]
+        samples = [['F{}'.format(idx), 'I{}'.format(idx)] for idx in range(23)]
+
+        # Run
+        with h5py.File(os.path.join(tmpdir, 'pred.h5'), 'r') as hdf5_file:
+            write_text(hdf5_file['pred_expr'], genes, samples, os.path.join(tmpdir, 'pred.txt.gz'), n_threads=2, max_bytes=1000)
+
+        # Validate
+        with gzip.open(os.path.join(tmpdir, 'pred.txt.gz'), 'rt') as f:
+            lines = [line.rstrip('\n').split('\t') for line in f]
+        assert lines[0] == ['FID', 'IID'] + genes
+        assert [line[:2] for line in lines[1:]] == samples
+        assert np.abs(np.array([line[2:] for line in lines[1:]], dtype=np.float64).T - values).max() <= 5e-7
@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from variant_keys import variant_keys, parse_var_ids, merge_join
+
+
+class VariantKeysTest(unittest.TestCase):
+    def test_keys_ignore_allele_order_and_chr_prefix(self):
+        # Run
+        keys = variant_keys(['chr1', '1', '1', '2', 'X'], [100, 100, 100, 100, 100], ['G', 'a', 'G', 'G', 'G'], ['A', 'g', 'C', 'A', 'A'])
+
+        # Validate
+        assert keys.dtype == np.uint64
+        assert keys[0] == keys[1]
+        assert keys[0] != keys[2]
+        assert keys[0] != keys[3]
+        assert keys[3] != keys[4]
+        assert int(keys[0]) >> 56 == 1
+        assert (int(keys[0]) >> 24) & 0xFFFFFFFF == 100
+
+    def test_parse_var_ids(self):
+        # Run
+        chromosomes, positions, alleles_a, alleles_b = parse_var_ids(['chr1_13550_G_A_b38', '22_16050075_A_G_b37'])
+
+        # Validate
+        assert chromosomes == ['chr1', '22']
+        assert positions == [13550, 16050075]
+        assert alleles_a == ['G', 'A']
+        assert alleles_b == ['A', 'G']
+
+    def test_merge_join_with_repeated_keys(self):
+        # Prepare
+        left_keys = np.array([30, 10, 20, 10], dtype=np.uint64)
+        right_keys = np.array([10, 40, 30, 20, 10], dtype=np.uint64)
+
+        # Run
+        left_idxs, right_idxs = merge_join(left_keys, right_keys)
+
+        # Validate
+        pairs = sorted(zip(left_idxs.tolist(), right_idxs.tolist()))
+        assert pairs == [(0, 2), (1, 0), (1, 4), (2, 3), (3, 0), (3, 4)], pairs
+        assert (left_keys[left_idxs] == right_keys[right_idxs]).all()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from bgen.variant_qc import VariantQC, variant_qc
+from tests.utils import get_repository_path
+
+
+def _read_gen(gen_path):
+    variants = []
+    with open(gen_path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            probs = np.array(fields[6:], dtype=np.float64).reshape(-1, 3)
+            variants.append((fields[2], probs))
+    return variants
+
+
+class VariantQCTest(unittest.TestCase):
+    def test_variant_qc(self):
+        # Prepare
+        dosages = np.array([0.0, 1.0, 2.0, np.nan])
+
+        # Run
+        allele_frequency, maf, info, missing_rate = variant_qc(dosages, dosages ** 2)
+
+        # Validate
+        # hard calls are fully informative
+        assert (allele_frequency, maf, info, missing_rate) == (0.5, 0.5, 1.0, 0.25)
+
+    def test_computed_once_and_used_to_exclude_variants(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        for filename in ('chr1impv1.bgen', 'chr1impv1.bgen.bgi'):
+            shutil.copy(get_repository_path('set00/' + filename), tmpdir)
+        bgen_path = os.path.join(tmpdir, 'chr1impv1.bgen')
+
+        expected = {}
+        for rsid, probs in _read_gen(get_repository_path('set00/chr1impv1.gen')):
+            dosages = probs[:, 1] + 2 * probs[:, 2]
+            expected[rsid] = variant_qc(dosages, probs[:, 1] + 4 * probs[:, 2])
+
+        # Run
+        qc = VariantQC(bgen_path, bgen_path + '.bgi', n_threads=2)
+        qc_mtime = os.stat(bgen_path + '.bgi.qc.npy').st_mtime_ns
+        qc_again = VariantQC(bgen_path, bgen_path + '.bgi')
+
+        # Validate
+        assert os.stat(bgen_path + '.bgi.qc.npy').st_mtime_ns == qc_mtime
+        assert len(qc_again.variants) == len(expected)
+        for name_idx, name in enumerate(('allele_frequency', 'maf', 'info', 'missing_rate')):
+            assert np.allclose(qc.variants[name], [x[name_idx] for x in expected.values()], atol=1e-3)
+
+        rsids = list(expected) + ['rs_other_file']
+        min_info = np.median([x[2] for x in expected.values()])
+        excluded = qc.excluded(rsids, min_info=min_info)
+        assert 'rs_other_file' not in excluded
+        assert 0 < len(excluded) < len(expected)
+        for rsid, (_, _, info, _) in expected.items():
+            if abs(info - min_info) > 1e-3:
+                assert (rsid in excluded) == (info < min_info)
+        assert set(qc.excluded(rsids, min_maf=0.6)) == set(expected)
@@ -0,0 +1,220 @@
+import os
+import gzip
+import zlib
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from vcf.tabix_index import TabixIndex, reg2bins
+from vcf.vcf_dosage import VCFDosage, parse_dosages
+
+
+def _reg2bin(beg, end, min_shift=14, depth=5):
+    end -= 1
+    level_start, shift = ((1 << (depth * 3)) - 1) // 7, min_shift
+    for level in range(depth, 0, -1):
+        if beg >> shift == end >> shift:
+            return level_start + (beg >> shift)
+        shift += 3
+        level_start -= 1 << ((level - 1) * 3)
+    return 0
+
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def _write_vcf(vcf_path, records, samples, index='tbi', block_size=1000):
+    """
+    Writes a bgzipped VCF file in blocks of block_size uncompressed bytes (so records span several blocks), and its
+    tabix or CSI index.
+    :param records: list of (chrom, position, id, ref, alt, list of the sample fields), sorted by position.
+    """
+    header = '##fileformat=VCFv4.1\n##contig=<ID=chr1>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}\n'.format('\t'.join(samples)).encode()
+    text = header
+    record_starts = []
+    for chrom, position, rsid, ref, alt, fields in records:
+        record_starts.append(len(text))
+        text += '{}\t{}\t{}\t{}\t{}\t.\tPASS\t.\tGT:DS:GP\t{}\n'.format(chrom, position, rsid, ref, alt, '\t'.join(fields)).encode()
+
+    block_offsets = []
+    with open(vcf_path, 'wb') as f:
+        for start in range(0, len(text), block_size):
+            block_offsets.append(f.tell())
+            f.write(_bgzf_block(text[start:start + block_size]))
+        f.write(_bgzf_block(b''))
+
+    def virtual_offset(offset):
+        if offset == len(text):
+            return block_offsets[-1] + len(_bgzf_block(text[(len(text) - 1) // block_size * block_size:])) << 16
+        return (block_offsets[offset // block_size] << 16) | (offset % block_size)
+
+    # chunks of consecutive records of the same bin, and smallest offset of the records of each 16 kb window
+    bins, linear_index = {}, {}
+    for record_idx, (chrom, position, _, ref, _, _) in enumerate(records):
+        beg, end = position - 1, position - 1 + len(ref)
+        start = virtual_offset(record_starts[record_idx])
+        stop = virtual_offset(record_starts[record_idx + 1] if record_idx + 1 < len(records) else len(text))
+        chunks = bins.setdefault(_reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start, stop])
+        for window in range(beg >> 14, ((end - 1) >> 14) + 1):
+            linear_index.setdefault(window, start)
+    linear = [linear_index.get(window, 0) for window in range(max(linear_index) + 1)]
+    for window in range(1, len(linear)):
+        linear[window] = linear[window] or linear[window - 1]
+
+    names = b'chr1\x00'
+    configuration = struct.pack('<7i', 2, 1, 2, 0, ord('#'), 0, len(names)) + names
+    if index == 'tbi':
+        data = b'TBI\x01' + struct.pack('<i', 1) + configuration + struct.pack('<i', len(bins))
+        for bin_number, chunks in bins.items():
+            data += struct.pack('<Ii', bin_number, len(chunks)) + b''.join(struct.pack('<QQ', *chunk) for chunk in chunks)
+        data += struct.pack('<i', len(linear)) + b''.join(struct.pack('<Q', x) for x in linear)
+    else:
+        data = b'CSI\x01' + struct.pack('<3i', 14, 5, len(configuration)) + configuration + struct.pack('<ii', 1, len(bins))
+        for bin_number, chunks in bins.items():
+            data += struct.pack('<IQi', bin_number, chunks[0][0], len(chunks)) + b''.join(struct.pack('<QQ', *chunk) for chunk in chunks)
+    with gzip.open(vcf_path + '.' + index, 'wb') as f:
+        f.write(data)
+
+
+def _random_records(n_variants, n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    dosages = np.round(rng.rand(n_variants, n_samples) * 2, 3)
+    missing = rng.rand(n_variants, n_samples) < 0.05
+    records = []
+    for variant_idx in range(n_variants):
+        fields = ['.|.:.:.' if missing[variant_idx, sample_idx] else '0|1:{:.3f}:0.1,0.8,0.1'.format(dosages[variant_idx, sample_idx])
+                  for sample_idx in range(n_samples)]
+        # variants spread over several 16 kb windows, with a long deletion in a higher-level bin
+        ref = 'A' * 20000 if variant_idx == 7 else 'A'
+        records.append(('chr1', 1000 + variant_idx * 3000, 'chr1:{}:A:G'.format(1000 + variant_idx * 3000), ref, 'G', fields))
+    dosages[missing] = np.nan
+    return records, dosages
+
+
+class ParseDosagesTest(unittest.TestCase):
+    def test_parse_dosages(self):
+        # Prepare
+        record = b'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tGT:DS:GP\t0|0:0.012:1,0,0\t1|1:2:0,0,1\t.|.:.:.\t0|1:1.5\t.\t0|1:.999'
+        out = np.empty(6)
+
+        # Run
+        parse_dosages(record, 6, out)
+
+        # Validate
+        assert np.allclose(out, [0.012, 2.0, np.nan, 1.5, np.nan, 0.999], equal_nan=True)
+
+    def test_parse_dosages_same_layout(self):
+        # Prepare
+        values = np.round(np.random.RandomState(0).rand(50) * 2, 3)
+        records = [
+            'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tGT:DS:HDS\t{}'.format('\t'.join('0|1:{:.3f}:0.1,0.9'.format(x) for x in values)).encode(),
+            'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tDS:GT\t{}'.format('\t'.join('{:.3f}:0|1'.format(x) for x in values)).encode(),
+            'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tGT:DS\t{}'.format('\t'.join(['.'] * 50)).encode(),
+        ]
+        out = np.empty((3, 50))
+
+        # Run
+        for record, row in zip(records, out):
+            parse_dosages(record, 50, row)
+
+        # Validate
+        assert np.allclose(out[:2], values)
+        assert np.isnan(out[2]).all()
+
+    def test_parse_dosages_missing_in_every_sample(self):
+        # Prepare
+        records = [
+            b'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tGT:DS\t./.:.\t./.:.\t./.:.',
+            b'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tDS\t.\t.\t.',
+        ]
+        out = np.empty((2, 3))
+
+        # Run
+        for record, row in zip(records, out):
+            parse_dosages(record, 3, row)
+
+        # Validate
+        assert np.isnan(out).all()
+
+    def test_parse_dosages_unexpected_characters(self):
+        # Prepare
+        record = b'chr1\t100\trs1\tA\tG\t.\tPASS\t.\tDS\t1e-3\t.\t0.5'
+        out = np.empty(3)
+
+        # Run
+        parse_dosages(record, 3, out)
+
+        # Validate
+        assert np.allclose(out, [0.001, np.nan, 0.5], equal_nan=True)
+
+
+class VCFDosageTest(unittest.TestCase):
+    def test_reg2bins(self):
+        # Run
+        bins = reg2bins(0, 1)
+
+        # Validate
+        # one bin per level for a 1 bp region
+        assert bins == [0, 1, 9, 73, 585, 4681]
+        assert _reg2bin(0, 1) == 4681
+
+    def _check_items(self, index):
+        # Prepare
+        vcf_path = os.path.join(tempfile.mkdtemp(), 'chr1.dose.vcf.gz')
+        samples = ['sample{}'.format(idx) for idx in range(30)]
+        records, dosages = _random_records(40, len(samples))
+        _write_vcf(vcf_path, records, samples, index)
+        selected = [3, 7, 8, 20, 21, 22, 39]
+        sample_idxs = np.array([1, 4, 5, 29])
+
+        # Run
+        vcf_dosage = VCFDosage(vcf_path, n_threads=3)
+        items = list(vcf_dosage.items(n_rows_cached=3, include_rsid=[records[idx][2] for idx in selected], sample_idxs=sample_idxs))
+
+        # Validate
+        assert isinstance(vcf_dosage.index, TabixIndex)
+        assert vcf_dosage.samples_count == len(samples)
+        assert [item.rsid for item in items] == [records[idx][2] for idx in selected]
+        assert [(item.chr, item.position, item.allele0, item.allele1) for item in items] == [(1, records[idx][1], records[idx][3], 'G') for idx in selected]
+        for item, variant_idx in zip(items, selected):
+            expected = dosages[variant_idx, sample_idxs]
+            # missing dosages get the mean of the variant
+            expected = np.where(np.isnan(expected), np.nanmean(expected), expected)
+            assert np.allclose(item.dosages, expected)
+
+    def test_items_with_tabix_index(self):
+        self._check_items('tbi')
+
+    def test_items_with_csi_index(self):
+        self._check_items('csi')
+
+    def test_sites_read_once(self):
+        # Prepare
+        vcf_path = os.path.join(tempfile.mkdtemp(), 'chr1.dose.vcf.gz')
+        records, _ = _random_records(10, 5)
+        records[4] = records[4][:4] + ('G,T',) + records[4][5:]
+        _write_vcf(vcf_path, records, ['s{}'.format(idx) for idx in range(5)])
+
+        # Run
+        first = VCFDosage(vcf_path)
+        sites_mtime = os.stat(vcf_path + '.sites.npz').st_mtime_ns
+        second = VCFDosage(vcf_path)
+
+        # Validate
+        assert os.stat(vcf_path + '.sites.npz').st_mtime_ns == sites_mtime
+        rsids, chromosomes, positions, alleles0, alleles1 = second.variant_table()
+        # the multiallelic record is left out
+        assert rsids == [x[2] for idx, x in enumerate(records) if idx != 4]
+        assert positions == [x[1] for idx, x in enumerate(records) if idx != 4]
+        assert set(chromosomes) == {1}
+        assert first.variant_positions([records[2][2]]) == [(records[2][2], records[2][1])]
@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import predict
+from work_queue import Lease, WorkQueue, get_argument_parser, reduce_partials, work
+from tests.utils import get_repository_path
+
+
+def _create_model(path, values):
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE weights (rsid TEXT, gene TEXT, weight REAL, ref_allele TEXT, eff_allele TEXT)')
+        conn.executemany('INSERT INTO weights VALUES (?, ?, ?, ?, ?)', values)
+    return path
+
+
+class LeaseTest(unittest.TestCase):
+    def test_lease_is_exclusive(self):
+        # Prepare
+        path = os.path.join(tempfile.mkdtemp(), 'unit.lease')
+        first, second = Lease(path, 'worker1', 60), Lease(path, 'worker2', 60)
+
+        # Run
+        acquired = [first.acquire(), second.acquire()]
+        first.release()
+
+        # Validate
+        assert acquired == [True, False]
+        assert not os.path.exists(path)
+        assert second.acquire()
+        second.release()
+
+    def test_stale_lease_is_reclaimed(self):
+        # Prepare
+        path = os.path.join(tempfile.mkdtemp(), 'unit.lease')
+        with open(path, 'w') as f:
+            json.dump({'worker': 'crashed'}, f)
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        lease = Lease(path, 'worker1', 60)
+
+        # Run
+        acquired = lease.acquire()
+
+        # Validate
+        assert acquired
+        assert lease.is_owned()
+        assert os.listdir(os.path.dirname(path)) == ['unit.lease']
+        lease.release()
+
+
+class WorkQueueTest(unittest.TestCase):
+    def test_units_reduced_to_the_output_of_one_run(self):
+        # Prepare
+        tmpdir = tempfile.mkdtemp()
+        # rs1 to rs4 are in the chr1 file, rs2000001 to rs2000004 in the chr2 file
+        model_path = _create_model(os.path.join(tmpdir, 'model.db'), [
+            ('rs1', 'gene1', 0.3, 'A', 'G'), ('rs2000002', 'gene1', -0.7, 'A', 'G'),
+            ('rs3', 'gene2', 1.1, 'G', 'A'), ('rs2000004', 'gene3', 0.5, 'A', 'G'),
+        ])
+        genotype_args = ['--bgens-dir', get_repository_path('set00/'), '--bgens-prefix', 'chr',
+                         '--bgens-sample-file', get_repository_path('set00/impv1.sample'), '--bgens-decoder', 'native']
+        queue_dir = os.path.join(tmpdir, 'queue')
+        args = get_argument_parser().parse_args(['init', '--queue-dir', queue_dir, '--weights-files', model_path,
+                                                 '--output-dir', tmpdir] + genotype_args)
+        WorkQueue.create(queue_dir, args)
+        # a unit leased by a crashed worker
+        stale_lease = os.path.join(queue_dir, 'leases', WorkQueue(queue_dir).units[1]['id'] + '.lease')
+        with open(stale_lease, 'w') as f:
+            json.dump({'worker': 'crashed'}, f)
+        os.utime(stale_lease, (time.time() - 120, time.time() - 120))
+
+        # Run
+        work(queue_dir, lease_timeout=60, poll_seconds=1)
+        reduce_partials(queue_dir)
+        predict.run(predict.get_argument_parser().parse_args(['--weights-file', model_path, '--output-file', os.path.join(tmpdir, 'expected.h5'),
+                                                              '--no-progress-bar'] + genotype_args))
+
+        # Validate
+        assert len(WorkQueue(queue_dir).units) == 2
+        assert os.listdir(os.path.join(queue_dir, 'partials')) == []
+        with h5py.File(os.path.join(tmpdir, 'model.h5'), 'r') as reduced, h5py.File(os.path.join(tmpdir, 'expected.h5'), 'r') as expected:
+            assert np.array_equal(reduced['genes'][:], expected['genes'][:])
+            assert np.array_equal(reduced['samples'][:], expected['samples'][:])
+            assert np.abs(reduced['pred_expr'][:] - expected['pred_expr'][:]).max() < 1e-4
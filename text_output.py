@@ -0,0 +1,146 @@
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# BGZF (bgzip) blocks hold at most 64 KB of compressed data; 0xff00 input bytes always fit
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# the three digits (with leading zeros) of 0 to 999, as characters
+_DIGITS = np.array([list('{:03d}'.format(x).encode()) for x in range(1000)], dtype=np.uint8)
+
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BGZFWriter:
+    """
+    Writes a BGZF file (gzip compatible, so it can be read with zcat, gzip.open or bgzip/tabix), compressing its blocks
+    in parallel with n_threads threads (zlib releases the GIL).
+    """
+    def __init__(self, path, n_threads=1):
+        self.file = open(path, 'wb')
+        self.pool = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+        self.pending = b''
+
+    def write(self, data):
+        data = self.pending + data
+        n_full = len(data) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE
+        self.pending = data[n_full:]
+        blocks = [data[start:start + BGZF_BLOCK_SIZE] for start in range(0, n_full, BGZF_BLOCK_SIZE)]
+        compressed = self.pool.map(_bgzf_block, blocks) if self.pool is not None else map(_bgzf_block, blocks)
+        for block in compressed:
+            self.file.write(block)
+
+    def close(self):
+        if self.pending:
+            self.file.write(_bgzf_block(self.pending))
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def format_rows(prefixes, values, decimals=6):
+    """
+    Formats a block of rows as tab-delimited text without a Python loop over the values: each value is laid out as
+    fixed-width characters (sign, integer digits, decimals), with zero bytes for the unused ones, which are dropped at
+    the end. NaN and infinite values (such as the genes of samples with missing genotypes) are written as str writes
+    them: nan, inf and -inf.
+    :param prefixes: list of the first fields of each row (such as 'FID\tIID\t'), as strings.
+    :param values: (rows x columns) array of numbers.
+    :return: the text of the rows, as bytes.
+    """
+    n_rows, n_columns = values.shape
+    if n_columns == 0:
+        return ''.join(prefix.rstrip('\t') + '\n' for prefix in prefixes).encode()
+    values = np.asarray(values, dtype=np.float64)
+    non_finite = ~np.isfinite(values)
+    scaled = np.rint(np.where(non_finite, 0.0, values) * 10 ** decimals).astype(np.int64)
+    negative = scaled < 0
+    scaled = np.abs(scaled)
+    integer_part, fraction_part = np.divmod(scaled, 10 ** decimals)
+    n_integer_digits = len(str(int(integer_part.max()))) if scaled.size else 1
+
+    width = 1 + n_integer_digits + (1 + decimals if decimals > 0 else 0) + 1
+    if non_finite.any():
+        # room for '-inf' and the delimiter
+        width = max(width, 5)
+    chars = np.zeros((n_rows, n_columns, width), dtype=np.uint8)
+    chars[:, :, 0] = np.where(negative, ord('-'), 0)
+    for digit_idx in range(n_integer_digits):
+        power = 10 ** (n_integer_digits - 1 - digit_idx)
+        digits = (integer_part // power) % 10 + ord('0')
+        # leading zeros are dropped, but the units digit is always written
+        chars[:, :, 1 + digit_idx] = np.where(integer_part >= power, digits, 0) if power > 1 else digits
+    if decimals > 0:
+        chars[:, :, 1 + n_integer_digits] = ord('.')
+        # decimals are written three at a time from a lookup table of the digits of 0 to 999
+        start = 2 + n_integer_digits + decimals
+        while decimals > 0:
+            n_digits = min(3, decimals)
+            fraction_part, digits = np.divmod(fraction_part, 10 ** n_digits)
+            chars[:, :, start - n_digits:start] = _DIGITS[digits.astype(np.int32), 3 - n_digits:]
+            start -= n_digits
+            decimals -= n_digits
+    for text, cells in ((b'nan', np.isnan(values)), (b'inf', values == np.inf), (b'-inf', values == -np.inf)):
+        chars[cells, :-1] = 0
+        chars[cells, :len(text)] = np.frombuffer(text, dtype=np.uint8)
+    chars[:, :, -1] = ord('\t')
+    chars[:, -1, -1] = ord('\n')
+
+    encoded_prefixes = [prefix.encode() for prefix in prefixes]
+    prefix_chars = np.zeros((n_rows, max(len(prefix) for prefix in encoded_prefixes)), dtype=np.uint8)
+    for row_idx, prefix in enumerate(encoded_prefixes):
+        prefix_chars[row_idx, :len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+
+    text = np.concatenate((prefix_chars, chars.reshape(n_rows, -1)), axis=1)
+    return text[text != 0].tobytes()
+
+
+def write_text(pred_expr, genes, samples, text_file, n_threads=1, max_bytes=512 * 1024 ** 2):
+    """
+    Writes predicted expression in the text layout of the original PrediXcan (predicted_expression.txt): a header
+    line, then one line per sample with FID, IID and the value of each gene, tab-delimited. Gene rows are transposed
+    into sample rows one block of samples at a time: blocks are aligned with the HDF5 chunks of pred_expr, so every
+    chunk is only decompressed once if the sample axis is chunked (--max-sample-chunk-size), and are at most max_bytes
+    of formatted text. Blocks are formatted by n_threads threads, and the file is BGZF-compressed (also with n_threads
+    threads) if its name ends with .gz.
+    :param pred_expr: (genes x samples) HDF5 dataset or array.
+    :param samples: list of [FID, IID].
+    """
+    n_genes, n_samples = pred_expr.shape
+    # float32 values, float64 and int64 copies, and about 12 bytes of text per value
+    n_block_samples = max(1, max_bytes // (max(n_genes, 1) * 64))
+    chunks = getattr(pred_expr, 'chunks', None)
+    if chunks is not None and chunks[1] < n_samples:
+        n_block_samples = max(1, n_block_samples // chunks[1]) * chunks[1]
+
+    pool = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+    writer = BGZFWriter(text_file, n_threads) if text_file.endswith('.gz') else open(text_file, 'wb')
+    with writer:
+        writer.write('\t'.join(['FID', 'IID'] + [str(gene) for gene in genes]).encode() + b'\n')
+        for start in range(0, n_samples, n_block_samples):
+            end = min(start + n_block_samples, n_samples)
+            block = np.asarray(pred_expr[:, start:end]).T
+            prefixes = ['{}\t{}\t'.format(*samples[sample_idx]) for sample_idx in range(start, end)]
+            # each thread formats a part of the samples of the block
+            n_part_samples = -(-(end - start) // n_threads)
+            parts = [(prefixes[idx:idx + n_part_samples], block[idx:idx + n_part_samples]) for idx in range(0, end - start, n_part_samples)]
+            texts = pool.map(lambda part: format_rows(*part), parts) if pool is not None else (format_rows(*part) for part in parts)
+            for text in texts:
+                writer.write(text)
+    if pool is not None:
+        pool.shutdown()
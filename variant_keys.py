@@ -0,0 +1,74 @@
+import zlib
+
+import numpy as np
+
+# non-numeric chromosomes, with the PLINK numbering
+CHROMOSOME_CODES = {'X': 23, 'Y': 24, 'XY': 25, 'MT': 26, 'M': 26}
+
+
+def chromosome_code(chromosome):
+    chromosome = str(chromosome)
+    chromosome = chromosome[3:] if chromosome.lower().startswith('chr') else chromosome
+    if chromosome.isdigit():
+        return int(chromosome)
+    return CHROMOSOME_CODES.get(chromosome.upper(), 0)
+
+
+def allele_hash(allele_a, allele_b):
+    """
+    24-bit hash of an unordered pair of alleles, so that a variant matches whichever allele is taken as reference.
+    """
+    allele_a, allele_b = sorted((allele_a.upper(), allele_b.upper()))
+    return zlib.crc32('{}>{}'.format(allele_a, allele_b).encode()) & 0xFFFFFF
+
+
+def variant_keys(chromosomes, positions, alleles_a, alleles_b):
+    """
+    Encodes variants as 64-bit integers: chromosome (8 bits), position (32 bits) and a hash of the alleles (24 bits).
+    Allele pairs are hashed once per distinct pair, so the cost is dominated by a sort of the pairs.
+    :return: uint64 array of keys, in the order of the given variants.
+    """
+    chromosome_codes = {x: chromosome_code(x) for x in set(chromosomes)}
+    codes = np.array([chromosome_codes[x] for x in chromosomes], dtype=np.uint64)
+
+    pairs = np.char.add(np.char.add(np.asarray(alleles_a, dtype=str), '>'), np.asarray(alleles_b, dtype=str))
+    unique_pairs, pair_idxs = np.unique(pairs, return_inverse=True)
+    hashes = np.array([allele_hash(*pair.split('>', 1)) for pair in unique_pairs], dtype=np.uint64)
+
+    return (codes << np.uint64(56)) | (np.asarray(positions, dtype=np.uint64) << np.uint64(24)) | hashes[pair_idxs]
+
+
+def parse_var_ids(var_ids):
+    """
+    Splits predictdb variant IDs (chr1_13550_G_A_b38, or 1_13550_G_A_b37) into chromosomes, positions and alleles.
+    """
+    chromosomes, positions, alleles_a, alleles_b = [], [], [], []
+    for var_id in var_ids:
+        fields = var_id.split('_')
+        chromosomes.append(fields[0])
+        positions.append(int(fields[1]))
+        alleles_a.append(fields[2])
+        alleles_b.append(fields[3])
+    return chromosomes, positions, alleles_a, alleles_b
+
+
+def merge_join(left_keys, right_keys):
+    """
+    Inner join of two key arrays through their sorted orders.
+    :return: (left indexes, right indexes) of every matching pair, sorted by right index.
+    """
+    left_keys = np.asarray(left_keys)
+    right_keys = np.asarray(right_keys)
+    left_order = np.argsort(left_keys, kind='mergesort')
+    sorted_left = left_keys[left_order]
+
+    starts = np.searchsorted(sorted_left, right_keys, side='left')
+    ends = np.searchsorted(sorted_left, right_keys, side='right')
+    counts = ends - starts
+
+    right_idxs = np.repeat(np.arange(len(right_keys)), counts)
+    # position of each pair within its run of equal left keys
+    offsets = np.arange(len(right_idxs)) - np.repeat(np.cumsum(counts) - counts, counts)
+    left_idxs = left_order[np.repeat(starts, counts) + offsets]
+
+    return left_idxs, right_idxs
@@ -0,0 +1,104 @@
+import gzip
+import struct
+
+import numpy as np
+
+
+def reg2bins(beg, end, min_shift=14, depth=5):
+    """
+    Bins of the binning scheme of tabix/CSI indexes that may hold records overlapping [beg, end) (0-based).
+    """
+    bins = []
+    end -= 1
+    level_start, shift = 0, min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(range(level_start + (beg >> shift), level_start + (end >> shift) + 1))
+        level_start += 1 << (level * 3)
+        shift -= 3
+    return bins
+
+
+class TabixIndex:
+    """
+    Index of a bgzipped VCF file, read from a tabix (.tbi) or CSI (.csi) file: for each contig, the chunks (ranges of
+    BGZF virtual file offsets) of the records of each bin, and for .tbi files the linear index (smallest offset of the
+    records overlapping each 16 kb window).
+    """
+    def __init__(self, index_path, contigs=()):
+        """
+        :param contigs: contig names of the VCF header, used for CSI files that do not store them.
+        """
+        with gzip.open(index_path, 'rb') as f:
+            data = f.read()
+
+        magic = data[:4]
+        if magic == b'TBI\x01':
+            self.is_csi = False
+            self.min_shift, self.depth = 14, 5
+            n_ref = struct.unpack_from('<i', data, 4)[0]
+            names, offset = self._read_names(data, 8)
+        elif magic == b'CSI\x01':
+            self.is_csi = True
+            self.min_shift, self.depth, aux_length = struct.unpack_from('<3i', data, 4)
+            names = self._read_names(data, 16)[0] if aux_length >= 28 else list(contigs)
+            offset = 16 + aux_length
+            n_ref = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+        else:
+            raise ValueError("{} is not a tabix or CSI index".format(index_path))
+
+        # the metadata pseudo-bin follows the last bin of the deepest level
+        pseudo_bin = ((1 << ((self.depth + 1) * 3)) - 1) // 7 + 1
+        self.contigs = {}
+        for ref_idx in range(n_ref):
+            n_bins = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            bins = {}
+            for _ in range(n_bins):
+                if self.is_csi:
+                    bin_number, _, n_chunks = struct.unpack_from('<IQi', data, offset)
+                    offset += 16
+                else:
+                    bin_number, n_chunks = struct.unpack_from('<Ii', data, offset)
+                    offset += 8
+                chunks = np.frombuffer(data, dtype='<u8', count=2 * n_chunks, offset=offset).reshape(n_chunks, 2)
+                offset += 16 * n_chunks
+                if bin_number != pseudo_bin:
+                    bins[bin_number] = chunks
+
+            linear_index = None
+            if not self.is_csi:
+                n_intervals = struct.unpack_from('<i', data, offset)[0]
+                offset += 4
+                linear_index = np.frombuffer(data, dtype='<u8', count=n_intervals, offset=offset)
+                offset += 8 * n_intervals
+
+            if ref_idx < len(names):
+                self.contigs[names[ref_idx]] = (bins, linear_index)
+
+    @staticmethod
+    def _read_names(data, offset):
+        """
+        Reads the tabix configuration (format, sequence, begin and end columns, comment character, skipped lines) and
+        the null-terminated contig names that follow it.
+        """
+        names_length = struct.unpack_from('<7i', data, offset)[6]
+        offset += 28
+        names = [name.decode() for name in data[offset:offset + names_length].split(b'\x00') if name]
+        return names, offset + names_length
+
+    def chunks(self, contig, beg, end):
+        """
+        Returns the (start, end) virtual offsets of the chunks that may hold records of contig overlapping [beg, end)
+        (0-based), sorted by start.
+        """
+        if contig not in self.contigs:
+            return []
+        bins, linear_index = self.contigs[contig]
+        min_offset = 0
+        if linear_index is not None and len(linear_index) > 0:
+            min_offset = int(linear_index[min(beg >> self.min_shift, len(linear_index) - 1)])
+
+        chunks = [(int(start), int(stop)) for bin_number in reg2bins(beg, end, self.min_shift, self.depth) if bin_number in bins
+                  for start, stop in bins[bin_number] if stop > min_offset]
+        return sorted(chunks)
@@ -0,0 +1,360 @@
+import os
+import gzip
+import json
+import zlib
+import struct
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from backends import VariantTableDosage, chromosome_number
+from vcf.tabix_index import TabixIndex
+
+# a BGZF block is at most 64 KB, compressed or not
+BGZF_MAX_BLOCK_SIZE = 0x10000
+
+TAB, COLON, DOT, ZERO, NINE = (ord(x) for x in '\t:.09')
+
+
+def read_vcf_header(vcf_path):
+    """
+    Returns the contig names (##contig lines) and the sample IDs (#CHROM line) of a VCF file.
+    """
+    contigs = []
+    with gzip.open(vcf_path, 'rt') as f:
+        for line in f:
+            if line.startswith('##contig=<'):
+                fields = dict(x.split('=', 1) for x in line.strip()[len('##contig=<'):-1].split(',') if '=' in x)
+                contigs.append(fields.get('ID'))
+            elif line.startswith('#CHROM'):
+                return contigs, line.rstrip('\r\n').split('\t')[9:]
+            elif not line.startswith('#'):
+                break
+    raise ValueError("{} has no #CHROM header line".format(vcf_path))
+
+
+def find_vcf_index(vcf_path):
+    for extension in ('.tbi', '.csi'):
+        if os.path.isfile(vcf_path + extension):
+            return vcf_path + extension
+    return None
+
+
+def _bgzf_block_size(data, offset):
+    """
+    Size of the BGZF block starting at offset of data, from the BSIZE field of its header.
+    """
+    extra_length = struct.unpack_from('<H', data, offset + 10)[0]
+    position = offset + 12
+    while position < offset + 12 + extra_length:
+        si1, si2, field_length = struct.unpack_from('<BBH', data, position)
+        if si1 == 66 and si2 == 67:
+            return struct.unpack_from('<H', data, position + 4)[0] + 1
+        position += 4 + field_length
+    raise ValueError("Not a BGZF block")
+
+
+def _inflate(block):
+    extra_length = struct.unpack_from('<H', block, 10)[0]
+    return zlib.decompress(block[12 + extra_length:-8], -15)
+
+
+def _records(text, final=True):
+    """
+    Yields the (start, end) offsets of the records (lines not starting with '#') of text. Unless final, text may end
+    with the beginning of a record, which is not yielded.
+    """
+    line_start = 0
+    while line_start < len(text):
+        line_end = text.find(b'\n', line_start)
+        if line_end < 0:
+            if not final:
+                return
+            line_end = len(text)
+        if text[line_start] != ord('#') and line_end > line_start:
+            yield line_start, line_end
+        line_start = line_end + 1
+
+
+def _first_columns(text, start):
+    """
+    Returns the offsets of the first five tabs of the record starting at start (after CHROM, POS, ID, REF and ALT).
+    """
+    tabs = [text.find(b'\t', start)]
+    for _ in range(4):
+        tabs.append(text.find(b'\t', tabs[-1] + 1))
+    return tabs
+
+
+def parse_dosages(record, n_samples, out):
+    """
+    Parses the DS field of every sample of a VCF record into out (NaN for missing values), without splitting the
+    record per sample: the DS field of each sample is located from the positions of the tabs and colons of the record,
+    its characters are gathered into a (samples x characters) array, and turned into numbers with array arithmetic
+    (each digit times the power of ten of its place relative to the decimal point), as a single matrix product when
+    all the values have the same layout.
+    :param record: the bytes of the record, without the line break.
+    """
+    line = np.frombuffer(record, dtype=np.uint8)
+    tabs = np.flatnonzero(line == TAB)
+    if len(tabs) != 8 + n_samples:
+        raise ValueError("VCF record with {} sample columns instead of {}: {}".format(len(tabs) - 8, n_samples, record[:80]))
+    format_keys = record[tabs[7] + 1:tabs[8]].split(b':')
+    if b'DS' not in format_keys:
+        raise ValueError("VCF record without a DS field: {}".format(record[:80]))
+    ds_field = format_keys.index(b'DS')
+
+    column_starts = tabs[8:] + 1
+    column_ends = np.append(tabs[9:], len(line))
+    # colon positions, with the end of the line as a last stop
+    colons = np.append(np.flatnonzero(line[tabs[8]:] == COLON) + tabs[8], len(line))
+    # the colon before the DS field of each sample (the one before its column for the first field)
+    colon_idxs = np.searchsorted(colons, column_starts) + ds_field - 1
+    if ds_field == 0:
+        starts = column_starts
+    else:
+        # samples with fewer fields (such as '.') have an empty DS field
+        colon_idxs = np.minimum(colon_idxs, len(colons) - 1)
+        field_colons = colons[colon_idxs]
+        starts = np.where(field_colons < column_ends, field_colons + 1, column_ends)
+    # the DS field ends at the next colon or at the end of the column
+    ends = np.minimum(colons[np.minimum(colon_idxs + 1, len(colons) - 1)], column_ends)
+
+    lengths = ends - starts
+    width = int(lengths.max()) if n_samples else 0
+    if width == 0:
+        out[:] = np.nan
+        return
+    places = np.arange(width)
+    if (lengths == width).all():
+        # same layout for every sample (such as the '%.3f' values of imputation servers): digits times place values
+        chars = line[starts[:, None] + places]
+        dot_columns = np.flatnonzero(chars[0] == DOT)
+        dot_place = int(dot_columns[0]) if len(dot_columns) == 1 else width
+        digit_places = places[places != dot_place]
+        digits = chars[:, digit_places] - np.uint8(ZERO)
+        # a lone '.' (missing in every sample) has no digit column and is left to the general case
+        if len(digit_places) and (digits <= 9).all() and (dot_place == width or (chars[:, dot_place] == DOT).all()):
+            place_values = np.power(10.0, dot_place - digit_places - (digit_places < dot_place))
+            np.dot(digits, place_values, out=out)
+            return
+
+    in_field = places < lengths[:, None]
+    chars = np.where(in_field, line[np.minimum(starts[:, None] + places, len(line) - 1)], 0)
+    is_digit = (chars >= ZERO) & (chars <= NINE)
+    is_dot = chars == DOT
+    if (in_field & ~is_digit & ~is_dot).any():
+        # signs, exponents or several values (not written by imputation servers)
+        values = [x.split(b':')[ds_field] if x.count(b':') >= ds_field else b'.' for x in record.split(b'\t')[9:]]
+        out[:] = [float(x) if x != b'.' else np.nan for x in values]
+        return
+
+    # place of the decimal point in each value (its length if there is none)
+    dot_places = np.where(is_dot.any(axis=1), is_dot.argmax(axis=1), lengths)[:, None]
+    exponents = dot_places - places - (places < dot_places)
+    # powers of ten from 10^-width to 10^width
+    place_values = np.power(10.0, np.arange(-width, width + 1))[exponents + width]
+    out[:] = ((chars - ZERO) * is_digit * place_values).sum(axis=1)
+    # '.' or an empty field
+    out[~is_digit.any(axis=1)] = np.nan
+
+
+class VCFDosage(VariantTableDosage):
+    """
+    Dosages (DS field, counting the ALT allele) of a bgzipped VCF file, such as the .dose.vcf.gz files of the
+    Michigan and TOPMed imputation servers, indexed with tabix (.tbi) or bcftools (.csi). The variant table (IDs,
+    positions and alleles) is kept in a NumPy file next to the VCF file, built from one pass over it the first time;
+    the records of a batch are found through the index, their BGZF blocks decompressed with n_threads threads, and
+    their DS fields parsed straight into the dosage array (see parse_dosages). Records with several ALT alleles are
+    left out.
+    """
+    def __init__(self, vcf_path, sample_path=None, n_threads=1, prefetch_depth=0, prefetch_max_bytes=256 * 1024 ** 2):
+        """
+        :param prefetch_depth: number of batches whose BGZF blocks are read ahead by the kernel (posix_fadvise) while
+        the current one is decoded, up to prefetch_max_bytes. 0 disables read-ahead.
+        """
+        self.vcf_path = vcf_path
+        self.sample_path = sample_path if sample_path is not None else vcf_path
+        contigs, samples = read_vcf_header(vcf_path)
+        self.samples_count = len(samples)
+
+        index_path = find_vcf_index(vcf_path)
+        if index_path is None:
+            raise ValueError("{} has no tabix (.tbi) or CSI (.csi) index".format(vcf_path))
+        self.index = TabixIndex(index_path, contigs)
+
+        self.pool = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+        self.fd = os.open(vcf_path, os.O_RDONLY)
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_bytes = prefetch_max_bytes
+        if prefetch_depth > 0:
+            self.prefetch_fd = self.fd
+
+        self._read_variants(vcf_path + '.sites.npz')
+
+    def close(self):
+        """
+        Closes the VCF file and stops the parsing threads. Variants cannot be read afterwards.
+        """
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.prefetch_fd = None
+        if getattr(self, 'pool', None) is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __del__(self):
+        self.close()
+
+    def _map(self, function, *iterables):
+        return list(self.pool.map(function, *iterables)) if self.pool is not None else list(map(function, *iterables))
+
+    def _read_blocks(self, virtual_ranges):
+        """
+        Decompresses (with the thread pool) the BGZF blocks of the given (start, end) virtual offset ranges, and
+        returns the uncompressed bytes of each range.
+        """
+        all_blocks, range_blocks = [], []
+        for start, end in virtual_ranges:
+            first_block, last_block = start >> 16, end >> 16
+            data = os.pread(self.fd, last_block - first_block + BGZF_MAX_BLOCK_SIZE, first_block)
+            offset, n_blocks = 0, 0
+            # the block where the range ends is only needed if the range has bytes of it
+            while offset < len(data) and (first_block + offset < last_block or (first_block + offset == last_block and end & 0xffff)):
+                size = _bgzf_block_size(data, offset)
+                all_blocks.append(data[offset:offset + size])
+                offset += size
+                n_blocks += 1
+            range_blocks.append(n_blocks)
+
+        inflated = self._map(_inflate, all_blocks)
+        texts, block_idx = [], 0
+        for (start, end), n_blocks in zip(virtual_ranges, range_blocks):
+            blocks = inflated[block_idx:block_idx + n_blocks]
+            block_idx += n_blocks
+            text = b''.join(blocks)
+            if end & 0xffff:
+                text = text[:len(text) - len(blocks[-1]) + (end & 0xffff)]
+            texts.append(text[start & 0xffff:])
+        return texts
+
+    def _read_variants(self, sites_path):
+        """
+        Reads the variant table from the sites file (sites_path, with its metadata in a .json file next to it), built
+        first if it is missing or older than the VCF file.
+        """
+        stat = os.stat(self.vcf_path)
+        stamp = {'vcf_size': stat.st_size, 'vcf_mtime_ns': stat.st_mtime_ns}
+        metadata_path = os.path.splitext(sites_path)[0] + '.json'
+        metadata = None
+        if os.path.isfile(sites_path) and os.path.isfile(metadata_path):
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+            if any(metadata.get(key) != value for key, value in stamp.items()):
+                metadata = None
+        if metadata is None:
+            metadata = self._build_sites(sites_path, metadata_path, stamp)
+
+        with np.load(sites_path) as sites:
+            contig_idxs = sites['contig_idxs']
+            self.positions = sites['positions'].tolist()
+            text = sites['text'].tobytes().decode()
+        self.contigs = metadata['contigs']
+        self.contig_names = [self.contigs[idx] for idx in contig_idxs.tolist()]
+        self.chromosomes = [chromosome_number(contig) for contig in self.contig_names]
+        fields = [line.split('\t') for line in text.split('\n')[:-1]]
+        self.rsids = [x[0] for x in fields]
+        self.alleles0 = [x[1] for x in fields]
+        self.alleles1 = [x[2] for x in fields]
+        self.variants_count = len(self.rsids)
+
+    def _build_sites(self, sites_path, metadata_path, stamp):
+        print("{} Reading the variants of {}".format(datetime.datetime.now(), self.vcf_path))
+        contigs, contig_idxs, positions, lines = [], [], [], []
+        contig_index = {}
+        file_size = os.fstat(self.fd).st_size
+        offset, pending = 0, b''
+        while offset < file_size:
+            # about 64 MB of whole blocks at a time, decompressed by the thread pool
+            data = os.pread(self.fd, 1024 * BGZF_MAX_BLOCK_SIZE, offset)
+            blocks, block_offset = [], 0
+            while block_offset + 18 <= len(data):
+                size = _bgzf_block_size(data, block_offset)
+                if block_offset + size > len(data):
+                    break
+                blocks.append(data[block_offset:block_offset + size])
+                block_offset += size
+            if not blocks:
+                raise ValueError("Truncated BGZF file {}".format(self.vcf_path))
+            offset += block_offset
+            text = pending + b''.join(self._map(_inflate, blocks))
+
+            final = offset >= file_size
+            for line_start, line_end in _records(text, final):
+                # the first five columns only
+                tabs = _first_columns(text, line_start)
+                if b',' in text[tabs[3] + 1:tabs[4]]:
+                    continue
+                contig = text[line_start:tabs[0]].decode()
+                if contig not in contig_index:
+                    contig_index[contig] = len(contigs)
+                    contigs.append(contig)
+                contig_idxs.append(contig_index[contig])
+                positions.append(int(text[tabs[0] + 1:tabs[1]]))
+                lines.append(text[tabs[1] + 1:tabs[4]] + b'\n')
+            # the beginning of a record continued in the next blocks
+            pending = b'' if final else text[text.rfind(b'\n') + 1:]
+
+        # written to temporary files first, so that concurrent jobs never read a partial file
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        with open(sites_path + tmp_suffix, 'wb') as f:
+            np.savez(f, contig_idxs=np.array(contig_idxs, dtype=np.int32), positions=np.array(positions, dtype=np.int64),
+                     text=np.frombuffer(b''.join(lines), dtype=np.uint8))
+        metadata = dict(stamp, contigs=contigs)
+        with open(metadata_path + tmp_suffix, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(sites_path + tmp_suffix, sites_path)
+        os.replace(metadata_path + tmp_suffix, metadata_path)
+        return metadata
+
+    def _virtual_ranges(self, variant_idxs):
+        """
+        Merged (start, end) virtual offset ranges of the index chunks that may hold the given variants.
+        """
+        chunks = sorted(chunk for idx in variant_idxs
+                        for chunk in self.index.chunks(self.contig_names[idx], self.positions[idx] - 1, self.positions[idx]))
+        merged = []
+        for start, end in chunks:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def _batch_ranges(self, variant_idxs):
+        return [(start >> 16, (end >> 16) - (start >> 16) + BGZF_MAX_BLOCK_SIZE) for start, end in self._virtual_ranges(variant_idxs)]
+
+    def _decode(self, variant_idxs):
+        # records are matched by position, ID and alleles; their order in the file is the order of variant_idxs
+        wanted = {}
+        for row_idx, idx in enumerate(variant_idxs):
+            key = (self.positions[idx], self.rsids[idx], self.alleles0[idx], self.alleles1[idx])
+            wanted.setdefault(key, []).append(row_idx)
+
+        records = [None] * len(variant_idxs)
+        for text in self._read_blocks(self._virtual_ranges(variant_idxs)):
+            for line_start, line_end in _records(text):
+                tabs = _first_columns(text, line_start)
+                key = (int(text[tabs[0] + 1:tabs[1]]),) + tuple(text[tabs[idx] + 1:tabs[idx + 1]].decode() for idx in range(1, 4))
+                if wanted.get(key):
+                    records[wanted[key].pop(0)] = text[line_start:line_end].rstrip(b'\r')
+
+        missing = [variant_idxs[row_idx] for row_idx, record in enumerate(records) if record is None]
+        if missing:
+            raise ValueError("Variant {} of {} not found through its index".format(self.rsids[missing[0]], self.vcf_path))
+
+        dosages = np.empty((len(variant_idxs), self.samples_count), dtype=np.float64)
+        self._map(parse_dosages, records, [self.samples_count] * len(records), dosages)
+        return dosages
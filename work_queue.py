@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import threading
+import traceback
+
+import predict
+
+QUEUE_FILE = 'queue.json'
+
+
+class Lease:
+    """
+    Exclusive claim of a work unit by one worker: a file created with os.link, which is atomic (also on NFS) and fails
+    if the file exists. The owner refreshes its modification time every timeout / 4 seconds while it works; a lease
+    not refreshed for timeout seconds belongs to a crashed worker and can be reclaimed.
+    """
+    def __init__(self, path, worker_id, timeout):
+        self.path = path
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _owner(self, path=None):
+        try:
+            with open(path or self.path, 'r') as f:
+                return json.load(f).get('worker')
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, self.worker_id)
+        with open(tmp_path, 'w') as f:
+            json.dump({'worker': self.worker_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'started': time.time()}, f)
+        try:
+            os.link(tmp_path, self.path)
+        except FileExistsError:
+            if not self._reclaim():
+                return False
+            try:
+                os.link(tmp_path, self.path)
+            except FileExistsError:
+                return False
+        finally:
+            os.remove(tmp_path)
+
+        self._heartbeat = threading.Thread(target=self._refresh, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _reclaim(self):
+        """
+        Removes the lease if it is stale. The lease is first moved away under a name of this worker, and put back if
+        another worker claimed the unit in the meantime (the moved lease is then not the stale one).
+        """
+        owner = self._owner()
+        try:
+            if time.time() - os.stat(self.path).st_mtime < self.timeout:
+                return False
+            moved_path = '{}.stale.{}'.format(self.path, self.worker_id)
+            os.rename(self.path, moved_path)
+        except FileNotFoundError:
+            # released or reclaimed by another worker
+            return True
+
+        if self._owner(moved_path) != owner or time.time() - os.stat(moved_path).st_mtime < self.timeout:
+            try:
+                os.link(moved_path, self.path)
+            except FileExistsError:
+                pass
+            os.remove(moved_path)
+            return False
+
+        print("{} Reclaimed stale lease {} of worker {}".format(datetime.datetime.now(), self.path, owner))
+        os.remove(moved_path)
+        return True
+
+    def _refresh(self):
+        while not self._stop.wait(self.timeout / 4.0):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def is_owned(self):
+        return self._owner() == self.worker_id
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self.is_owned():
+            os.remove(self.path)
+
+
+class WorkQueue:
+    """
+    Work units of a multi-node prediction, one per (model, genotype file), in a directory on a shared filesystem:
+    queue.json (the units and the prediction options), leases/ (units being computed), partials/ (float64 gene x
+    sample results of each finished unit), done/ and failed/ (one file per finished or failed attempt of a unit).
+    """
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        with open(os.path.join(queue_dir, QUEUE_FILE), 'r') as f:
+            config = json.load(f)
+        self.args = config['args']
+        self.units = config['units']
+        self.models = config['models']
+
+    @staticmethod
+    def create(queue_dir, args):
+        """
+        Creates the queue of a prediction of every model of args.weights_files over each genotype file. A unit covers
+        one chromosome only if each genotype file holds one (such as the files selected with --autosomes and a
+        --bgens-prefix with {chr_num}).
+        """
+        for subdir in ('leases', 'partials', 'done', 'failed'):
+            os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+        backend, genotype_files = predict.get_genotype_files(args.bgens_dir, args.bgens_prefix, args)
+        if not genotype_files:
+            print("ERROR: No genotype files in {} start with {}".format(args.bgens_dir, args.bgens_prefix))
+            sys.exit(1)
+
+        models, units = [], []
+        for model_idx, weights_file in enumerate(args.weights_files):
+            model_name = os.path.splitext(os.path.basename(weights_file))[0]
+            model_id = '{:03d}_{}'.format(model_idx, model_name)
+            models.append({'id': model_id, 'weights_file': os.path.abspath(weights_file),
+                           'output_file': os.path.abspath(os.path.join(args.output_dir, model_name + '.h5'))})
+            for genotype_file in genotype_files:
+                units.append({'id': '{}__{}'.format(model_id, genotype_file), 'model': model_id,
+                              'weights_file': os.path.abspath(weights_file), 'genotype_file': genotype_file})
+
+        options = {key: value for key, value in vars(args).items() if key not in ('command', 'queue_dir', 'weights_files', 'output_dir')}
+        for key in ('bgens_dir', 'bgens_bgi_dir', 'bgens_sample_file', 'gene_list', 'keep_samples'):
+            if options.get(key) is not None:
+                options[key] = os.path.abspath(options[key])
+        with open(os.path.join(queue_dir, QUEUE_FILE), 'w') as f:
+            json.dump({'args': options, 'models': models, 'units': units}, f, indent=2)
+        print("{} Created {} work units ({} models x {} genotype files) in {}".format(
+            datetime.datetime.now(), len(units), len(models), len(genotype_files), queue_dir))
+
+    def _path(self, subdir, unit_id, suffix=''):
+        return os.path.join(self.queue_dir, subdir, unit_id + suffix)
+
+    def is_done(self, unit_id):
+        return os.path.exists(self._path('done', unit_id))
+
+    def n_failures(self, unit_id):
+        prefix = unit_id + '.'
+        return sum(1 for x in os.listdir(os.path.join(self.queue_dir, 'failed')) if x.startswith(prefix))
+
+    def pending_units(self, max_attempts):
+        return [unit for unit in self.units if not self.is_done(unit['id']) and self.n_failures(unit['id']) < max_attempts]
+
+    def partial_path(self, unit_id):
+        return self._path('partials', unit_id, '.h5')
+
+    def unit_args(self, unit, output_file):
+        """
+        Arguments of predict.run for one unit: the prediction options of the queue, restricted to the unit's genotype
+        file and writing a partial output.
+        """
+        args = argparse.Namespace(**self.args)
+        args.weights_file = unit['weights_file']
+        args.output_file = output_file
+        args.bgens_prefix = unit['genotype_file']
+        args.autosomes = False
+        args.covariance_output = None
+        args.dry_run = False
+        args.gene_stats = False
+        args.scratch_dir = None
+        args.swmr = False
+        args.result_cache_dir = None
+        args.text_output = None
+        args.partial_output = True
+        args.append_samples = False
+        args.no_progress_bar = True
+        return args
+
+    def run_unit(self, unit, worker_id):
+        """
+        Computes a unit into partials/, then marks it as done. Returns False if it failed.
+        """
+        tmp_output = self._path('partials', unit['id'], '.{}.h5'.format(worker_id))
+        try:
+            predict.run(self.unit_args(unit, tmp_output))
+            if not os.path.isfile(tmp_output):
+                raise RuntimeError("no output written (no genes to predict)")
+        except (Exception, SystemExit) as e:
+            error = traceback.format_exc() if isinstance(e, Exception) else 'exit code {}'.format(e.code)
+            print("{} Unit {} failed: {}".format(datetime.datetime.now(), unit['id'], error))
+            with open(self._path('failed', unit['id'], '.{}'.format(worker_id)), 'w') as f:
+                f.write(error)
+            if os.path.isfile(tmp_output):
+                os.remove(tmp_output)
+            return False
+
+        os.replace(tmp_output, self.partial_path(unit['id']))
+        with open(self._path('done', unit['id']), 'w') as f:
+            json.dump({'worker': worker_id, 'finished': time.time()}, f)
+        return True
+
+
+def work(queue_dir, lease_timeout=600, max_attempts=3, poll_seconds=30):
+    """
+    Claims and computes pending units until every unit is done (or failed max_attempts times). Units leased by other
+    workers are waited for, and reclaimed if their lease gets stale.
+    """
+    queue = WorkQueue(queue_dir)
+    worker_id = '{}.{}.{}'.format(socket.gethostname(), os.getpid(), int(time.time() * 1000) % 100000)
+    while True:
+        pending = queue.pending_units(max_attempts)
+        if not pending:
+            break
+
+        worked = False
+        for unit in pending:
+            lease = Lease(queue._path('leases', unit['id'], '.lease'), worker_id, lease_timeout)
+            # the unit may have been finished since pending_units was called
+            if queue.is_done(unit['id']) or not lease.acquire():
+                continue
+            try:
+                if not queue.is_done(unit['id']):
+                    print("{} Worker {} running unit {}".format(datetime.datetime.now(), worker_id, unit['id']))
+                    queue.run_unit(unit, worker_id)
+                    worked = True
+            finally:
+                lease.release()
+
+        if not worked:
+            time.sleep(poll_seconds)
+    print("{} No pending units left".format(datetime.datetime.now()))
+
+
+def reduce_partials(queue_dir, keep_partials=False):
+    """
+    Sums the partial results of the units of each model whose units are all done into the model's output file (the
+    same layout as predict.py), one block of genes at a time.
+    """
+    import h5py
+
+    queue = WorkQueue(queue_dir)
+    args = argparse.Namespace(**queue.args)
+    for model in queue.models:
+        units = [unit for unit in queue.units if unit['model'] == model['id']]
+        not_done = [unit['id'] for unit in units if not queue.is_done(unit['id'])]
+        if not_done:
+            print("{} Skipping model {}: {} units not done ({})".format(datetime.datetime.now(), model['id'], len(not_done), ', '.join(not_done)))
+            continue
+
+        print("{} Reducing {} partial results of model {}".format(datetime.datetime.now(), len(units), model['id']))
+        partial_files = [h5py.File(queue.partial_path(unit['id']), 'r') for unit in units]
+        partials = [partial_file['pred_expr'] for partial_file in partial_files]
+        n_genes, n_samples = partials[0].shape
+
+        keep_samples = predict.load_keep_samples(args.keep_samples)
+        transcription_matrix = predict.TranscriptionMatrix(model['weights_file'], args.bgens_sample_file, model['output_file'],
+                                                           cache_size=(args.bgens_writing_cache_size * (1024 ** 2)), keep_samples=keep_samples,
+                                                           n_compression_threads=args.n_compression_threads,
+                                                           max_pending_size=args.compression_max_pending_mb * (1024 ** 2))
+        transcription_matrix.create_output(n_samples, args.max_gene_chunk_size, args.max_sample_chunk_size, predict.load_gene_list(args.gene_list))
+        genes = transcription_matrix.gene_list
+        for unit, partial_file in zip(units, partial_files):
+            if [gene.decode() for gene in partial_file['genes'][:]] != [str(gene) for gene in genes]:
+                print("ERROR: the genes of {} do not match the model {}".format(queue.partial_path(unit['id']), model['weights_file']))
+                sys.exit(1)
+
+        n_genes_block = partials[0].chunks[0] if partials[0].chunks is not None else n_genes
+        for start in range(0, n_genes, n_genes_block):
+            block = sum(partial[start:start + n_genes_block] for partial in partials)
+            for block_idx, gene in enumerate(genes[start:start + n_genes_block]):
+                transcription_matrix.set_row(gene, block[block_idx])
+            transcription_matrix.finish_genes(genes[start:start + n_genes_block])
+        transcription_matrix.save()
+
+        for partial_file in partial_files:
+            partial_file.close()
+        if not keep_partials:
+            for unit in units:
+                os.remove(queue.partial_path(unit['id']))
+
+
+def status(queue_dir, max_attempts=3):
+    queue = WorkQueue(queue_dir)
+    leases = set(x[:-len('.lease')] for x in os.listdir(os.path.join(queue_dir, 'leases')) if x.endswith('.lease'))
+    counts = {'done': 0, 'running': 0, 'failed': 0, 'pending': 0}
+    for unit in queue.units:
+        if queue.is_done(unit['id']):
+            counts['done'] += 1
+        elif unit['id'] in leases:
+            counts['running'] += 1
+        elif queue.n_failures(unit['id']) >= max_attempts:
+            counts['failed'] += 1
+        else:
+            counts['pending'] += 1
+    print(json.dumps(counts, indent=2))
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description="Runs predictions of several models as (model, genotype file) work "
+                                                 "units shared through a queue directory, by any number of workers on any node.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    init_parser = subparsers.add_parser('init', help="Create the work units of a prediction.")
+    init_parser.add_argument('--queue-dir', required=True, help="Queue directory, on a filesystem shared by all workers.")
+    init_parser.add_argument('--weights-files', required=True, nargs='+', help="SQLite databases with rsid weights, one per model.")
+    init_parser.add_argument('--output-dir', required=True, help="Directory of the predicted expression files (one per model, named after it).")
+    init_parser.add_argument('--gene-list', default=None, help="a list of gene to work with (one gene per row without header)")
+    init_parser.add_argument('--keep-samples', default=None, help="a list of sample IDs to predict for (one ID per row without header)")
+    predict.add_genotype_arguments(init_parser)
+
+    for name, help_text in (('work', "Claim and compute work units until none is left."), ('reduce', "Sum the partial results of each model."),
+                            ('status', "Print the number of done, running, failed and pending units.")):
+        command_parser = subparsers.add_parser(name, help=help_text)
+        command_parser.add_argument('--queue-dir', required=True, help="Queue directory.")
+        if name in ('work', 'status'):
+            command_parser.add_argument('--max-attempts', type=int, default=3, help="Number of failed attempts after which a unit is given up. Default: 3")
+        if name == 'work':
+            command_parser.add_argument('--lease-timeout', type=int, default=600, help="Seconds after which the lease of a unit that is not refreshed is considered stale (its worker crashed) and the unit is claimed again. Default: 600")
+            command_parser.add_argument('--poll-seconds', type=int, default=30, help="Seconds between checks for units to reclaim while other workers run the last ones. Default: 30")
+        if name == 'reduce':
+            command_parser.add_argument('--keep-partials', action="store_true", help="Keep the partial results after writing each model's output.")
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_argument_parser()
+    args = parser.parse_args()
+    if args.command == 'init':
+        WorkQueue.create(args.queue_dir, args)
+    elif args.command == 'work':
+        work(args.queue_dir, args.lease_timeout, args.max_attempts, args.poll_seconds)
+    elif args.command == 'reduce':
+        reduce_partials(args.queue_dir, args.keep_partials)
+    elif args.command == 'status':
+        status(args.queue_dir, args.max_attempts)
+    else:
+        parser.print_help()
+        sys.exit(1)